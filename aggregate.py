@@ -0,0 +1,232 @@
+import math
+import time
+import threading
+import discovery
+import mqtt
+import serialize
+from array import array
+from config import CONFIG, parse_windows
+from loguru import logger
+from sensors import OUTPUTS, flatten, set_value
+
+
+# Values averaged as angles (ex: 350° and 10° average to 0°, not 180°). Their min/max aren't published
+CIRCULAR_FIELDS = {("wind", "direction", "degrees")}
+
+# Each field takes up this many slots in a window's array: count, sum, min, max, sum of sin, sum of cos
+SLOTS = 6
+EMPTY_FIELD = array("d", [0.0, 0.0, math.inf, -math.inf, 0.0, 0.0])
+
+
+# [(name, seconds)]. Invalid windows are left out (and reported by config.check)
+windows = parse_windows(CONFIG)[0]
+ha_stats = [stat.strip() for stat in CONFIG.aggregate_ha_stats.split(",") if stat.strip() != ""]
+
+# Every station shares the same field layout. keys -> index of the field in each window's array
+field_indexes = {}
+fields = []
+# (mac, window name) -> [the window number (time // seconds), array of SLOTS values per field]
+window_states = {}
+window_states_lock = threading.Lock()
+# mac -> (mac address, stationtype, send_ha_config) of the station's last payload, to publish its windows once they've ended
+stations = {}
+
+# How long after a window ends the flusher checks for it, so it's not woken up just before the window ends
+FLUSH_DELAY_SEC = 0.05
+flusher_thread = None
+flusher_lock = threading.Lock()
+# Whether flush_expired is called by the flusher thread, rather than the runtime (ex: the asyncio runtime)
+flusher_thread_enabled = True
+
+
+def is_enabled():
+    return len(windows) > 0
+
+
+def __field_index(keys):
+    """
+    Returns the index of the field, adding it if it's new. Must be called with window_states_lock held
+    """
+    index = field_indexes.get(keys)
+    if index is None:
+        index = len(fields)
+        fields.append(keys)
+        field_indexes[keys] = index
+    return index
+
+
+def add(mac_sanitized, json_payload, timestamp, mac, stationtype, send_ha_config):
+    """
+    Adds a payload to each of the station's windows. Windows that have ended are published (if flush_expired hasn't already)
+    A reading from a window that has already ended (ex: one a logger stored while offline) is left out of that window, since the window
+    has already been published (or was never started)
+    :param mac_sanitized: the station the payload is for
+    :param json_payload: the dict generated by generate_sensor_dict
+    :param timestamp: unix time of the reading
+    :param mac: MAC address of the station (used for HA discovery)
+    :param stationtype: Station Type of the station (used for HA discovery)
+    :param send_ha_config: whether to send HA discovery configs for the aggregate values
+    """
+    now = time.time()
+    finished = []
+    __ensure_flusher()
+
+    with window_states_lock:
+        stations[mac_sanitized] = (mac, stationtype, send_ha_config)
+        values = [(__field_index(keys), keys in CIRCULAR_FIELDS, float(value)) for keys, value in flatten(json_payload)
+                  if keys[0] != "station" and isinstance(value, (int, float))]
+        size = len(fields) * SLOTS
+
+        for name, seconds in windows:
+            current = int(now // seconds)
+            # A station whose clock is ahead counts towards the current window
+            number = min(int(timestamp // seconds), current)
+            state = window_states.get((mac_sanitized, name))
+            if number < (current if state is None else state[0]):
+                continue
+            if state is None:
+                state = [number, EMPTY_FIELD * len(fields)]
+                window_states[(mac_sanitized, name)] = state
+            elif state[0] != number:
+                finished.append((name, seconds, state[0], state[1]))
+                state[0] = number
+                state[1] = EMPTY_FIELD * len(fields)
+
+            totals = state[1]
+            if len(totals) < size:
+                # New fields showed up since the window started
+                totals.extend(EMPTY_FIELD * ((size - len(totals)) // SLOTS))
+
+            for index, circular, value in values:
+                slot = index * SLOTS
+                totals[slot] += 1
+                if circular:
+                    radians = math.radians(value)
+                    totals[slot + 4] += math.sin(radians)
+                    totals[slot + 5] += math.cos(radians)
+                    continue
+                totals[slot + 1] += value
+                if value < totals[slot + 2]:
+                    totals[slot + 2] = value
+                if value > totals[slot + 3]:
+                    totals[slot + 3] = value
+
+    for name, seconds, number, totals in finished:
+        __publish(mac_sanitized, name, seconds, number, totals, mac, stationtype, send_ha_config)
+
+
+def seconds_until_flush():
+    """
+    Returns how long until the next window ends (and flush_expired should be called)
+    """
+    now = time.time()
+    return min(seconds - now % seconds for _, seconds in windows) + FLUSH_DELAY_SEC
+
+
+def flush_expired():
+    """
+    Publishes the windows that have ended, so a window is published when it ends rather than with the station's next payload. Stations
+    that have stopped reporting are forgotten once their windows are published
+    """
+    now = time.time()
+    finished = []
+
+    with window_states_lock:
+        for name, seconds in windows:
+            number = int(now // seconds)
+            for mac_sanitized in list(stations):
+                state = window_states.get((mac_sanitized, name))
+                if state is not None and state[0] != number:
+                    del window_states[(mac_sanitized, name)]
+                    finished.append((mac_sanitized, name, seconds, state[0], state[1]) + stations[mac_sanitized])
+
+        for mac_sanitized in [mac_sanitized for mac_sanitized in stations if all((mac_sanitized, name) not in window_states for name, _ in windows)]:
+            del stations[mac_sanitized]
+
+    for window in finished:
+        __publish(*window)
+
+
+def disable_flusher_thread():
+    """
+    Stops the flusher thread from being started, for runtimes that call flush_expired themselves (ex: the asyncio runtime)
+    """
+    global flusher_thread_enabled
+    flusher_thread_enabled = False
+
+
+def __ensure_flusher():
+    """
+    Starts the flusher thread if it isn't running in this process (threads don't survive a fork)
+    """
+    global flusher_thread
+    if not flusher_thread_enabled or (flusher_thread is not None and flusher_thread.is_alive()):
+        return
+    with flusher_lock:
+        if flusher_thread is None or not flusher_thread.is_alive():
+            flusher_thread = threading.Thread(target=__flusher, name="aggregate-flusher", daemon=True)
+            flusher_thread.start()
+
+
+def __flusher():
+    """
+    Publishes windows as they end
+    """
+    while True:
+        time.sleep(seconds_until_flush())
+        flush_expired()
+
+
+def __publish(mac_sanitized, name, seconds, number, totals, mac, stationtype, send_ha_config):
+    """
+    Publishes a finished window
+    """
+    payload = {
+        "window": name,
+        "start": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(number * seconds)),
+        "end": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime((number + 1) * seconds)),
+    }
+    topic = "{topic}/{window}".format(topic=CONFIG.mqtt_topic_aggregate, window=name)
+
+    for index in range(len(totals) // SLOTS):
+        slot = index * SLOTS
+        count = totals[slot]
+        if count == 0:
+            continue
+
+        keys = fields[index]
+        if keys in CIRCULAR_FIELDS:
+            stats = {"avg": round(math.degrees(math.atan2(totals[slot + 4], totals[slot + 5])) % 360, CONFIG.precision)}
+        else:
+            stats = {
+                "avg": round(totals[slot + 1] / count, CONFIG.precision),
+                "min": round(totals[slot + 2], CONFIG.precision),
+                "max": round(totals[slot + 3], CONFIG.precision),
+            }
+        set_value(payload, keys[:-1], keys[-1], stats)
+        __send_ha_configs(send_ha_config, mac, stationtype, name, topic, keys, stats)
+
+    mqtt.publish("{mac}/{topic}".format(mac=mac_sanitized, topic=topic), serialize.dumps(payload))
+
+
+def __send_ha_configs(send_ha_config, mac, stationtype, name, topic, keys, stats):
+    """
+    Sends the HA config for each stat of a field, if the field is sent to HA
+    """
+    output = OUTPUTS.get(".".join(keys))
+    if output is None or output.ha is None:
+        return
+
+    ha = output.ha
+    for stat in ha_stats:
+        if stat not in stats:
+            continue
+        discovery.send_ha_sensor_config(send_ha_config, mac, stationtype, "{name} ({window} {stat})".format(name=ha.name, window=name, stat=stat),
+                                        "aggregate.{window}.{path}.{stat}".format(window=name, path=output.path, stat=stat),
+                                        "{{{{ value_json.{path}.{stat} }}}}".format(path=output.path, stat=stat),
+                                        unit_of_measurement=ha.unit_of_measurement, device_class=ha.device_class, icon=ha.icon,
+                                        state_class="measurement", state_topic=topic)
+
+
+if is_enabled():
+    logger.info("Publishing aggregates for windows: {windows}".format(windows=", ".join(name for name, seconds in windows)))
@@ -1,40 +1,30 @@
-import os
 import sys
 import logging
 import mqtt
-import json
-import fasteners
-import math
-from flask import Flask, request
+import time
+import config
+import dedup
+import history
+import aggregate
+import discovery
+import known_sensors
+import metrics
+import protocols
+import serialize
+from flask import Flask, Response, request
+from urllib.parse import unquote_plus
+from config import CONFIG
 from loguru import logger
-from mergedeep import merge
-
-
-# Set variables from env
-DEBUG = bool(int(os.getenv("DEBUG", False)))
-LISTEN_PORT = int(os.getenv("LISTEN_PORT", 8000))
-PRECISION = int(os.getenv("PRECISION", 2))
-# (default) If we should send a message to a discovery topic when a new client connects
-SEND_HA_DISCOVERY_CONFIG = bool(int(os.getenv("SEND_HA_DISCOVERY_CONFIG", True)))
-HA_DISCOVERY_PREFIX = os.getenv("HA_DISCOVERY_PREFIX", "homeassistant")
-# We watch this topic for HA coming online. When it does, we wipe the known_sensors dict so we'll re-send sensor config messages)
-HA_BIRTH_TOPIC = os.getenv("HA_BIRTH_TOPIC", "homeassistant/status")
-HA_BIRTH_TOPIC_ONLINE = os.getenv("HA_BIRTH_TOPIC_ONLINE", "online")
-# A comma separated list of mac addresses and their name. Ex: 00:00:00:00:00:00/Weather Station
-MAC_NAME_MAPPING = os.getenv("MAC_NAME_MAPPING", None)
-MQTT_TOPIC_JSON = os.getenv("MQTT_TOPIC_JSON", "sensor")  # What topic should we publish on?
-
-KNOWN_SENSORS_CACHE_FILE = os.getenv("KNOWN_SENSORS_CACHE_FILE", "known_sensors.json")
-KNOWN_SENSORS_LOCK_FILE = os.getenv("KNOWN_SENSORS_LOCK_FILE", "known_sensors.lock")
+from sensors import SENSORS, DERIVED, set_value, generate_columns
 
 
 # Logging
 log_level = "INFO"
-if DEBUG:
+if CONFIG.debug:
     log_level = "DEBUG"
 
 logger.remove()
-logger.add(sys.stderr, level=log_level)
+logger.add(sys.stderr, level=log_level, enqueue=CONFIG.log_enqueue)
 
 
 # Intercept standard logging library messages:
@@ -60,587 +50,393 @@ logging.basicConfig(handlers=[InterceptHandler()], level=0, force=True)
 
 
 # Main logic
-if os.path.isfile(KNOWN_SENSORS_CACHE_FILE):
-    logger.info("Clearing previous KNOWN_SENSORS_CACHE_FILE")
-    os.remove(KNOWN_SENSORS_CACHE_FILE)
+app = Flask(__name__)
 
-if os.path.isfile(KNOWN_SENSORS_LOCK_FILE):
-    logger.info("Clearing previous KNOWN_SENSORS_LOCK_FILE")
-    os.remove(KNOWN_SENSORS_LOCK_FILE)
+# mac -> [requests since the last summary, time.monotonic of the last summary]
+station_summaries = {}
 
-# As Flask can spawn multiple processes, we need a way to keep the known_sensors known among all threads/processes.
-# As such, I've opted for file locking for now
-known_sensors_lock = fasteners.InterProcessLock(KNOWN_SENSORS_LOCK_FILE)
-app = Flask(__name__)
-mac_names = {}
+# Arguments that identify the station rather than being a sensor
+STATION_ARGS = {"PASSKEY", "mac", "stationtype", "dateutc"}
 
-# Translate the env-set mapping to a dict
-if MAC_NAME_MAPPING is not None:
-    for mapping in MAC_NAME_MAPPING.split(","):
-        mac, name = mapping.split("/")
-        mac_names[mac] = name
+# The response to every reading
+OK_STATUS = "200 OK"
+OK_HEADERS = [("Content-Type", "text/html; charset=utf-8"), ("Content-Length", "2")]
+ERROR_STATUS = "500 INTERNAL SERVER ERROR"
+ERROR_HEADERS = [("Content-Type", "text/html; charset=utf-8"), ("Content-Length", "21")]
 
 
-def __rounded(value):
+def __send_ha_output_config(send_config, mac, stationtype, output):
     """
-    Takes a float and returns it rounded to PRECISION
+    Sends the HA config for an Output if it has HA discovery metadata
     """
-    return round(float(value), PRECISION)
+    ha = output.ha
+    if ha is None:
+        return
+    discovery.send_ha_sensor_config(send_config, mac, stationtype, ha.name, ha.uniqueid, ha.value_template,
+                                    unit_of_measurement=ha.unit_of_measurement, device_class=ha.device_class, icon=ha.icon,
+                                    state_class=ha.state_class)
 
-def __convert_battery_to_percent(value):
-    """
-    Converts the battery int value to a percentage
-    """
-    return int(value) * 100
 
-def __convert_in_to_mm(value):
+def __new_sensor_dict(args):
     """
-    Converts inches to mm
+    Returns a dict containing the station's MAC and type, along with the MAC and type to send HA configs for
     """
-    return float(value) * 25.4
+    data_dict = {}
+    mac = None
+    stationtype = "UNKNOWN"
+
+    # Parse MAC and type separately as we want these pre-set before we wend HA configs
+    if "mac" in args:
+        mac = args["mac"]
+        set_value(data_dict, ("station",), "mac", str(mac))
+    elif "PASSKEY" in args:
+        mac = args["PASSKEY"]
+        set_value(data_dict, ("station",), "mac", str(mac))
+    if "stationtype" in args:
+        stationtype = args["stationtype"]
+        set_value(data_dict, ("station",), "type", str(stationtype))
+    return data_dict, mac, stationtype
 
 
-def __convert_f_to_c(value):
+def generate_sensor_dict(args, send_ha_config=False):
     """
-    Converts farenheit to celcius
+    Generates a dict containing each value provided
     """
-    return (float(value) - 32) * 5 / 9
 
+    logger.debug("Generating a single dict containing each value provided (send_ha_config: {})", send_ha_config)
+    started = time.perf_counter()
 
-def __convert_c_to_f(value):
-    """
-    Converts celcius to farenheit
-    """
-    return (float(value) * 9 / 5) + 32
+    data_dict, mac, stationtype = __new_sensor_dict(args)
+
+    # Process each arg. If known, lets's process it
+    for key, value in args.items():
+        # loguru does some work for each call even when the level is disabled, so skip it on the hot path
+        if CONFIG.debug:
+            logger.debug("Processing argument {}:{}", key, value)
+
+        spec = SENSORS.get(key)
+        if spec is None:
+            # Either not a sensor (ex: mac, dateutc) or a sensor we don't know about
+            if key not in STATION_ARGS:
+                metrics.count_unknown_arg(key)
+            continue
+
+        for output in spec.outputs:
+            __send_ha_output_config(send_ha_config, mac, stationtype, output)
+            set_value(data_dict, output.parents, output.leaf, output.convert(value))
+
+    # Calculate values that depend on multiple arguments (ex: dew point)
+    for derived in DERIVED:
+        if not all(key in args for key in derived.inputs):
+            continue
+
+        result = derived.compute(*[args[key] for key in derived.inputs])
+        for output in derived.outputs:
+            __send_ha_output_config(send_ha_config, mac, stationtype, output)
+            set_value(data_dict, output.parents, output.leaf, output.convert(result))
+
+    metrics.GENERATE_SECONDS.observe(time.perf_counter() - started)
+    logger.debug("Done generating dict")
+    return data_dict
 
 
-def __convert_inhg_to_hpa(value):
+def generate_sensor_dicts(readings, send_ha_config=False):
     """
-    Converts inHg to hPa
+    Generates the dict of each reading, the same as generate_sensor_dict would. The values of all readings are converted at once
+    (see sensors.generate_columns), which is much faster for many readings (ex: a bulk upload)
     """
-    return float(value) * 33.86389
+    logger.debug("Generating dicts for {} readings (send_ha_config: {})", len(readings), send_ha_config)
+    started = time.perf_counter()
 
+    keys = dict.fromkeys(key for args in readings for key in args)
+    values = generate_columns({key: [args.get(key) for args in readings] for key in keys})
 
-def __convert_mph_to_kph(value):
-    """
-    Converts MPH to KPH
-    """
-    return float(value) * 1.609344
+    data_dicts = []
+    for row, args in enumerate(readings):
+        data_dict, mac, stationtype = __new_sensor_dict(args)
 
+        for key in args:
+            spec = SENSORS.get(key)
+            if spec is None:
+                if key not in STATION_ARGS:
+                    metrics.count_unknown_arg(key)
+                continue
 
-def __convert_mph_to_mps(value):
-    """
-    Converts MPH to m/s
-    """
-    return float(value) * 0.44704
+            for output in spec.outputs:
+                __send_ha_output_config(send_ha_config, mac, stationtype, output)
+                set_value(data_dict, output.parents, output.leaf, values[output.path][row])
 
+        for derived in DERIVED:
+            if not all(key in args for key in derived.inputs):
+                continue
 
-def __convert_mph_to_fps(value):
-    """
-    Converts MPH to ft/s
-    """
-    return float(value) * 1.466667
+            for output in derived.outputs:
+                value = values[output.path][row]
+                # Values that can't be calculated (ex: the dew point at 0% humidity) are left out
+                if value is not None:
+                    __send_ha_output_config(send_ha_config, mac, stationtype, output)
+                    set_value(data_dict, output.parents, output.leaf, value)
+
+        data_dicts.append(data_dict)
 
+    metrics.GENERATE_SECONDS.observe(time.perf_counter() - started)
+    logger.debug("Done generating dicts")
+    return data_dicts
 
-def __convert_mph_to_knots(value):
+
+def __publish_fields(mac_sanitized, json_payload, messages):
     """
-    Converts MPH to knots
+    Adds each value that changed since the last payload (see dedup.changed_fields) to messages, to be published to its own topic
+    (ex: 00-00-00-00-00-00/temperature/outdoor/celsius)
+    The topics are retained so subscribers get the current value of values that rarely change (ex: total rain)
     """
-    return float(value) * 0.868976
+    for keys, value in dedup.changed_fields(mac_sanitized, json_payload):
+        messages.append(("{mac}/{field}".format(mac=mac_sanitized, field="/".join(keys)), str(value), True))
 
 
-def __convert_wm2_to_lux(value):
+def __log_station_summary(mac_sanitized):
     """
-    Convert W/m^2 to lux (See https://ambientweather.com/faqs/question/view/id/1452/.)
+    Logs how many requests a station has sent, at most once per LOG_SUMMARY_INTERVAL_SEC
     """
-    return float(value) * 126.7
+    now = time.monotonic()
+    summary = station_summaries.get(mac_sanitized)
+    if summary is None:
+        logger.info("Receiving data from new station: {}", mac_sanitized)
+        station_summaries[mac_sanitized] = [0, now]
+        return
+
+    summary[0] += 1
+    if now - summary[1] >= CONFIG.log_summary_interval_sec:
+        logger.info("Received {} requests from {} in the last {:.0f}s", summary[0], mac_sanitized, now - summary[1])
+        summary[0] = 0
+        summary[1] = now
 
 
-def __calculate_dew_point_c(temp_c, humidity):
+def parse_query(query):
     """
-    Calculates the dew point (Celsius) from the temperature and relative humidity
-    :param temp_c: the temperature in celsius
-    :param humidity: the relatie humidity (%)
+    Parses a query string into a dict. As with Flask's request.args, the first value of a repeated argument is used
     """
-    A = 17.625
-    B = 243.04
-    result = ((A * temp_c) / (B + temp_c)) + math.log(humidity / 100.0)
-    return (B * result) / (A - result)
+    args = {}
+    for pair in query.split("&"):
+        if pair == "":
+            continue
+        key, _, value = pair.partition("=")
+        # Stations only escape a few values (ex: the space in dateutc), so most pairs are used as they are
+        if "%" in pair or "+" in pair:
+            key, value = unquote_plus(key), unquote_plus(value)
+        if key not in args:
+            args[key] = value
+    return args
 
 
-def __calculate_feels_like_temp(temp_f, humidity, wind_speed_mph):
+def ingest(args, messages, json_payload=None):
     """
-    Calculates the 'feels like' temperature
-    :param temp_f: the temerature in farenheit
-    :param humidity: the relatie humidity (%)
-    :param wind_speed_mph: the wind speed in mph
+    Generates the payload for a single reading from a station, adding the messages to publish to messages
+    :param args: the reading's Ambient Weather arguments (see protocols for translating other protocols)
+    :param messages: a list of (topic, payload, retain) to be passed to mqtt.publish_many
+    :param json_payload: the reading's payload if it has already been generated (ex: by generate_sensor_dicts)
     """
+    if json_payload is None:
+        json_payload = generate_sensor_dict(args, send_ha_config=CONFIG.send_ha_discovery_config)
 
-    # References:
-    # https://ambientweather.com/faqs/question/view/id/2033/
-    # https://www.wpc.ncep.noaa.gov/html/heatindex_equation.shtml
-    # https://sciencing.com/calculate-wind-chill-factor-5981683.html
-
-    # If it's cold, we use the wind chill
-    # The Ambient Weather link above has a different threshold than the sciencing.com link.
-    # As sciencing.com sounds more 'sciency', I'm starting with those thresholds for now.
-    if temp_f <= 50 and wind_speed_mph >= 3:
-        # Wind chill = 35.74 + 0.6215T – 35.75 (V^0.16) + 0.4275T (V^0.16)
-        return 35.74 + (0.6215 * temp_f) - 35.75 * (wind_speed_mph ** 0.16) + ((0.4275 * temp_f) * (wind_speed_mph ** 0.16))
+    mac_sanitized = json_payload["station"]["mac"].replace(':', '-')
+    metrics.count_station_request(mac_sanitized)
 
-    # If it's warm, use the heat index
-    # Using https://www.wpc.ncep.noaa.gov/html/heatindex_equation.shtml for this
-    if temp_f >= 80:
-        # Steadman
-        heat_index_temp = 0.5 * (temp_f + 61.0 + ((temp_f - 68.0) * 1.2) + (humidity * 0.094))
+    if CONFIG.mqtt_publish_mode != "json":
+        __publish_fields(mac_sanitized, json_payload, messages)
 
-        # Rothfusz regression
-        if heat_index_temp >= 80:
-            heat_index_temp = (
-                -42.379 + 2.04901523 * temp_f + 10.14333127 * humidity - 0.22475541 * temp_f * humidity - 0.00683783 *
-                temp_f * temp_f - 0.05481717 * humidity * humidity + 0.00122874 * temp_f * temp_f * humidity + 0.00085282 *
-                temp_f * humidity * humidity - 0.00000199 * temp_f * temp_f * humidity * humidity
-                )
-            if humidity < 13 and temp_f >= 80 and temp_f <= 112:
-                heat_index_temp = heat_index_temp - ((13 - humidity) / 4) * math.sqrt((17 - math.fabs(temp_f - 95.0)) / 17)
-            if humidity > 85 and temp_f >= 80 and temp_f <= 87:
-                heat_index_temp = heat_index_temp + ((humidity - 85) / 10) * ((87 - temp_f) / 5)
+    if CONFIG.mqtt_publish_mode != "fields" and dedup.should_publish(mac_sanitized, json_payload):
+        messages.append(("{mac}/{topic}".format(mac=mac_sanitized, topic=CONFIG.mqtt_topic_json), serialize.dumps(json_payload), False))
 
-        return heat_index_temp
+    if aggregate.is_enabled() or history.is_enabled():
+        timestamp = history.parse_dateutc(args.get("dateutc"))
 
-    # Netiher wind chill or heat index take effect. Return the current temp.
-    return float(temp_f)
+    if aggregate.is_enabled():
+        station = json_payload["station"]
+        aggregate.add(mac_sanitized, json_payload, timestamp, station["mac"], station.get("type", "UNKNOWN"), CONFIG.send_ha_discovery_config)
 
+    if history.is_enabled():
+        history.add(mac_sanitized, json_payload, timestamp)
 
-def __create_dict(elements, value):
-    """
-    Creates a dictionary from a given list of elements
-    """
-    result = dict()
-    if len(elements) > 1:
-        result[elements[0]] = __create_dict(elements[1:], value)
-    else:
-        result[elements[0]] = value
-    return result
+    __log_station_summary(mac_sanitized)
 
 
-def __translate_topic_to_dict(data, key, value):
+# Data receiver
+@app.route("/ambientweather", methods=['GET'])
+def receive():
     """
-    Takes an json path (ex: rain.total.mm) and adds it into a dict (ex: dict["rain"]["total"]["mm"])
-    :param data: the dict to update
-    :param key: the MQTT topic key (ex: rain/total/mm)
-    :param value: the value to save to the dict (ex: 12)
+    Flask endpoint for listening for requests from the local Ambient Weather weather station
+    Reference: https://ambientweather.com/faqs/question/view/id/1857/
     """
-    single_dict = __create_dict(key.split("."), value)
-    return merge(data, single_dict)
+    logger.opt(lazy=True).debug("Received request: {}", lambda: request.args.to_dict())
+
+    messages = []
+    ingest(request.args, messages)
+    mqtt.publish_many(messages)
+    return "OK"
 
 
-def send_ha_sensor_config(send_config, mac, stationtype, sensorname, uniqueid, value_template, unit_of_measurement=None,
-                          device_class=None, icon=None, state_class=None):
+# Ecowitt protocol receiver. Set the gateway's customized server path to /data/report/
+@app.route("/data/report/", methods=['POST'])
+def receive_ecowitt():
     """
-    Sends the configuration of the sensor to HA if we haven't already
-    :param mac: MAC address of the device
-    :param stationtype: Station Type of the device (usually pulled from request params)
-    :param sensorname: The name of the sensor as it should show in Home Assistant (ex: "Outdoor Temperature")
-    :param uniqueid: The unique ID to suffix behind mac
-    :param value_template: The lookup string for HA to parse the value from json (ex: "{{ value_json.temperature.outdoor.celsius }}")
-    :param unit_of_measurement: The Unit of Measurement (ex: °C)
-    :param device_class: HA device class
-    :param icon: Icon to use (to override device class)
-    :param state_class: HA state class
+    Flask endpoint for listening for uploads from stations and gateways using the Ecowitt protocol
     """
+    logger.opt(lazy=True).debug("Received Ecowitt request: {}", lambda: request.form.to_dict())
 
-    if bool(send_config) is not True:
-        return
-
-    if mac is None:
-        logger.debug("Not sending sensor config as mac is None")
-        return
+    messages = []
+    ingest(protocols.from_ecowitt(request.form.to_dict()), messages)
+    mqtt.publish_many(messages)
+    return "OK"
 
-    # The topic can't handle colons. As such, we use hyphens instead
-    # Reference: https://www.home-assistant.io/docs/mqtt/discovery/
-    mac_sanitized = mac.replace(':', '-')
-    sensor_unique_id = "{mac_sanitized}_{uniqueid_sanitized}".format(mac_sanitized=mac_sanitized, uniqueid_sanitized=uniqueid.replace(".", "-"))
 
-    if is_known_sensor(sensor_unique_id):
-        logger.debug("Already sent config for {sensor} to HA. Skipping".format(sensor=sensor_unique_id))
-        return
+# Weather Underground protocol receiver
+@app.route("/weatherstation/updateweatherstation.php", methods=['GET', 'POST'])
+def receive_wunderground():
+    """
+    Flask endpoint for listening for uploads from stations using the Weather Underground protocol
+    """
+    args = protocols.from_wunderground(request.values.to_dict())
+    logger.opt(lazy=True).debug("Received Weather Underground request: {}", lambda: args)
 
-    # If we're here, we have to send the device config to HA
-    discovery_topic = "{prefix}/sensor/{sensor_unique_id}/config".format(prefix=HA_DISCOVERY_PREFIX, sensor_unique_id=sensor_unique_id)
-
-    devicename = ""
-    if mac in mac_names:
-        devicename = mac_names[mac]
-
-    config_payload = {
-        "name": sensorname,  # Outdoor Temperatre
-        "object_id": "{devicename} - {sensorname}".format(devicename=devicename, sensorname=sensorname),
-        "unique_id": sensor_unique_id,
-        "state_topic": "{prefix}/{mac}/sensor".format(prefix=mqtt.MQTT_PREFIX, mac=mac_sanitized),
-        "value_template": value_template,
-        "device": {
-            "connections": [["mac", mac]],
-            "identifiers": [stationtype],
-            "manufacturer": "Ambient Weather",
-            "name": devicename
-        },
-        "availability": [
-            {"topic": "{prefix}/online".format(prefix=mqtt.MQTT_PREFIX)}
-        ],
-        "payload_available": "online",
-        "payload_not_available": "offline"
-    }
-
-    if unit_of_measurement is not None:
-        config_payload["unit_of_measurement"] = unit_of_measurement
-
-    if device_class is not None:
-        config_payload["device_class"] = device_class
-
-    if icon is not None:
-        config_payload["icon"] = icon
-
-    if state_class is not None:
-        config_payload["state_class"] = state_class
-
-    logger.info("Sending {sensorname} config to discovery topic for MAC: {mac}".format(sensorname=sensorname, mac=mac_sanitized))
-    mqtt.publish(discovery_topic, json.dumps(config_payload), insert_prefix=False)
-    add_known_sensor(sensor_unique_id)
-    logger.debug("Done sending {sensorname} config to HA".format(sensorname=sensorname))
+    messages = []
+    ingest(args, messages)
+    mqtt.publish_many(messages)
+    # Stations expect the same response Weather Underground sends
+    return "success"
 
 
-def generate_sensor_dict(args, send_ha_config=False):
+# Bulk receiver (ex: a logger uploading the readings it stored while offline)
+@app.route("/bulk", methods=['POST'])
+def receive_bulk():
     """
-    Generates a dict containing each value provided
+    Flask endpoint for receiving multiple readings in a single request. The body is a json list of readings, each a dict of arguments
+    The protocol the arguments use can be set with ?protocol= (ambientweather (default), ecowitt or wunderground)
     """
+    translate = protocols.TRANSLATORS.get(request.args.get("protocol", "ambientweather"))
+    if translate is None:
+        return "Unknown protocol. Expected one of: {protocols}".format(protocols=", ".join(protocols.TRANSLATORS)), 400
 
-    logger.info("Generating a single dict containing each value provided...")
-    logger.debug("send_ha_config: {send_ha_config}".format(send_ha_config=send_ha_config))
+    readings = request.get_json(silent=True)
+    if not isinstance(readings, list) or not all(isinstance(reading, dict) for reading in readings):
+        return "Expected a json list of readings", 400
 
-    data_dict = {}
-    mac = None
-    stationtype = "UNKNOWN"
+    readings = [translate({key: str(value) for key, value in reading.items()}) for reading in readings]
+    json_payloads = generate_sensor_dicts(readings, send_ha_config=CONFIG.send_ha_discovery_config)
 
-    # For use in other calculations
-    temp_c = None
-    temp_f = None
-    humidity = None
-    wind_speed_mph = None
+    # Readings are published in the order they were received with a single call so they're queued together
+    messages = []
+    for args, json_payload in zip(readings, json_payloads):
+        ingest(args, messages, json_payload)
+    mqtt.publish_many(messages)
 
-    # Parse MAC and type separately as we want these pre-set before we wend HA configs
-    if "mac" in args:
-        mac = args["mac"]
-        __translate_topic_to_dict(data_dict, "station.mac", str(mac))
-    elif "PASSKEY" in args:
-        mac = args["PASSKEY"]
-        __translate_topic_to_dict(data_dict, "station.mac", str(mac))
-    if "stationtype" in args:
-        stationtype = args["stationtype"]
-        __translate_topic_to_dict(data_dict, "station.type", str(stationtype))
-
-    # Process each arg. If known, lets's process it
-    for key, value in args.items():
-        logger.debug("Processing argument {key}:{value}".format(key=key, value=value))
-
-        # TODO - make an elegant definition for these. For now, hack it together with if statements
-
-        if key == "stationtype":
-            pass  # This was set previously outside of the loop
-        elif key == "PASSKEY" or key == "mac":
-            pass  # This was set previously outside of the loop
-        elif key == "battout":
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Outdoor Battery", "station.battery.outdoor",
-                                  "{{ value_json.station.battery.outdoor }}", unit_of_measurement="%", device_class="battery", icon="mdi:battery")
-            __translate_topic_to_dict(data_dict, "station.battery.outdoor", __convert_battery_to_percent(value))
-        elif key == "batt_co2":
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "CO2 Battery", "station.battery.co2", "{{ value_json.station.battery.co2 }}",
-                                  unit_of_measurement="%", device_class="battery", icon="mdi:battery")
-            __translate_topic_to_dict(data_dict, "station.battery.co2", __convert_battery_to_percent(value))
-        elif key == "humidityin":
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Indoor Humidity", "humidity.indoor.percentage",
-                                  "{{ value_json.humidity.indoor.percentage }}", unit_of_measurement="%", device_class="humidity")
-            __translate_topic_to_dict(data_dict, "humidity.indoor.percentage", int(value))
-        elif key == "humidity":
-            humidity = int(value)
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Outdoor Humidity", "humidity.outdoor.percentage",
-                                  "{{ value_json.humidity.outdoor.percentage }}", unit_of_measurement="%", device_class="humidity")
-            __translate_topic_to_dict(data_dict, "humidity.outdoor.percentage", humidity)
-        elif key == "tempinf":
-            # Only send once as HA supports conversion (https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes)
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Indoor Temperature", "temperature.indoor.celsius",
-                                  "{{ value_json.temperature.indoor.celsius }}", unit_of_measurement="°C", device_class="temperature")
-            __translate_topic_to_dict(data_dict, "temperature.indoor.fahrenheit", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "temperature.indoor.celsius", __rounded(__convert_f_to_c(value)))  # Convert F to C
-        elif key == "tempf":
-            temp_f = float(value)
-            temp_c = __convert_f_to_c(value)  # Convert F to C
-            # Only send once as HA supports conversion (https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes)
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Outdoor Temperature", "temperature.outdoor.celsius",
-                                  "{{ value_json.temperature.outdoor.celsius }}", unit_of_measurement="°C", device_class="temperature")
-            __translate_topic_to_dict(data_dict, "temperature.outdoor.fahrenheit", __rounded(temp_f))
-            __translate_topic_to_dict(data_dict, "temperature.outdoor.celsius", __rounded(temp_c))
-        elif key == "baromrelin":
-            # Only send once as HA supports conversion (https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes)
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Relative Pressure", "pressure.relative.mmhg",
-                                  "{{ value_json.pressure.relative.mmhg }}", unit_of_measurement="mmHg", device_class="pressure")
-            __translate_topic_to_dict(data_dict, "pressure.relative.inhg", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "pressure.relative.mmhg", __rounded(__convert_in_to_mm(value)))  # Convert inHg to mmHg
-            __translate_topic_to_dict(data_dict, "pressure.relative.hpa", __rounded(__convert_inhg_to_hpa(value)))  # Convert inHg to hPa
-        elif key == "baromabsin":
-            # Only send once as HA supports conversion (https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes)
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Absolute Pressure", "pressure.absolute.mmhg",
-                                  "{{ value_json.pressure.absolute.mmhg }}", unit_of_measurement="mmHg", device_class="pressure")
-            __translate_topic_to_dict(data_dict, "pressure.absolute.inhg", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "pressure.absolute.mmhg", __rounded(__convert_in_to_mm(value)))  # Convert inHg to mmHg
-            __translate_topic_to_dict(data_dict, "pressure.absolute.hpa", __rounded(__convert_inhg_to_hpa(value)))  # Convert inHg to hPa
-        elif key == "winddir":
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Direction", "wind.direction.degrees",
-                                  "{{ value_json.wind.direction.degrees }}", unit_of_measurement="°", icon="mdi:compass")
-            __translate_topic_to_dict(data_dict, "wind.direction.degrees", int(value))
-        elif key == "windspeedmph":
-            wind_speed_mph = float(value)
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Speed (mph)", "wind.speed.mph", "{{ value_json.wind.speed.mph }}",
-                                  unit_of_measurement="mph", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Speed (kph)", "wind.speed.kph", "{{ value_json.wind.speed.kph }}",
-                                  unit_of_measurement="kph", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Speed (m/s)", "wind.speed.mps", "{{ value_json.wind.speed.mps }}",
-                                  unit_of_measurement="m/s", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Speed (ft/s)", "wind.speed.ftps", "{{ value_json.wind.speed.ftps }}",
-                                  unit_of_measurement="ft/s", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Speed (knots)", "wind.speed.knots", "{{ value_json.wind.speed.knots }}",
-                                  unit_of_measurement="knots", icon="mdi:weather-windy")
-            __translate_topic_to_dict(data_dict, "wind.speed.mph", __rounded(wind_speed_mph))
-            __translate_topic_to_dict(data_dict, "wind.speed.kph", __rounded(__convert_mph_to_kph(value)))  # Convert mph to kph
-            __translate_topic_to_dict(data_dict, "wind.speed.mps", __rounded(__convert_mph_to_mps(value)))  # Convert mph to m/s
-            __translate_topic_to_dict(data_dict, "wind.speed.ftps", __rounded(__convert_mph_to_fps(value)))  # Convert mph to ft/s
-            __translate_topic_to_dict(data_dict, "wind.speed.knots", __rounded(__convert_mph_to_knots(value)))  # Convert mph to knots
-        elif key == "windgustmph":
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Gust (mph)", "wind.gust.mph", "{{ value_json.wind.gust.mph }}",
-                                  unit_of_measurement="mph", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Gust (kph)", "wind.gust.kph", "{{ value_json.wind.gust.kph }}",
-                                  unit_of_measurement="kph", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Gust (m/s)", "wind.gust.mps", "{{ value_json.wind.gust.mps }}",
-                                  unit_of_measurement="m/s", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Gust (ft/s)", "wind.gust.ftps", "{{ value_json.wind.gust.ftps }}",
-                                  unit_of_measurement="ft/s", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Gust (knots)", "wind.gust.knots", "{{ value_json.wind.gust.knots }}",
-                                  unit_of_measurement="knots", icon="mdi:weather-windy")
-            __translate_topic_to_dict(data_dict, "wind.gust.mph", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "wind.gust.kph", __rounded(__convert_mph_to_kph(value)))  # Convert mph to kph
-            __translate_topic_to_dict(data_dict, "wind.gust.mps", __rounded(__convert_mph_to_mps(value)))  # Convert mph to m/s
-            __translate_topic_to_dict(data_dict, "wind.gust.ftps", __rounded(__convert_mph_to_fps(value)))  # Convert mph to ft/s
-            __translate_topic_to_dict(data_dict, "wind.gust.knots", __rounded(__convert_mph_to_knots(value)))  # Convert mph to knots
-        elif key == "maxdailygust":
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Max. Daily Gust (mph)", "wind.daily.gust.mph",
-                                  "{{ value_json.wind.daily.gust.mph }}", unit_of_measurement="mph", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Max. Daily Gust (kph)", "wind.daily.gust.kph",
-                                  "{{ value_json.wind.daily.gust.kph }}", unit_of_measurement="kph", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Max. Daily Gust (m/s)", "wind.daily.gust.mps",
-                                  "{{ value_json.wind.daily.gust.mps }}", unit_of_measurement="m/s", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Max. Daily Gust (ft/s)", "wind.daily.gust.ftps",
-                                  "{{ value_json.wind.daily.gust.ftps }}", unit_of_measurement="ft/s", icon="mdi:weather-windy")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Wind Max. Daily Gust (knots)", "wind.daily.gust.knots",
-                                  "{{ value_json.wind.daily.gust.knots }}", unit_of_measurement="knots", icon="mdi:weather-windy")
-            __translate_topic_to_dict(data_dict, "wind.daily.gust.mph", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "wind.daily.gust.kph", __rounded(__convert_mph_to_kph(value)))  # Convert mph to kph
-            __translate_topic_to_dict(data_dict, "wind.daily.gust.mps", __rounded(__convert_mph_to_mps(value)))  # Convert mph to m/s
-            __translate_topic_to_dict(data_dict, "wind.daily.gust.ftps", __rounded(__convert_mph_to_fps(value)))  # Convert mph to ft/s
-            __translate_topic_to_dict(data_dict, "wind.daily.gust.knots", __rounded(__convert_mph_to_knots(value)))  # Convert mph to knots
-        elif key == "hourlyrainin":
-            # Even though you'd think hourlyrainin and dailyrainin would be similar measurements, they're not...
-            #   hourlyrainin is an hourly rate (in/h) while the others are total volume
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Hourly Rain Rate (in/h)", "rain.hourlyrate.inh",
-                                  "{{ value_json.rain.hourlyrate.inh }}", unit_of_measurement="in/h", icon="mdi:water", state_class="total")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Hourly Rain Rate (mm/h)", "rain.hourlyrate.mmh",
-                                  "{{ value_json.rain.hourlyrate.mmh }}", unit_of_measurement="mm/h", icon="mdi:water", state_class="total")
-            __translate_topic_to_dict(data_dict, "rain.hourlyrate.inh", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "rain.hourlyrate.mmh", __rounded(__convert_in_to_mm(value)))  # Convert inches/h to mm/h
-
-            # We evaluate whether it's raining using the hourly rain rate:
-            #   https://ambientweather.com/faqs/question/view/id/1454/
-            rain_status = "Not Raining"
-            if float(value) > 0:
-                # It's currently raining
-                rain_status = "Raining"
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Rain Status", "rain.currentstatus",
-                                  "{{ value_json.rain.currentstatus }}", icon="mdi:water")
-            __translate_topic_to_dict(data_dict, "rain.currentstatus", rain_status)
-        elif key == "eventrainin":
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Event Rain (in)", "rain.event.in", "{{ value_json.rain.event.in }}",
-                                  unit_of_measurement="in", icon="mdi:water", state_class="total")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Event Rain (mm)", "rain.event.mm", "{{ value_json.rain.event.mm }}",
-                                  unit_of_measurement="mm", icon="mdi:water", state_class="total")
-            __translate_topic_to_dict(data_dict, "rain.event.in", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "rain.event.mm", __rounded(__convert_in_to_mm(value)))  # Convert inches to mm
-        elif key == "dailyrainin":
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Daily Rain (in)", "rain.daily.in", "{{ value_json.rain.daily.in }}",
-                                  unit_of_measurement="in", icon="mdi:water", state_class="total")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Daily Rain (mm)", "rain.daily.mm", "{{ value_json.rain.daily.mm }}",
-                                  unit_of_measurement="mm", icon="mdi:water", state_class="total")
-            __translate_topic_to_dict(data_dict, "rain.daily.in", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "rain.daily.mm", __rounded(__convert_in_to_mm(value)))  # Convert inches to mm
-        elif key == "weeklyrainin":
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Weekly Rain (in)", "rain.weekly.in", "{{ value_json.rain.weekly.in }}",
-                                  unit_of_measurement="in", icon="mdi:water", state_class="total")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Weekly Rain (mm)", "rain.weekly.mm", "{{ value_json.rain.weekly.mm }}",
-                                  unit_of_measurement="mm", icon="mdi:water", state_class="total")
-            __translate_topic_to_dict(data_dict, "rain.weekly.in", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "rain.weekly.mm", __rounded(__convert_in_to_mm(value)))  # Convert inches to mm
-        elif key == "monthlyrainin":
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Monthly Rain (in)", "rain.monthly.in", "{{ value_json.rain.monthly.in }}",
-                                  unit_of_measurement="in", icon="mdi:water", state_class="total")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Monthly Rain (mm)", "rain.monthly.mm", "{{ value_json.rain.monthly.mm }}",
-                                  unit_of_measurement="mm", icon="mdi:water", state_class="total")
-            __translate_topic_to_dict(data_dict, "rain.monthly.in", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "rain.monthly.mm", __rounded(__convert_in_to_mm(value)))  # Convert inches to mm
-        elif key == "totalrainin":
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Total Rain (in)", "rain.total.in", "{{ value_json.rain.total.in }}",
-                                  unit_of_measurement="in", icon="mdi:water", state_class="total")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Total Rain (mm)", "rain.total.mm", "{{ value_json.rain.total.mm }}",
-                                  unit_of_measurement="mm", icon="mdi:water", state_class="total")
-            __translate_topic_to_dict(data_dict, "rain.total.in", __rounded(float(value)))
-            __translate_topic_to_dict(data_dict, "rain.total.mm", __rounded(__convert_in_to_mm(value)))  # Convert inches to mm
-        elif key == "solarradiation":
-            # HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Solar Radiation (W/m²)", "solarradiation.wm2",
-                                  "{{ value_json.solarradiation.wm2 }}", unit_of_measurement="W/m²", icon="mdi:white-balance-sunny")
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "Solar Radiation (lux)", "solarradiation.lux",
-                                  "{{ value_json.solarradiation.lux }}", unit_of_measurement="lux", icon="mdi:white-balance-sunny")
-            __translate_topic_to_dict(data_dict, "solarradiation.wm2", __rounded(float(value)))
-            # Convert W/m^2 to lux (See https://ambientweather.com/faqs/question/view/id/1452/.)
-            __translate_topic_to_dict(data_dict, "solarradiation.lux", __rounded(__convert_wm2_to_lux(value)))
-        elif key == "uv":
-            send_ha_sensor_config(send_ha_config, mac, stationtype, "UV Index", "uv.index", "{{ value_json.uv.index }}", unit_of_measurement="Index",
-                                  icon="mdi:white-balance-sunny")
-            __translate_topic_to_dict(data_dict, "uv.index", int(value))
-
-    # Calculate dew point from the temp and humidity
-    if temp_c is not None and humidity is not None:
-        dew_point_c = __calculate_dew_point_c(temp_c, humidity)
-        # Only send once as HA supports conversion (https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes)
-        send_ha_sensor_config(send_ha_config, mac, stationtype, "Dew Point Temperature", "temperature.dewpoint.celsius",
-                              "{{ value_json.temperature.dewpoint.celsius }}", unit_of_measurement="°C", device_class="temperature")
-        __translate_topic_to_dict(data_dict, "temperature.dewpoint.fahrenheit", __rounded(__convert_c_to_f(value)))  # Convert C to F
-        __translate_topic_to_dict(data_dict, "temperature.dewpoint.celsius", __rounded(dew_point_c))
-
-    # Calculate 'Feels Like' from the temp, humidity, and windspeed
-    if temp_f is not None and humidity is not None and wind_speed_mph is not None:
-        feels_like_f = __calculate_feels_like_temp(temp_f, humidity, wind_speed_mph)
-        send_ha_sensor_config(send_ha_config, mac, stationtype, "Feels Like Temperature", "temperature.feelslike.celsius",
-                              "{{ value_json.temperature.feelslike.celsius }}", unit_of_measurement="°C", device_class="temperature")
-        __translate_topic_to_dict(data_dict, "temperature.feelslike.fahrenheit", __rounded(feels_like_f))
-        __translate_topic_to_dict(data_dict, "temperature.feelslike.celsius", __rounded(__convert_f_to_c(feels_like_f)))  # Convert F to C
-
-    logger.info("Done generating dict")
-    return data_dict
+    logger.info("Received {} readings in a bulk upload", len(readings))
+    return {"readings": len(readings)}
 
 
-def __read_known_sensors_cache_file():
+# History
+@app.route("/history", methods=['GET'])
+def station_history():
     """
-    Reads the known_sensors dict from the cache file
+    Flask endpoint for returning the recent values of a station's field (requires HISTORY_DIR)
+    Arguments: mac, field (ex: temperature.outdoor.celsius), from/to (unix time, default: the last 24 hours) and
+    step (optional, seconds to average values over)
     """
-    __create_known_sensors_cache_file()
-    with open(KNOWN_SENSORS_CACHE_FILE, 'r') as f:
-        known_sensors = json.load(f)
-    return known_sensors
+    if not history.is_enabled():
+        return "History is disabled. Set HISTORY_DIR to enable it", 404
 
+    mac = request.args.get("mac")
+    field = request.args.get("field")
+    if mac is None or field is None:
+        return "mac and field are required", 400
 
-def __write_known_sensors_cache_file(known_sensors):
-    """
-    Writes the known_sensors dict to the cache file
-    """
-    with open(KNOWN_SENSORS_CACHE_FILE, 'w') as f:
-        json.dump(known_sensors, f)
+    try:
+        end = float(request.args.get("to", time.time()))
+        start = float(request.args.get("from", end - 86400))
+        step = request.args.get("step")
+        if step is not None:
+            step = float(step)
+            if step <= 0:
+                raise ValueError("step must be positive")
+    except ValueError:
+        return "from, to and step must be numbers (from/to are unix time)", 400
+
+    points = history.query(mac.replace(':', '-'), field, start, end, step)
+    if points is None:
+        return "No history for {mac} {field}".format(mac=mac, field=field), 404
+    return {"mac": mac, "field": field, "from": start, "to": end, "step": step, "points": points}
 
 
-def __create_known_sensors_cache_file():
+# Healthcheck
+@app.route("/health", methods=['GET'])
+def health():
     """
-    Initializes the KNOWN_SENSORS_CACHE_FILE if it doesn't exist
+    Flask endpoint for returning status 200
     """
-    if os.path.isfile(KNOWN_SENSORS_CACHE_FILE):
-        logger.debug("known sensors cache file already exists")
-        return
-    # We need to create the dict file
-    known_sensors = {}
-    __write_known_sensors_cache_file(known_sensors)
+    return "OK"
 
 
-def clear_known_sensors():
+# Stats
+@app.route("/stats", methods=['GET'])
+def stats():
     """
-    Clears out the known sensors dict so the config will be sent to Home Assistant next message
+    Flask endpoint for returning the MQTT publish queue stats (for this worker): the main MQTT server's and each server's by name
     """
-    global known_sensors_lock
-    logger.info("Clearing out known sensors")
-    with known_sensors_lock:
-        known_sensors = __read_known_sensors_cache_file()
-        known_sensors.clear()
-        __write_known_sensors_cache_file(known_sensors)
+    return {"mqtt": mqtt.get_stats(), "brokers": mqtt.get_broker_stats()}
 
 
-def add_known_sensor(sensor_id):
+# Prometheus metrics
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
     """
-    Adds a known sensor to the global dict
+    Flask endpoint for returning Prometheus metrics
     """
-    global known_sensors_lock
-    with known_sensors_lock:
-        known_sensors = __read_known_sensors_cache_file()
-        known_sensors[sensor_id] = True
-        __write_known_sensors_cache_file(known_sensors)
+    data, content_type = metrics.generate()
+    return Response(data, content_type=content_type)
 
 
-def is_known_sensor(sensor_id):
-    global known_sensors_lock
-    with known_sensors_lock:
-        known_sensors = __read_known_sensors_cache_file()
-        if sensor_id in known_sensors and known_sensors[sensor_id] is True:
-            return True
-    return False
-
-
-# Data receiver
-@app.route("/ambientweather", methods=['GET'])
-def receive():
+class FastPath:
     """
-    Flask endpoint for listening for requests from the local Ambient Weather weather station
-    Reference: https://ambientweather.com/faqs/question/view/id/1857/
+    A WSGI app that serves GET /ambientweather itself and hands every other request to Flask. A reading only needs the query string,
+    so this skips Flask's routing and building a Request (and its MultiDict of args). Enabled with WEB_FAST_PATH
     """
-    logger.debug("Received request")
-    logger.debug(request.args)
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
 
-    json_payload = generate_sensor_dict(request.args, send_ha_config=SEND_HA_DISCOVERY_CONFIG)
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") != "/ambientweather" or environ.get("REQUEST_METHOD") != "GET":
+            return self.wsgi_app(environ, start_response)
 
-    mac_sanitized = json_payload["station"]["mac"].replace(':', '-')
-    mqtt.publish("{mac}/{topic}".format(mac=mac_sanitized, topic=MQTT_TOPIC_JSON), json.dumps(json_payload))
+        try:
+            args = parse_query(environ.get("QUERY_STRING", ""))
+            logger.opt(lazy=True).debug("Received request: {}", lambda: args)
 
-    return "OK"
+            messages = []
+            ingest(args, messages)
+            mqtt.publish_many(messages)
+        except Exception:
+            # As Flask would
+            logger.exception("Exception on /ambientweather [GET]")
+            start_response(ERROR_STATUS, ERROR_HEADERS)
+            return [b"Internal Server Error"]
 
+        start_response(OK_STATUS, OK_HEADERS)
+        return [b"OK"]
 
-# Healthcheck
-@app.route("/health", methods=['GET'])
-def health():
-    """
-    Flask endpoint for returning status 200
-    """
-    return "OK"
+
+if CONFIG.web_fast_path:
+    app.wsgi_app = FastPath(app.wsgi_app)
 
 
-# Entrypoint
+# Entrypoint (development server). In production, gunicorn is used (see gunicorn.conf.py)
 def main():
+    config.check()
     logger.info("Starting ambient-weather-to-mqtt server")
     logger.debug("Debug is enabled")
+    known_sensors.reset()
     mqtt.connect()
 
-    app.run(host='0.0.0.0', port=LISTEN_PORT)
+    app.run(host='0.0.0.0', port=CONFIG.listen_port)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,394 @@
+import time
+import socket
+import asyncio
+import threading
+import app
+import config
+import aggregate
+import dedup
+import discovery
+import journal
+import known_sensors
+import metrics
+import mqtt
+import paho.mqtt.client as paho
+from config import CONFIG, parse_brokers
+from loguru import logger
+
+# uvloop is optional. It handles many connections with less overhead than asyncio's own event loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+# An alternative to running the Flask app with gunicorn: the receiver and the MQTT clients run on a single asyncio event loop,
+# so a reading goes from the station's connection to the MQTT server's socket without being handed between threads:
+#   python3 async_app.py
+# Only /ambientweather and /health are served
+
+
+# The largest request line and headers we accept
+MAX_HEADER_BYTES = 16384
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class AsyncBroker(mqtt.Broker):
+    """
+    An MQTT server we publish to from the event loop. paho's network loop is driven by the event loop (add_reader/add_writer)
+    rather than its own thread. Messages are published as soon as they're received, or queued until we're connected
+    """
+    def __init__(self, target, loop):
+        super().__init__(target)
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.connected = asyncio.Event()
+        # Resolved when the connection is lost
+        self.disconnected = None
+        # Whether the server accepted the connection since we last (re)connected
+        self.accepted = False
+        self.misc_task = None
+
+    def __call(self, function, *args):
+        """
+        Calls function on the event loop. paho calls the socket callbacks from the executor while connecting
+        """
+        if threading.get_ident() == self.loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    # The socket callbacks pass the file descriptor as the socket may be closed by the time they run on the event loop
+    def __on_socket_open(self, client, userdata, sock):
+        self.__call(self.loop.add_reader, sock.fileno(), client.loop_read)
+        self.__call(self.__start_misc)
+
+    def __on_socket_close(self, client, userdata, sock):
+        self.__call(self.loop.remove_reader, sock.fileno())
+
+    def __on_socket_register_write(self, client, userdata, sock):
+        self.__call(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def __on_socket_unregister_write(self, client, userdata, sock):
+        self.__call(self.loop.remove_writer, sock.fileno())
+
+    def __start_misc(self):
+        if self.misc_task is None or self.misc_task.done():
+            self.misc_task = self.loop.create_task(self.__misc())
+
+    async def __misc(self):
+        """
+        Sends keepalive pings and notices timeouts while the socket is open
+        """
+        while self.client.socket() is not None:
+            self.client.loop_misc()
+            await asyncio.sleep(1)
+
+    def __on_connect(self, client, userdata, flags, rc, properties=None):
+        logger.info("Connected to {name} ({protocol}) with result code {rc}".format(name=self.name, protocol=self.protocol_name(), rc=str(rc)))
+        # run replaces the client once it's disconnected
+        if self.fall_back(rc):
+            return
+        self.reset_aliases(properties)
+        if rc != 0:
+            return
+
+        if self.has_connected:
+            metrics.MQTT_RECONNECTS.labels(self.name).inc()
+            # Payloads and field values published while the connection was going down may not have arrived
+            dedup.forget_all()
+        self.has_connected = True
+        self.accepted = True
+        self.connected.set()
+        # Set as retain so anyone wondering if the device is online or not knows regardles of whether they were listening at the time
+        self.publish_now(CONFIG.mqtt_topic_online, "online", retain=True)
+        if self.target.ha and bool(CONFIG.send_ha_discovery_config):
+            self.subscribe(CONFIG.ha_birth_topic)
+            discovery.start_warm_start(self)
+
+        # Send anything received while we were disconnected
+        now = time.monotonic()
+        while len(self.queue) > 0 and self.is_connected():
+            topic, payload, retain, qos, queued_at = self.queue.popleft()
+            self.queue_topics.pop(topic, None)
+            info = self.publish_now(topic, payload, insert_prefix=False, retain=retain, qos=qos, expiry_sec=mqtt.expires_in(now - queued_at))
+            self.record_publish(topic, info, now - queued_at)
+        metrics.MQTT_QUEUE_DEPTH.labels(self.name).set(len(self.queue))
+
+    def __on_disconnect(self, client, userdata, rc, properties=None):
+        logger.warning("Disconnected from {name} with result code {rc}".format(name=self.name, rc=str(rc)))
+        self.connected.clear()
+        self.reset_aliases()
+        # run replaces the client if we've fallen back to MQTT 3.1.1
+        self.fall_back_on_close()
+        self.__call(self.__resolve_disconnected, rc)
+
+    def __resolve_disconnected(self, rc):
+        if self.disconnected is not None and not self.disconnected.done():
+            self.disconnected.set_result(rc)
+
+    def __on_message(self, client, userdata, msg):
+        if msg.topic == CONFIG.ha_birth_topic:
+            self.loop.create_task(on_ha_birth(msg.payload.decode("utf-8")))
+        elif msg.retain:
+            discovery.on_retained_config(msg.topic, msg.payload)
+
+    def __create_client(self):
+        """
+        Creates the client, using self.protocol
+        """
+        target = self.target
+        self.client = paho.Client(client_id=target.client_id, protocol=self.protocol)
+        self.client.will_set("{prefix}/{topic}".format(prefix=target.prefix, topic=CONFIG.mqtt_topic_online), "offline", retain=True)
+        self.client.on_connect = self.__on_connect
+        self.client.on_disconnect = self.__on_disconnect
+        self.client.on_message = self.__on_message
+        self.client.on_socket_open = self.__on_socket_open
+        self.client.on_socket_close = self.__on_socket_close
+        self.client.on_socket_register_write = self.__on_socket_register_write
+        self.client.on_socket_unregister_write = self.__on_socket_unregister_write
+        if target.username is not None or target.password is not None:
+            self.client.username_pw_set(target.username, target.password)
+        self.client.max_inflight_messages_set(CONFIG.mqtt_max_inflight)
+        self.client.max_queued_messages_set(CONFIG.mqtt_queue_size)
+
+    async def run(self):
+        """
+        Connects to the MQTT server, reconnecting (with a backoff) whenever the connection is lost
+        """
+        target = self.target
+        self.__create_client()
+        client_protocol = self.protocol
+
+        delay = CONFIG.mqtt_reconnect_min_sec
+        first = True
+        while True:
+            self.disconnected = self.loop.create_future()
+            self.accepted = False
+            if client_protocol != self.protocol:
+                # Fell back to MQTT 3.1.1. A client can't change its protocol, so connect with a new one
+                self.__create_client()
+                client_protocol = self.protocol
+                first = True
+            try:
+                # Opening the socket (and looking up the host) blocks, so it's the one step done off the event loop
+                if first:
+                    await self.loop.run_in_executor(None, self.client.connect, target.host, target.port, CONFIG.mqtt_keepalive_sec)
+                else:
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                first = False
+            except OSError as e:
+                logger.warning("Couldn't connect to {name} ({error}). Retrying in {delay}s".format(name=self.name, error=e, delay=delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, CONFIG.mqtt_reconnect_max_sec)
+                continue
+
+            await self.disconnected
+            if self.accepted:
+                delay = CONFIG.mqtt_reconnect_min_sec
+            logger.info("Reconnecting to {name} in {delay}s".format(name=self.name, delay=delay))
+            await asyncio.sleep(delay)
+            if not self.accepted:
+                delay = min(delay * 2, CONFIG.mqtt_reconnect_max_sec)
+
+    def publish_many(self, messages, insert_prefix=True, qos=None):
+        """
+        Publishes messages straight away if we're connected, otherwise queues them until we are. With MQTT_QUEUE_OVERFLOW=coalesce, a
+        queued message is replaced by a newer one for the same topic
+        """
+        if qos is None:
+            qos = self.target.qos
+
+        for topic, payload, retain in self.prepare(messages, insert_prefix):
+            self.stats["queued"] += 1
+            if len(self.queue) == 0 and self.is_connected():
+                self.record_publish(topic, self.publish_now(topic, payload, insert_prefix=False, retain=retain, qos=qos,
+                                                            expiry_sec=mqtt.expires_in(0.0)), 0.0)
+                continue
+
+            if CONFIG.mqtt_queue_overflow == "coalesce":
+                waiting = self.queue_topics.get(topic)
+                if waiting is not None:
+                    # Replace the payload but keep its place in the queue
+                    waiting[1] = payload
+                    waiting[2] = retain
+                    waiting[3] = qos
+                    self.stats["coalesced"] += 1
+                    metrics.MQTT_MESSAGES.labels("coalesced", self.name).inc()
+                    continue
+
+            if len(self.queue) >= CONFIG.mqtt_queue_size:
+                dropped = self.queue.popleft()
+                self.queue_topics.pop(dropped[0], None)
+                self.stats["dropped"] += 1
+                metrics.MQTT_MESSAGES.labels("dropped", self.name).inc()
+                logger.warning("Publish queue for {name} is full. Dropped message to {topic}".format(name=self.name, topic=dropped[0]))
+                self.forget_published(dropped[0])
+            message = [topic, payload, retain, qos, time.monotonic()]
+            self.queue.append(message)
+            if CONFIG.mqtt_queue_overflow == "coalesce":
+                self.queue_topics[topic] = message
+            metrics.MQTT_QUEUE_DEPTH.labels(self.name).set(len(self.queue))
+        return True
+
+
+async def on_ha_birth(payload):
+    """
+    Handles a message on HA_BIRTH_TOPIC
+    """
+    logger.debug("Received HA_BIRTH_TOPIC message")
+    if payload == CONFIG.ha_birth_topic_online:
+        logger.info("We have a home assistant online message, we're re-sending all sensor configs")
+        discovery.republish_all()
+
+
+async def discovery_publisher(configs):
+    """
+    Sends queued SensorConfigs and DeviceConfigs to HA, limited to HA_DISCOVERY_RATE messages per second
+    """
+    interval = 0
+    if CONFIG.ha_discovery_rate > 0:
+        interval = 1 / CONFIG.ha_discovery_rate
+
+    while True:
+        config = await configs.get()
+        if isinstance(config, discovery.DeviceConfig):
+            await asyncio.sleep(max(0.0, config.ready_at - time.monotonic()))
+        # Configs queued while we're still connecting would be dropped by the MQTT client, so hold on to them
+        await mqtt.primary.connected.wait()
+        while not discovery.warm_started.is_set():
+            await asyncio.sleep(0.1)
+        for topic, payload, retain in discovery.build_messages(config):
+            with metrics.DISCOVERY_PUBLISH_SECONDS.time():
+                mqtt.publish_now(topic, payload, insert_prefix=False, retain=retain, qos=CONFIG.ha_discovery_qos)
+            if interval > 0:
+                await asyncio.sleep(interval)
+
+
+async def aggregate_flusher():
+    """
+    Publishes aggregate windows as they end
+    """
+    while True:
+        await asyncio.sleep(aggregate.seconds_until_flush())
+        aggregate.flush_expired()
+
+
+def handle_request(method, target):
+    """
+    Handles a single request
+    :return: the status code and body
+    """
+    path, _, query = target.partition("?")
+    if path == "/health":
+        return 200, b"OK"
+
+    if path != "/ambientweather":
+        return 404, b"Not Found"
+    if method != "GET":
+        return 405, b"Method Not Allowed"
+
+    args = app.parse_query(query)
+    logger.opt(lazy=True).debug("Received request: {}", lambda: args)
+
+    messages = []
+    app.ingest(args, messages)
+    mqtt.publish_many(messages)
+    return 200, b"OK"
+
+
+async def handle_connection(reader, writer):
+    """
+    Serves the requests of a single connection, keeping it open between requests unless the client asks us not to
+    """
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), CONFIG.web_keepalive_sec)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                return
+
+            lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, version = lines[0].split(" ")
+            except ValueError:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            # We don't use request bodies, but they have to be read to get to the next request
+            length = headers.get("content-length", "") or "0"
+            if not (length.isascii() and length.isdigit()):
+                writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            length = int(length)
+            if length > 0:
+                await reader.readexactly(length)
+
+            try:
+                status, body = handle_request(method, target)
+            except Exception:
+                logger.exception("Failed to handle {method} {target}".format(method=method, target=target))
+                status, body = 500, b"Internal Server Error"
+
+            keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+            writer.write("HTTP/1.1 {status} {text}\r\nContent-Type: text/plain\r\nContent-Length: {length}\r\n{connection}\r\n".format(
+                status=status, text=STATUS_TEXT[status], length=len(body),
+                connection="" if keep_alive else "Connection: close\r\n").encode("latin-1") + body)
+            if writer.transport.get_write_buffer_size() > 0:
+                await writer.drain()
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve():
+    """
+    Connects to the MQTT servers and serves requests until cancelled
+    """
+    loop = asyncio.get_running_loop()
+
+    # Everything that publishes (ex: aggregates) goes through mqtt.publish_many, so swapping the servers moves it onto the event loop
+    mqtt.brokers = [AsyncBroker(target, loop) for target in parse_brokers(CONFIG)[0]]
+    mqtt.primary = mqtt.brokers[0]
+    for broker in mqtt.brokers:
+        loop.create_task(broker.run())
+
+    configs = asyncio.Queue()
+    discovery.set_publisher(configs.put_nowait)
+    loop.create_task(discovery_publisher(configs))
+
+    if aggregate.is_enabled():
+        aggregate.disable_flusher_thread()
+        loop.create_task(aggregate_flusher())
+
+    server = await asyncio.start_server(handle_connection, "0.0.0.0", CONFIG.listen_port, limit=MAX_HEADER_BYTES, reuse_address=True,
+                                        backlog=socket.SOMAXCONN)
+    logger.info("Listening on port {port}".format(port=CONFIG.listen_port))
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    config.check()
+    logger.info("Starting ambient-weather-to-mqtt server (asyncio)")
+    if journal.is_enabled():
+        logger.warning("MQTT_JOURNAL_FILE isn't supported by the asyncio runtime. Messages are only queued in memory (up to MQTT_QUEUE_SIZE) "
+                       "while the MQTT server is unavailable")
+    logger.debug("Debug is enabled")
+    known_sensors.reset()
+
+    if uvloop is not None:
+        uvloop.install()
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
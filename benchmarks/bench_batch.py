@@ -0,0 +1,97 @@
+"""
+Checks sensors.generate_columns produces exactly the same values as the per-reading conversions over a dense grid of readings,
+and compares how long each takes:
+
+    python benchmarks/bench_batch.py
+
+Exits with a non-zero status if any value differs.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensors import SENSORS, DERIVED, generate_columns  # noqa: E402
+
+
+def build_grid(temp_step):
+    """
+    Returns columns covering every temperature (-40°F to 120°F) and humidity (1% to 100%) combination, with wind speeds cycling from
+    0 to 40 mph so wind chill, heat index (and both of its adjustments) and neither are all covered
+    """
+    columns = {"tempf": [], "humidity": [], "windspeedmph": [], "baromrelin": [], "hourlyrainin": [], "solarradiation": []}
+    steps = int(round(160 / temp_step))
+    row = 0
+    for temp_index in range(steps + 1):
+        tempf = "{:.1f}".format(-40 + temp_index * temp_step)
+        for humidity in range(1, 101):
+            columns["tempf"].append(tempf)
+            columns["humidity"].append(str(humidity))
+            columns["windspeedmph"].append("{:.1f}".format((row % 401) / 10))
+            columns["baromrelin"].append("{:.2f}".format(28 + (row % 300) / 100))
+            columns["hourlyrainin"].append("{:.3f}".format((row % 1000) / 1000))
+            columns["solarradiation"].append("{:.2f}".format((row % 120000) / 100))
+            row += 1
+    return columns
+
+
+def generate_scalar(columns):
+    """
+    Converts each reading one at a time, the same way generate_sensor_dict does
+    """
+    results = {}
+    rows = len(next(iter(columns.values())))
+    for row in range(rows):
+        args = {key: values[row] for key, values in columns.items()}
+        for key, value in args.items():
+            for output in SENSORS[key].outputs:
+                results.setdefault(output.path, []).append(output.convert(value))
+        for derived in DERIVED:
+            result = derived.compute(*[args[key] for key in derived.inputs])
+            for output in derived.outputs:
+                results.setdefault(output.path, []).append(output.convert(result))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--temp-step", type=float, default=0.1, help="°F between each temperature in the grid")
+    args = parser.parse_args()
+
+    columns = build_grid(args.temp_step)
+    rows = len(columns["tempf"])
+
+    started = time.perf_counter()
+    scalar = generate_scalar(columns)
+    scalar_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batch = generate_columns(columns)
+    batch_elapsed = time.perf_counter() - started
+
+    mismatches = 0
+    for path, expected in scalar.items():
+        actual = batch.get(path)
+        if actual is None:
+            print("{path}: missing from generate_columns".format(path=path))
+            mismatches += 1
+            continue
+        for row, (expected_value, actual_value) in enumerate(zip(expected, actual)):
+            if type(expected_value) is not type(actual_value) or expected_value != actual_value:
+                mismatches += 1
+                if mismatches <= 20:
+                    print("{path} row {row} ({inputs}): expected {expected!r}, got {actual!r}".format(
+                        path=path, row=row, inputs={key: values[row] for key, values in columns.items()}, expected=expected_value,
+                        actual=actual_value))
+
+    print("{rows} readings, {paths} values each".format(rows=rows, paths=len(scalar)))
+    print("scalar: {elapsed:.3f}s ({per_row:.2f}us per reading)".format(elapsed=scalar_elapsed, per_row=scalar_elapsed / rows * 1e6))
+    print("batch:  {elapsed:.3f}s ({per_row:.2f}us per reading)".format(elapsed=batch_elapsed, per_row=batch_elapsed / rows * 1e6))
+    print("mismatches: {mismatches}".format(mismatches=mismatches))
+    sys.exit(1 if mismatches > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Benchmarks the /ambientweather ingest path.
+
+Replays recorded station query strings through generate_sensor_dict and through the Flask test client, publishing to an
+in-process stub MQTT client. The encode target times serializing each payload's json on its own. The wsgi and fastpath targets
+call the Flask WSGI app and app.FastPath directly with the same environ, so the difference between them is the overhead the
+fast path removes (reported as fastpath_saved_us). Writes a JSON report that can be compared across commits:
+
+    python benchmarks/bench_ingest.py --output before.json
+    python benchmarks/bench_ingest.py --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from urllib.parse import parse_qsl
+from werkzeug.test import EnvironBuilder
+
+# The app reads its config from env at import time
+os.environ.setdefault("MQTT_HOST", "localhost")
+os.environ.setdefault("MQTT_PORT", "1883")
+# Send discovery configs as fast as possible so they don't pile up in the queue
+os.environ.setdefault("HA_DISCOVERY_RATE", "0")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mqtt  # noqa: E402
+import app  # noqa: E402
+import discovery  # noqa: E402
+import known_sensors  # noqa: E402
+import serialize  # noqa: E402
+from config import CONFIG  # noqa: E402
+from loguru import logger  # noqa: E402
+from paho.mqtt.client import MQTTMessageInfo  # noqa: E402
+from payloads import PAYLOADS  # noqa: E402
+
+
+class StubClient:
+    """
+    Stands in for the paho client. Counts what would have been sent to the MQTT server
+    """
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.messages += 1
+        self.bytes += len(topic) + len(payload if payload is not None else b"")
+        info = MQTTMessageInfo(self.messages)
+        info._set_as_published()
+        return info
+
+    def is_connected(self):
+        return True
+
+
+def __reset_caches():
+    """
+    Forgets every known sensor and prebuilt config (ie: a cold start)
+    """
+    known_sensors.reset()
+    with discovery.sensor_configs_lock:
+        discovery.sensor_configs.clear()
+        discovery.station_fragments.clear()
+
+
+def __wait_for_queues():
+    """
+    Waits for the background publishers to drain so one scenario doesn't bleed into the next
+    """
+    while not discovery.publish_queue.empty() or mqtt.get_stats()["queue_depth"] > 0:
+        time.sleep(0.01)
+
+
+def __start_response(status, headers, exc_info=None):
+    pass
+
+
+def __make_runner(target, query, send_ha_config):
+    """
+    Returns a function that ingests the query once
+    """
+    if target == "generate":
+        args = dict(parse_qsl(query))
+        return lambda: app.generate_sensor_dict(args, send_ha_config=send_ha_config)
+
+    if target == "encode":
+        json_payload = app.generate_sensor_dict(dict(parse_qsl(query)))
+        return lambda: serialize.dumps(json_payload)
+
+    CONFIG.send_ha_discovery_config = send_ha_config
+    if target in ("wsgi", "fastpath"):
+        environ = EnvironBuilder(path="/ambientweather", query_string=query).get_environ()
+        wsgi_app = app.app.wsgi_app
+        if target == "fastpath":
+            wsgi_app = app.FastPath(wsgi_app)
+        elif isinstance(wsgi_app, app.FastPath):
+            wsgi_app = wsgi_app.wsgi_app
+        return lambda: b"".join(wsgi_app(dict(environ), __start_response))
+
+    client = app.app.test_client()
+    url = "/ambientweather?" + query
+    return lambda: client.get(url)
+
+
+def run_scenario(target, payload, send_ha_config, cache, iterations, warmup):
+    """
+    Runs a single scenario and returns its results
+    """
+    run = __make_runner(target, PAYLOADS[payload], send_ha_config)
+    cold = cache == "cold"
+
+    __reset_caches()
+    for _ in range(warmup):
+        if cold:
+            __reset_caches()
+        run()
+    __wait_for_queues()
+
+    stub = mqtt.primary.client
+    messages, sent_bytes = stub.messages, stub.bytes
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        if cold:
+            __reset_caches()
+        request_started = time.perf_counter_ns()
+        run()
+        latencies.append(time.perf_counter_ns() - request_started)
+    elapsed = time.perf_counter() - started
+    __wait_for_queues()
+    messages, sent_bytes = stub.messages - messages, stub.bytes - sent_bytes
+
+    # Allocations are measured in a separate pass as tracing slows everything down
+    alloc_iterations = max(1, iterations // 10)
+    tracemalloc.start()
+    peaks = []
+    for _ in range(alloc_iterations):
+        if cold:
+            __reset_caches()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        run()
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    __wait_for_queues()
+
+    latencies.sort()
+    return {
+        "target": target,
+        "payload": payload,
+        "ha_discovery": send_ha_config,
+        "cache": cache,
+        "iterations": iterations,
+        "req_per_sec": round(iterations / elapsed, 1),
+        "mean_us": round(statistics.mean(latencies) / 1000, 2),
+        "p50_us": round(latencies[len(latencies) // 2] / 1000, 2),
+        "p99_us": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] / 1000, 2),
+        "alloc_peak_bytes": int(statistics.median(peaks)),
+        "mqtt_messages_per_req": round(messages / iterations, 2),
+        "mqtt_bytes_per_req": round(sent_bytes / iterations, 1),
+        "json_payload_bytes": len(serialize.dumps(app.generate_sensor_dict(dict(parse_qsl(PAYLOADS[payload]))))),
+    }
+
+
+def __git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def __scenario_key(result):
+    return (result["target"], result["payload"], result["ha_discovery"], result["cache"])
+
+
+def compare(results, baseline_file):
+    """
+    Prints the change of each scenario against a previous report
+    """
+    with open(baseline_file) as f:
+        baseline = {__scenario_key(result): result for result in json.load(f)["results"]}
+
+    print("{:<10} {:<14} {:<5} {:<5} {:>12} {:>12} {:>12}".format("target", "payload", "ha", "cache", "req/s", "p50", "p99"))
+    for result in results:
+        before = baseline.get(__scenario_key(result))
+        if before is None:
+            continue
+        print("{:<10} {:<14} {:<5} {:<5} {:>+11.1f}% {:>+11.1f}% {:>+11.1f}%".format(
+            result["target"], result["payload"], str(result["ha_discovery"]), result["cache"],
+            (result["req_per_sec"] / before["req_per_sec"] - 1) * 100,
+            (result["p50_us"] / before["p50_us"] - 1) * 100,
+            (result["p99_us"] / before["p99_us"] - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=1000, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=200, help="requests to run before measuring each scenario")
+    parser.add_argument("--targets", default="generate,encode,http,wsgi,fastpath", help="comma separated: generate, encode, http, wsgi, "
+                        "fastpath")
+    parser.add_argument("--payloads", default=",".join(PAYLOADS), help="comma separated: " + ", ".join(PAYLOADS))
+    parser.add_argument("--log-level", default="INFO", help="log level to benchmark with (logs are written to /dev/null)")
+    parser.add_argument("--output", help="file to write the JSON report to (default: stdout)")
+    parser.add_argument("--compare", help="a previous JSON report to compare against")
+    args = parser.parse_args()
+
+    # Logging is part of the cost of a request, but we don't want it on the terminal
+    logger.remove()
+    logger.add(open(os.devnull, "w"), level=args.log_level)
+
+    mqtt.primary.client = StubClient()
+
+    results = []
+    for target in args.targets.split(","):
+        for payload in args.payloads.split(","):
+            # Encoding doesn't depend on discovery or the known-sensors cache
+            scenarios = ((False, "warm"),) if target == "encode" else ((False, "warm"), (True, "warm"), (True, "cold"))
+            for send_ha_config, cache in scenarios:
+                result = run_scenario(target, payload, send_ha_config, cache, args.iterations, args.warmup)
+                print("{target:<10} {payload:<14} ha={ha_discovery!s:<5} {cache:<5} {req_per_sec:>10} req/s  p50 {p50_us}us  "
+                      "p99 {p99_us}us".format(**result), file=sys.stderr)
+                results.append(result)
+
+    # The fast path's saving is the difference from the same scenario through Flask
+    flask_results = {__scenario_key(result)[1:]: result for result in results if result["target"] == "wsgi"}
+    for result in results:
+        flask_result = flask_results.get(__scenario_key(result)[1:])
+        if result["target"] != "fastpath" or flask_result is None:
+            continue
+        result["fastpath_saved_us"] = round(flask_result["mean_us"] - result["mean_us"], 2)
+        print("fastpath   {payload:<14} ha={ha_discovery!s:<5} {cache:<5} saves {fastpath_saved_us}us per request".format(**result),
+              file=sys.stderr)
+
+    report = {
+        "meta": {
+            "commit": __git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "iterations": args.iterations,
+            "log_level": args.log_level,
+            "json_encoder": serialize.ENCODER,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Measures how long the app takes to start: how long importing it takes, and how long until /health responds when started with
+`python app.py`. The MQTT server is pointed at a closed port, so this also checks we listen without waiting on the MQTT connection:
+
+    python benchmarks/bench_startup.py --budget-ms 1500
+
+Exits with a non-zero status if the median time until /health responds is over --budget-ms.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def free_port():
+    """
+    Returns a port nothing is listening on
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def environment():
+    env = dict(os.environ)
+    env["MQTT_HOST"] = "127.0.0.1"
+    env["MQTT_PORT"] = str(free_port())
+    env["LISTEN_PORT"] = str(free_port())
+    return env
+
+
+def measure_import():
+    """
+    Returns how long (in seconds) a fresh interpreter takes to import the app
+    """
+    code = "import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=environment(), check=True, capture_output=True, text=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def measure_health(timeout):
+    """
+    Returns how long (in seconds) from starting the app until /health responds
+    """
+    env = environment()
+    url = "http://127.0.0.1:{port}/health".format(port=env["LISTEN_PORT"])
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "app.py"], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError("app.py exited with status {status}".format(status=process.returncode))
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError("/health didn't respond within {timeout}s".format(timeout=timeout))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="times to start the app")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for /health to respond")
+    parser.add_argument("--budget-ms", type=float, help="fail if the median time until /health responds is over this")
+    args = parser.parse_args()
+
+    imports = [measure_import() * 1000 for _ in range(args.runs)]
+    healths = [measure_health(args.timeout) * 1000 for _ in range(args.runs)]
+
+    print("import:  median {median:.0f}ms, max {max:.0f}ms".format(median=statistics.median(imports), max=max(imports)))
+    print("/health: median {median:.0f}ms, max {max:.0f}ms".format(median=statistics.median(healths), max=max(healths)))
+
+    if args.budget_ms is not None and statistics.median(healths) > args.budget_ms:
+        print("Over the budget of {budget:.0f}ms".format(budget=args.budget_ms))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
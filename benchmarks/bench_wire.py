@@ -0,0 +1,156 @@
+"""
+Measures how many bytes publishing readings puts on the wire with MQTT 3.1.1 and with MQTT 5 (topic aliases), through a proxy
+that counts what's sent to a local MQTT server:
+
+    python benchmarks/bench_wire.py --port 1883 --publish-mode fields
+
+The server has to support MQTT 5 (and grant topic aliases) for the MQTT 5 run to differ. One that doesn't is reconnected to with
+3.1.1, which is reported as the protocol used.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+
+# The app reads its config from env at import time
+os.environ.setdefault("MQTT_HOST", "localhost")
+os.environ.setdefault("MQTT_PORT", "1883")
+os.environ.setdefault("SEND_HA_DISCOVERY_CONFIG", "0")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mqtt  # noqa: E402
+import app  # noqa: E402
+import dedup  # noqa: E402
+from config import CONFIG, BrokerTarget  # noqa: E402
+from loguru import logger  # noqa: E402
+from payloads import PAYLOADS  # noqa: E402
+
+
+class CountingProxy:
+    """
+    Forwards connections to the MQTT server, counting the bytes sent to it
+    """
+    def __init__(self, host, port):
+        self.target = (host, port)
+        self.sent = 0
+        self.lock = threading.Lock()
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def __accept(self):
+        while True:
+            client, _ = self.server.accept()
+            upstream = socket.create_connection(self.target)
+            threading.Thread(target=self.__forward, args=(client, upstream, True), daemon=True).start()
+            threading.Thread(target=self.__forward, args=(upstream, client, False), daemon=True).start()
+
+    def __forward(self, source, destination, count):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if count:
+                    with self.lock:
+                        self.sent += len(data)
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            source.close()
+            destination.close()
+
+
+def readings(payload, count):
+    """
+    Returns count readings based on the recorded payload. Each value changes every reading so MQTT_PUBLISH_MODE=fields publishes them all
+    """
+    base = app.parse_query(PAYLOADS[payload])
+    result = []
+    for index in range(count):
+        args = dict(base)
+        for key, value in base.items():
+            # Only decimal values, as some (ex: batteries) must be whole numbers
+            if key not in app.STATION_ARGS and "." in value:
+                args[key] = "{:.3f}".format(float(value) + index / 1000)
+        result.append(args)
+    return result
+
+
+def measure(proxy, protocol, args_list):
+    """
+    Publishes the readings with the given MQTT protocol version
+    :return: the bytes sent, messages sent, the protocol used and the topic aliases used
+    """
+    CONFIG.mqtt_protocol = protocol
+    dedup.forget_all()
+    broker = mqtt.Broker(BrokerTarget("bench", "127.0.0.1", proxy.port, None, None, CONFIG.mqtt_prefix, "bench-wire-" + protocol, 0, None,
+                                      False))
+    broker.connect()
+    started = time.monotonic()
+    while not broker.is_connected():
+        if time.monotonic() - started > 10:
+            raise RuntimeError("Couldn't connect to the MQTT server")
+        time.sleep(0.05)
+    # Leave out connecting (and the online message)
+    time.sleep(0.2)
+    with proxy.lock:
+        sent_before = proxy.sent
+
+    messages = 0
+    for args in args_list:
+        batch = []
+        app.ingest(args, batch)
+        messages += len(batch)
+        broker.publish_many(batch)
+        # One reading at a time, as a station sends them
+        while broker.get_stats()["queue_depth"] > 0:
+            time.sleep(0.001)
+    # Give the client's network thread time to write everything out
+    time.sleep(0.5)
+
+    with proxy.lock:
+        sent = proxy.sent - sent_before
+    stats = broker.get_stats()
+    broker.client.disconnect()
+    broker.client.loop_stop()
+    return sent, messages, stats["protocol"], stats["topic_aliases"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="the MQTT server")
+    parser.add_argument("--port", type=int, default=1883, help="the MQTT server's port")
+    parser.add_argument("--v311-port", type=int, help="the port of an MQTT server to use for the MQTT 3.1.1 run, if the one at --port only "
+                        "supports MQTT 5 (default: --port)")
+    parser.add_argument("--readings", type=int, default=200, help="readings to publish")
+    parser.add_argument("--payload", default="ws2902", help="one of: " + ", ".join(PAYLOADS))
+    parser.add_argument("--publish-mode", default="json", help="MQTT_PUBLISH_MODE to publish with: json, fields or both")
+    parser.add_argument("--topic-aliases", type=int, default=CONFIG.mqtt_topic_aliases, help="MQTT_TOPIC_ALIASES to publish with")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    CONFIG.mqtt_publish_mode = args.publish_mode
+    CONFIG.mqtt_topic_aliases = args.topic_aliases
+
+    proxies = {"3.1.1": CountingProxy(args.host, args.v311_port or args.port), "5": CountingProxy(args.host, args.port)}
+    args_list = readings(args.payload, args.readings)
+    results = {}
+    for protocol in ("3.1.1", "5"):
+        sent, messages, used, aliases = measure(proxies[protocol], protocol, args_list)
+        results[protocol] = sent
+        print("MQTT {protocol:<5} (used {used:<5}) {messages} messages, {sent} bytes, {per:.1f} bytes/message, {aliases} topic aliases".format(
+            protocol=protocol, used=used, messages=messages, sent=sent, per=sent / max(1, messages), aliases=aliases))
+
+    print("MQTT 5 sent {change:+.1f}% bytes".format(change=(results["5"] / results["3.1.1"] - 1) * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# Query strings recorded from Ambient Weather stations (MAC addresses/passkeys anonymized)
+PAYLOADS = {
+    # WS-2902C with the outdoor array and indoor console
+    "ws2902": (
+        "PASSKEY=00:00:00:00:00:01&stationtype=AMBWeatherV4.3.3&dateutc=2022-10-29+03:53:24&tempinf=68.5&battout=1&batt_co2=1"
+        "&humidityin=61&baromrelin=29.741&baromabsin=29.842&tempf=55.8&humidity=96&winddir=127&windspeedmph=0.0&windgustmph=0.0"
+        "&maxdailygust=6.9&hourlyrainin=0.000&eventrainin=0.323&dailyrainin=0.323&weeklyrainin=0.323&monthlyrainin=0.323"
+        "&totalrainin=0.681&solarradiation=2.97&uv=0"
+    ),
+    # WS-5000 ultrasonic array with a WH31 on channel 1
+    "ws5000": (
+        "PASSKEY=00:00:00:00:00:02&stationtype=AMBWeatherPro_V5.0.6&dateutc=2023-06-14+17:21:46&tempf=84.2&humidity=48"
+        "&windspeedmph=4.92&windgustmph=8.05&maxdailygust=14.99&winddir=212&winddir_avg10m=205&windspdmph_avg10m=3.8&uv=7"
+        "&solarradiation=812.44&hourlyrainin=0.000&eventrainin=0.000&dailyrainin=0.000&weeklyrainin=0.126&monthlyrainin=0.870"
+        "&yearlyrainin=14.358&totalrainin=14.358&battout=1&battrain=1&tempinf=73.6&humidityin=41&baromrelin=29.912"
+        "&baromabsin=29.203&battin=1&temp1f=71.4&humidity1=44&batt1=1"
+    ),
+    # WS-5000 with a full set of add-on sensors
+    "ws5000-extras": (
+        "PASSKEY=00:00:00:00:00:03&stationtype=AMBWeatherPro_V5.0.6&dateutc=2023-06-14+17:21:46&tempf=84.2&humidity=48"
+        "&windspeedmph=4.92&windgustmph=8.05&maxdailygust=14.99&winddir=212&winddir_avg10m=205&windspdmph_avg10m=3.8&uv=7"
+        "&solarradiation=812.44&hourlyrainin=0.012&eventrainin=0.040&dailyrainin=0.040&weeklyrainin=0.126&monthlyrainin=0.870"
+        "&yearlyrainin=14.358&totalrainin=14.358&battout=1&battrain=1&tempinf=73.6&humidityin=41&baromrelin=29.912"
+        "&baromabsin=29.203&battin=1"
+        "&temp1f=71.4&humidity1=44&batt1=1&temp2f=68.0&humidity2=52&batt2=1&temp3f=39.2&humidity3=30&batt3=1"
+        "&temp4f=-2.5&humidity4=61&batt4=0&temp5f=77.1&humidity5=55&batt5=1&temp6f=70.3&humidity6=40&batt6=1"
+        "&temp7f=65.9&humidity7=58&batt7=1&temp8f=82.4&humidity8=37&batt8=1"
+        "&soilhum1=34&soilhum2=41&soilhum3=27&soilhum4=55&leak1=0&leak2=0&leak3=2&leak4=1"
+        "&pm25=8.4&pm25_24h=6.9&pm25_in=3.1&pm25_in_24h=2.8&batt_25=1&co2=612&lightning_day=3&lightning_distance=8.7"
+    ),
+}
@@ -0,0 +1,306 @@
+import os
+import sys
+from collections import namedtuple
+from dataclasses import dataclass, fields
+from typing import Optional
+from urllib.parse import urlsplit, unquote
+from loguru import logger
+
+
+@dataclass
+class Config:
+    """
+    Every setting, loaded once from the environment variable of the same name in upper case (ex: mqtt_host is MQTT_HOST)
+    See the README for what each setting does
+    """
+    # General
+    debug: bool = False
+    listen_port: int = 8000
+    # The number of decimal places values are rounded to
+    precision: int = 2
+    # Write logs from a background thread so requests never wait on stderr
+    log_enqueue: bool = False
+    # At INFO, each station's requests are summarized at most once per this many seconds
+    log_summary_interval_sec: int = 300
+
+    # Gunicorn (see gunicorn.conf.py)
+    web_workers: int = 1
+    web_threads: int = 4
+    web_keepalive_sec: int = 5
+    web_timeout_sec: int = 30
+    # Serve /ambientweather from a minimal WSGI app in front of Flask (see app.FastPath)
+    web_fast_path: bool = False
+
+    # MQTT
+    mqtt_host: Optional[str] = None
+    mqtt_port: int = 0
+    mqtt_username: Optional[str] = None
+    mqtt_password: Optional[str] = None
+    mqtt_keepalive_sec: int = 60
+    mqtt_prefix: str = "ambientweather"
+    mqtt_client_id: str = "ambientweather"
+    mqtt_qos: int = 0
+    # How many QoS 1/2 messages can be waiting on the MQTT server to acknowledge them. With MQTT 5, the server's receive maximum if lower
+    mqtt_max_inflight: int = 20
+    # The MQTT protocol version: 3.1.1 or 5. A server that doesn't support 5 is reconnected to with 3.1.1
+    mqtt_protocol: str = "3.1.1"
+    # With MQTT 5, how many topics (per connection) are sent as a short topic alias once they've been published twice. The server may allow fewer
+    mqtt_topic_aliases: int = 20
+    # With MQTT 5, readings the server hasn't delivered within this many seconds are dropped by the server (0 = never)
+    mqtt_message_expiry_sec: int = 0
+    # How many messages can be waiting to be published before mqtt_queue_overflow applies
+    mqtt_queue_size: int = 1000
+    # What to do when the publish queue is full:
+    #   drop-oldest: drop the oldest waiting message
+    #   coalesce: only keep the newest message for each topic (and drop the oldest if the queue is still full)
+    mqtt_queue_overflow: str = "drop-oldest"
+    # How many messages can be waiting in the MQTT client to be written to the socket (or acknowledged) before we stop handing it more.
+    # The rest wait in the publish queue, so mqtt_queue_overflow applies while the server is slow as well as while it's unavailable
+    mqtt_client_buffer_size: int = 100
+    # While the MQTT server is unavailable, messages are written to this sqlite database and replayed in order once it's back. Disabled if empty
+    mqtt_journal_file: str = ""
+    # The oldest messages are dropped once the journal is larger than this many MB
+    mqtt_journal_max_mb: float = 100
+    # Messages older than this many seconds are dropped rather than replayed
+    mqtt_journal_max_age_sec: int = 86400
+    # How many messages are read from the journal at a time while replaying
+    mqtt_journal_replay_batch: int = 1000
+    # A space separated list of other MQTT servers to publish to, as URLs. See parse_brokers
+    mqtt_extra_brokers: str = ""
+    # After losing the connection to an MQTT server, wait between these many seconds (doubling each attempt) before reconnecting
+    mqtt_reconnect_min_sec: int = 1
+    mqtt_reconnect_max_sec: int = 120
+
+    # MQTT topics
+    mqtt_topic_online: str = "online"
+    mqtt_topic_json: str = "sensor"
+    mqtt_topic_aggregate: str = "aggregate"
+    # How sensor data is published:
+    #   json: a single json payload per station (ex: ambientweather/00-00-00-00-00-00/sensor)
+    #   fields: a retained topic per value, only published when the value changes (ex: ambientweather/00-00-00-00-00-00/temperature/outdoor/celsius)
+    #   both: json and fields
+    mqtt_publish_mode: str = "json"
+    # Only publish a station's payload if it changed since it was last published
+    publish_only_changes: bool = False
+    # With publish_only_changes, still publish at least this often (in seconds) so consumers know the station is alive
+    publish_heartbeat_sec: int = 300
+    # With publish_only_changes, numeric values must change by more than this to count as a change
+    publish_deadband: float = 0
+
+    # Home Assistant
+    # If we should send a message to a discovery topic when a new client connects
+    send_ha_discovery_config: bool = True
+    ha_discovery_prefix: str = "homeassistant"
+    # We watch this topic for HA coming online. When it does, we wipe the known sensors so we'll re-send sensor config messages
+    ha_birth_topic: str = "homeassistant/status"
+    ha_birth_topic_online: str = "online"
+    # A comma separated list of mac addresses and their name. Ex: 00:00:00:00:00:00/Weather Station
+    mac_name_mapping: Optional[str] = None
+    # Prebuilt configs are kept for stations that have reported within this many seconds
+    ha_config_cache_ttl_sec: int = 3600
+    # Sensor configs are sent from a background thread at up to this many messages per second (0 = no limit)
+    ha_discovery_rate: float = 50
+    ha_discovery_qos: int = 0
+    # With a QoS above 0, how many configs can be waiting on the MQTT server to acknowledge them
+    ha_discovery_max_inflight: int = 20
+    # How sensor configs are sent to HA:
+    #   entity: a config message per sensor (default)
+    #   device: a single config message per station, with each sensor as one of its components
+    ha_discovery_mode: str = "entity"
+    # With ha_discovery_mode=device, moves sensors from their entity configs to the station's device config (keeping their history)
+    # and then removes the entity configs. Only needed for one run after switching from entity mode
+    ha_discovery_migrate: bool = False
+    # If configs are sent as retained messages, so HA (and KNOWN_SENSORS_WARM_START=retained) can read them back from the MQTT server
+    ha_discovery_retain: bool = False
+    # Where known sensors are kept:
+    #   memory: each process keeps its own set (default)
+    #   sqlite: shared between processes (ex: multiple workers) using known_sensors_cache_file
+    known_sensors_backend: str = "memory"
+    known_sensors_cache_file: str = "known_sensors.db"
+    # What we start with when deciding which configs HA already has:
+    #   off: nothing. Every config is sent again (default)
+    #   snapshot: the known sensors kept in known_sensors_cache_file by the previous run
+    #   retained: the configs retained on the MQTT server, read for known_sensors_warm_start_sec after connecting (needs ha_discovery_retain)
+    # Either way, a config that's changed since it was sent is sent again
+    known_sensors_warm_start: str = "off"
+    known_sensors_warm_start_sec: float = 2
+
+    # Aggregates
+    # A comma separated list of windows to publish min/max/avg values for (ex: 1m,10m,1h). Disabled if empty
+    aggregate_windows: str = ""
+    # A comma separated list of the stats to send HA discovery configs for
+    aggregate_ha_stats: str = "avg,min,max"
+
+    # History
+    # A directory to keep each station's recent values in (for /history). Disabled if empty
+    history_dir: str = ""
+    # How many readings are kept per station. Once full, the oldest reading is overwritten
+    history_size: int = 17280
+
+    # Monitoring
+    # When running multiple gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory so /metrics reports all workers
+    # Reference: https://prometheus.github.io/client_python/multiprocess/
+    prometheus_multiproc_dir: Optional[str] = None
+    # Requests are counted per station for this many stations. Any others are counted together, so /metrics stays a manageable size
+    metrics_max_stations: int = 20
+    # As metrics_max_stations, for the arguments received that aren't a known sensor
+    metrics_max_unknown_args: int = 20
+
+
+def __parse_bool(value):
+    """
+    Parses a boolean setting. Accepts 0/1 (as documented) as well as true/false
+    """
+    if value.lower() in ("true", "yes"):
+        return True
+    if value.lower() in ("false", "no"):
+        return False
+    return bool(int(value))
+
+
+# The type of each setting -> the function that parses it (and its description for errors)
+PARSERS = {
+    bool: (__parse_bool, "0 or 1"),
+    int: (int, "an int"),
+    float: (float, "a number"),
+    str: (str, "a string"),
+    Optional[str]: (str, "a string"),
+}
+
+# Settings that must be one of a few values -> (the allowed values, what to use instead)
+CHOICES = {
+    "mqtt_publish_mode": (("json", "fields", "both"), "json"),
+    "mqtt_queue_overflow": (("drop-oldest", "coalesce"), "drop-oldest"),
+    "mqtt_protocol": (("3.1.1", "5"), "3.1.1"),
+    "known_sensors_backend": (("memory", "sqlite"), "memory"),
+    "ha_discovery_mode": (("entity", "device"), "entity"),
+    "known_sensors_warm_start": (("off", "snapshot", "retained"), "off"),
+}
+
+
+def load(environ=os.environ):
+    """
+    Loads the config from the environment. Problems that would stop us working (ex: no MQTT_HOST) are returned rather than raised so
+    modules can be imported (ex: by benchmarks) without a complete config. check() reports them on startup
+    :return: the Config and a list of errors
+    """
+    values = {}
+    errors = []
+    for field in fields(Config):
+        name = field.name.upper()
+        raw = environ.get(name)
+        if raw is None:
+            continue
+        parse, description = PARSERS[field.type]
+        try:
+            values[field.name] = parse(raw)
+        except ValueError:
+            errors.append("{name} must be {description} (got '{raw}')".format(name=name, description=description, raw=raw))
+
+    config = Config(**values)
+
+    for name, (allowed, fallback) in CHOICES.items():
+        if getattr(config, name) not in allowed:
+            logger.warning("Unknown {name} '{value}'. Using {fallback}".format(name=name.upper(), value=getattr(config, name), fallback=fallback))
+            setattr(config, name, fallback)
+
+    if config.mqtt_host is None or config.mqtt_host == "":
+        errors.append("No MQTT_HOST provided")
+    if config.mqtt_port == 0:
+        errors.append("No MQTT_PORT provided")
+    for name in ("mqtt_qos", "ha_discovery_qos"):
+        if getattr(config, name) not in (0, 1, 2):
+            errors.append("{name} must be 0, 1 or 2".format(name=name.upper()))
+    errors.extend(parse_brokers(config)[1])
+    errors.extend(parse_windows(config)[1])
+    if config.known_sensors_warm_start == "retained" and not config.ha_discovery_retain:
+        logger.warning("KNOWN_SENSORS_WARM_START=retained only finds configs sent with HA_DISCOVERY_RETAIN=1")
+
+    return config, errors
+
+
+# An MQTT server to publish to
+# :param name: identifies the server in logs, /stats and metrics
+# :param topics: MQTT topic filters (after the prefix) of the messages sent to this server, or None for all of them
+# :param ha: whether HA discovery configs are sent to this server (and it's watched for HA's birth message)
+BrokerTarget = namedtuple("BrokerTarget", ["name", "host", "port", "username", "password", "prefix", "client_id", "qos", "topics", "ha"])
+
+
+def parse_brokers(config):
+    """
+    Returns the MQTT servers to publish to: the main server (MQTT_HOST) then each of MQTT_EXTRA_BROKERS. Each extra server is a URL:
+        mqtt://[username[:password]@]host[:port][/prefix][?name=central&client_id=ambientweather&qos=1&topics=+/sensor,+/aggregate/#]
+    The prefix, client ID and QoS default to MQTT_PREFIX, MQTT_CLIENT_ID and MQTT_QOS
+    :return: a list of BrokerTarget and a list of errors
+    """
+    targets = [BrokerTarget("main", config.mqtt_host, config.mqtt_port, config.mqtt_username, config.mqtt_password, config.mqtt_prefix,
+                            config.mqtt_client_id, config.mqtt_qos, None, True)]
+    errors = []
+    for url in config.mqtt_extra_brokers.split():
+        try:
+            # Topic filters use + and #, so they're kept as is rather than parsed as a space and the fragment
+            parts = urlsplit(url, allow_fragments=False)
+            params = dict(param.partition("=")[::2] for param in parts.query.split("&") if param != "")
+            target = BrokerTarget(
+                name=params.get("name", parts.netloc.rpartition("@")[2]),
+                host=parts.hostname,
+                port=parts.port or 1883,
+                username=None if parts.username is None else unquote(parts.username),
+                password=None if parts.password is None else unquote(parts.password),
+                prefix=parts.path.strip("/") or config.mqtt_prefix,
+                client_id=params.get("client_id", config.mqtt_client_id),
+                qos=int(params.get("qos", config.mqtt_qos)),
+                topics=params["topics"].split(",") if "topics" in params else None,
+                ha=False)
+        except ValueError as e:
+            errors.append("Invalid MQTT_EXTRA_BROKERS URL '{url}': {error}".format(url=url, error=e))
+            continue
+
+        if parts.scheme != "mqtt" or target.host is None:
+            errors.append("Invalid MQTT_EXTRA_BROKERS URL '{url}': expected mqtt://host[:port]".format(url=url))
+        elif target.qos not in (0, 1, 2):
+            errors.append("Invalid MQTT_EXTRA_BROKERS URL '{url}': qos must be 0, 1 or 2".format(url=url))
+        elif target.name in [existing.name for existing in targets]:
+            errors.append("MQTT_EXTRA_BROKERS has more than one server named '{name}'. Set a name with ?name=".format(name=target.name))
+        else:
+            targets.append(target)
+    return targets, errors
+
+
+# The suffixes a window can have -> seconds
+WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+
+def parse_windows(config):
+    """
+    Returns the aggregate windows in AGGREGATE_WINDOWS. Each is a whole number of seconds, optionally followed by s, m or h (ex: 90s, 10m, 1h)
+    :return: a list of (name, seconds) and a list of errors
+    """
+    windows = []
+    errors = []
+    for window in config.aggregate_windows.split(","):
+        window = window.strip()
+        if window == "":
+            continue
+        number, unit = (window[:-1], window[-1]) if window[-1] in WINDOW_UNITS else (window, "s")
+        if not number.isdecimal() or int(number) == 0:
+            errors.append("Invalid AGGREGATE_WINDOWS window '{window}': expected a positive whole number followed by s, m or h (ex: 10m)"
+                          .format(window=window))
+        elif window in [name for name, _ in windows]:
+            errors.append("AGGREGATE_WINDOWS has the window '{window}' more than once".format(window=window))
+        else:
+            windows.append((window, int(number) * WINDOW_UNITS[unit]))
+    return windows, errors
+
+
+def check():
+    """
+    Logs any errors in the config and exits if there are any. Called on startup rather than on import
+    """
+    for error in CONFIG_ERRORS:
+        logger.error(error)
+    if len(CONFIG_ERRORS) > 0:
+        sys.exit(1)
+
+
+CONFIG, CONFIG_ERRORS = load()
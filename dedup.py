@@ -0,0 +1,136 @@
+import time
+import threading
+from config import CONFIG
+from loguru import logger
+from sensors import flatten
+
+
+# mac -> (time.monotonic the payload was published, {keys: value} of the published payload)
+last_published = {}
+last_published_lock = threading.Lock()
+next_eviction = 0
+
+# mac -> {keys: (value, time.monotonic it was published to its own topic)}. Used when MQTT_PUBLISH_MODE is fields/both
+field_values = {}
+field_values_lock = threading.Lock()
+next_field_eviction = 0
+
+
+def __changed(previous, current):
+    """
+    Returns True if any value in current differs from previous (beyond PUBLISH_DEADBAND for numbers)
+    """
+    if previous.keys() != current.keys():
+        return True
+
+    for keys, value in current.items():
+        previous_value = previous[keys]
+        if isinstance(value, (int, float)) and isinstance(previous_value, (int, float)):
+            if abs(value - previous_value) > CONFIG.publish_deadband:
+                return True
+        elif value != previous_value:
+            return True
+    return False
+
+
+def should_publish(mac, payload):
+    """
+    Returns True if the payload for the station should be published
+    :param mac: the station the payload is for
+    :param payload: the dict generated by generate_sensor_dict
+    """
+    if not CONFIG.publish_only_changes:
+        return True
+
+    global next_eviction
+    now = time.monotonic()
+    current = dict(flatten(payload))
+    with last_published_lock:
+        if now >= next_eviction:
+            next_eviction = now + CONFIG.publish_heartbeat_sec
+            __evict_published(now)
+
+        previous = last_published.get(mac)
+        if previous is not None and now - previous[0] < CONFIG.publish_heartbeat_sec and not __changed(previous[1], current):
+            logger.debug("Payload for {} is unchanged. Skipping", mac)
+            return False
+
+        # Only saved when published, so slow drifts within the deadband are still published eventually
+        last_published[mac] = (now, current)
+    return True
+
+
+def __evict_published(now):
+    """
+    Removes the payloads of stations that haven't published within PUBLISH_HEARTBEAT_SEC, as they'd be published again anyway. Must be
+    called with last_published_lock held
+    """
+    for mac in [mac for mac, (published_at, _) in last_published.items() if now - published_at >= CONFIG.publish_heartbeat_sec]:
+        del last_published[mac]
+
+
+def forget_published(mac):
+    """
+    Forgets the payload published for a station so the next one is published even if it's unchanged. Used when the message didn't reach
+    the MQTT server
+    """
+    with last_published_lock:
+        last_published.pop(mac, None)
+
+
+def changed_fields(mac, payload):
+    """
+    Returns the (keys, value) of each value in the payload to publish to its own topic: those that changed since they were last published,
+    or were last published over PUBLISH_HEARTBEAT_SEC ago
+    :param mac: the station the payload is for
+    :param payload: the dict generated by generate_sensor_dict
+    """
+    global next_field_eviction
+    now = time.monotonic()
+    changed = []
+    with field_values_lock:
+        if now >= next_field_eviction:
+            next_field_eviction = now + CONFIG.publish_heartbeat_sec
+            __evict_fields(now)
+
+        published = field_values.setdefault(mac, {})
+        for keys, value in flatten(payload):
+            previous = published.get(keys)
+            if previous is not None and previous[0] == value and now - previous[1] < CONFIG.publish_heartbeat_sec:
+                continue
+            published[keys] = (value, now)
+            changed.append((keys, value))
+    return changed
+
+
+def __evict_fields(now):
+    """
+    Removes the values of stations that haven't published any within PUBLISH_HEARTBEAT_SEC, as they'd be published again anyway. Must be
+    called with field_values_lock held
+    """
+    stale = [mac for mac, published in field_values.items()
+             if all(now - published_at >= CONFIG.publish_heartbeat_sec for _, published_at in published.values())]
+    for mac in stale:
+        del field_values[mac]
+
+
+def forget_field(topic):
+    """
+    Forgets the value published to a field's topic (ex: 00-00-00-00-00-00/temperature/outdoor/celsius) so it's published again with the
+    next payload. Used when the message didn't reach the MQTT server
+    """
+    mac, _, field = topic.partition("/")
+    with field_values_lock:
+        published = field_values.get(mac)
+        if published is not None:
+            published.pop(tuple(field.split("/")), None)
+
+
+def forget_all():
+    """
+    Forgets every published payload and field value so they're all published again (ex: after reconnecting to an MQTT server)
+    """
+    with last_published_lock:
+        last_published.clear()
+    with field_values_lock:
+        field_values.clear()
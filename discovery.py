@@ -0,0 +1,427 @@
+import time
+import queue
+import threading
+import metrics
+import mqtt
+import known_sensors
+import serialize
+from collections import namedtuple, deque
+from config import CONFIG
+from loguru import logger
+from paho.mqtt.client import MQTTMessageInfo
+
+
+# A prebuilt config message for a single sensor
+# :param sensor_unique_id: the unique ID of the sensor in HA (ex: 00-00-00-00-00-00_temperature-outdoor-celsius)
+# :param topic: the discovery topic to publish to
+# :param payload: the serialized config payload. With HA_DISCOVERY_MODE=device, the serialized component for the station's device config
+# :param stationtype: the station type the config was built for. If the station reports a new type, the config is rebuilt
+# :param digest: the hash of the payload (see known_sensors.digest)
+SensorConfig = namedtuple("SensorConfig", ["sensor_unique_id", "topic", "payload", "stationtype", "digest"])
+
+# The config of a whole station, sent instead of its SensorConfigs with HA_DISCOVERY_MODE=device. It's built when it's sent so it
+# includes every sensor of the station we know about
+# :param mac: the station's MAC address
+# :param ready_at: when (time.monotonic) to send it. It's held back briefly so the rest of the reading's sensors are included
+DeviceConfig = namedtuple("DeviceConfig", ["mac", "ready_at"])
+
+# How long (in seconds) a DeviceConfig waits for the rest of a reading's sensors
+DEVICE_SETTLE_SEC = 0.5
+
+# Identifies us in HA's logs. Required in device configs
+# Reference: https://www.home-assistant.io/integrations/mqtt/#device-discovery-payload
+ORIGIN = serialize.dumps({"name": "ambient-weather-to-mqtt", "support_url": "https://github.com/klagroix/ambient-weather-to-mqtt"})
+
+# Sent to an entity's discovery topic so HA moves the entity to the device config sent next, rather than removing it
+MIGRATE_PAYLOAD = serialize.dumps({"migrate_discovery": True})
+
+# (mac, uniqueid) -> SensorConfig
+sensor_configs = {}
+# mac -> the time (time.monotonic) the station last reported
+stations_last_seen = {}
+next_eviction = 0
+sensor_configs_lock = threading.Lock()
+
+# SensorConfigs waiting to be sent by the publisher thread
+publish_queue = queue.Queue()
+publisher_thread = None
+publisher_lock = threading.Lock()
+# If set, called with each SensorConfig to send instead of using the publisher thread (ex: by the asyncio runtime)
+custom_publisher = None
+
+# (mac, stationtype) -> the serialized fields that are the same in the config of each of a station's sensors (its device and availability)
+station_fragments = {}
+
+# mac -> the sensor unique IDs included in the last device config sent for the station (HA_DISCOVERY_MODE=device)
+devices_sent = {}
+# macs with a DeviceConfig waiting to be sent
+devices_pending = set()
+# The sensor unique IDs moved from their entity configs to their station's device config (HA_DISCOVERY_MIGRATE)
+sensors_migrated = set()
+
+# With KNOWN_SENSORS_WARM_START=retained, the topics the configs of a previous run are retained on
+WARM_START_TOPICS = ["{prefix}/sensor/+/config".format(prefix=CONFIG.ha_discovery_prefix),
+                     "{prefix}/device/+/config".format(prefix=CONFIG.ha_discovery_prefix)]
+# sensor unique ID (or sanitized mac for device configs) -> the digest of its retained config
+retained_digests = {}
+warm_start_timer = None
+# Set once we know which configs HA already has. Configs are held back until then
+warm_started = threading.Event()
+if CONFIG.known_sensors_warm_start != "retained":
+    warm_started.set()
+
+mac_names = {}
+
+# Translate the env-set mapping to a dict
+if CONFIG.mac_name_mapping is not None:
+    for mapping in CONFIG.mac_name_mapping.split(","):
+        mac, name = mapping.split("/")
+        mac_names[mac] = name
+
+
+def __build_sensor_config(mac, stationtype, sensorname, uniqueid, value_template, unit_of_measurement, device_class, icon, state_class,
+                          state_topic):
+    """
+    Builds the SensorConfig for a sensor. See send_ha_sensor_config for the parameters
+    """
+    # The topic can't handle colons. As such, we use hyphens instead
+    # Reference: https://www.home-assistant.io/docs/mqtt/discovery/
+    mac_sanitized = mac.replace(':', '-')
+    sensor_unique_id = "{mac_sanitized}_{uniqueid_sanitized}".format(mac_sanitized=mac_sanitized, uniqueid_sanitized=uniqueid.replace(".", "-"))
+    discovery_topic = "{prefix}/sensor/{sensor_unique_id}/config".format(prefix=CONFIG.ha_discovery_prefix, sensor_unique_id=sensor_unique_id)
+
+    devicename = ""
+    if mac in mac_names:
+        devicename = mac_names[mac]
+
+    config_payload = {
+        "name": sensorname,  # Outdoor Temperatre
+        "object_id": "{devicename} - {sensorname}".format(devicename=devicename, sensorname=sensorname),
+        "unique_id": sensor_unique_id,
+        "state_topic": "{prefix}/{mac}/sensor".format(prefix=CONFIG.mqtt_prefix, mac=mac_sanitized),
+        "value_template": value_template,
+    }
+
+    if state_topic is not None:
+        config_payload["state_topic"] = "{prefix}/{mac}/{topic}".format(prefix=CONFIG.mqtt_prefix, mac=mac_sanitized, topic=state_topic)
+    elif CONFIG.mqtt_publish_mode != "json":
+        # Each value has its own topic, so HA doesn't need to parse the json payload
+        field_topic = uniqueid.replace(".", "/")
+        config_payload["state_topic"] = "{prefix}/{mac}/{field}".format(prefix=CONFIG.mqtt_prefix, mac=mac_sanitized, field=field_topic)
+        del config_payload["value_template"]
+
+    if unit_of_measurement is not None:
+        config_payload["unit_of_measurement"] = unit_of_measurement
+
+    if device_class is not None:
+        config_payload["device_class"] = device_class
+
+    if icon is not None:
+        config_payload["icon"] = icon
+
+    if state_class is not None:
+        config_payload["state_class"] = state_class
+
+    if CONFIG.ha_discovery_mode == "device":
+        # The station's fields are sent once, in the device config
+        config_payload["platform"] = "sensor"
+        payload = serialize.dumps(config_payload)
+        return SensorConfig(sensor_unique_id, discovery_topic, payload, stationtype, known_sensors.digest(payload))
+
+    # The station's fields are serialized once and added to the end of the object
+    payload = serialize.dumps(config_payload)[:-1] + b"," + __station_fragment(mac, stationtype, devicename) + b"}"
+    return SensorConfig(sensor_unique_id, discovery_topic, payload, stationtype, known_sensors.digest(payload))
+
+
+def __station_fragment(mac, stationtype, devicename):
+    """
+    Returns the serialized fields (without the surrounding braces) that are the same in the config of each of a station's sensors
+    """
+    fragment = station_fragments.get((mac, stationtype))
+    if fragment is None:
+        fragment = serialize.dumps({
+            "device": {
+                "connections": [["mac", mac]],
+                "identifiers": [stationtype],
+                "manufacturer": "Ambient Weather",
+                "name": devicename
+            },
+            "availability": [
+                {"topic": "{prefix}/online".format(prefix=CONFIG.mqtt_prefix)}
+            ],
+            "payload_available": "online",
+            "payload_not_available": "offline"
+        })[1:-1]
+        station_fragments[(mac, stationtype)] = fragment
+    return fragment
+
+
+def __evict_stale_stations(now):
+    """
+    Removes the prebuilt configs of stations that haven't reported within HA_CONFIG_CACHE_TTL_SEC
+    """
+    global next_eviction
+    with sensor_configs_lock:
+        next_eviction = now + CONFIG.ha_config_cache_ttl_sec
+        stale = [mac for mac, last_seen in stations_last_seen.items() if now - last_seen > CONFIG.ha_config_cache_ttl_sec]
+        if len(stale) == 0:
+            return
+
+        logger.info("Removing cached sensor configs for stations that stopped reporting: {stale}".format(stale=stale))
+        for mac in stale:
+            del stations_last_seen[mac]
+        for key in [key for key in sensor_configs if key[0] in stale]:
+            del sensor_configs[key]
+        for key in [key for key in station_fragments if key[0] in stale]:
+            del station_fragments[key]
+        for mac in stale:
+            devices_sent.pop(mac, None)
+
+
+def send_ha_sensor_config(send_config, mac, stationtype, sensorname, uniqueid, value_template, unit_of_measurement=None,
+                          device_class=None, icon=None, state_class=None, state_topic=None):
+    """
+    Sends the configuration of the sensor to HA if we haven't already
+    :param mac: MAC address of the device
+    :param stationtype: Station Type of the device (usually pulled from request params)
+    :param sensorname: The name of the sensor as it should show in Home Assistant (ex: "Outdoor Temperature")
+    :param uniqueid: The unique ID to suffix behind mac
+    :param value_template: The lookup string for HA to parse the value from json (ex: "{{ value_json.temperature.outdoor.celsius }}")
+    :param unit_of_measurement: The Unit of Measurement (ex: °C)
+    :param device_class: HA device class
+    :param icon: Icon to use (to override device class)
+    :param state_class: HA state class
+    :param state_topic: The topic (after the prefix and mac) HA reads the value from, if not the station's sensor data (ex: aggregate/10m)
+    """
+
+    if bool(send_config) is not True:
+        return
+
+    if mac is None:
+        logger.debug("Not sending sensor config as mac is None")
+        return
+
+    now = time.monotonic()
+    with sensor_configs_lock:
+        stations_last_seen[mac] = now
+    if now >= next_eviction:
+        __evict_stale_stations(now)
+
+    config = sensor_configs.get((mac, uniqueid))
+    if config is None or config.stationtype != stationtype:
+        config = __build_sensor_config(mac, stationtype, sensorname, uniqueid, value_template, unit_of_measurement, device_class, icon, state_class,
+                                       state_topic)
+        with sensor_configs_lock:
+            sensor_configs[(mac, uniqueid)] = config
+
+    if CONFIG.ha_discovery_mode == "device":
+        __queue_device_config(mac, config.sensor_unique_id)
+        return
+
+    if known_sensors.is_known_sensor(config.sensor_unique_id, config.digest):
+        if CONFIG.debug:
+            logger.debug("Already sent config for {} to HA. Skipping", config.sensor_unique_id)
+        return
+
+    # If we're here, we have to send the device config to HA. We mark it as known now so it's only queued once
+    logger.debug("Queueing {} config to discovery topic for MAC: {}", sensorname, mac)
+    known_sensors.add_known_sensor(config.sensor_unique_id, config.digest)
+    __enqueue(config)
+
+
+def __queue_device_config(mac, sensor_unique_id):
+    """
+    Queues the station's device config to be sent to HA if the last one sent didn't include this sensor
+    """
+    sent = devices_sent.get(mac)
+    if sent is not None and sensor_unique_id in sent:
+        return
+
+    with sensor_configs_lock:
+        if mac in devices_pending:
+            return
+        devices_pending.add(mac)
+    logger.debug("Queueing device config to discovery topic for MAC: {}", mac)
+    __enqueue(DeviceConfig(mac, time.monotonic() + DEVICE_SETTLE_SEC))
+
+
+def build_messages(config):
+    """
+    Returns the messages to send for a queued SensorConfig or DeviceConfig
+    :return: a list of (topic, payload, retain)
+    """
+    if isinstance(config, SensorConfig):
+        # The config may have been queued before we read the retained configs
+        if retained_digests.get(config.sensor_unique_id) == config.digest:
+            return []
+        return [(config.topic, config.payload, CONFIG.ha_discovery_retain)]
+
+    mac = config.mac
+    with sensor_configs_lock:
+        devices_pending.discard(mac)
+        components = [component for key, component in sensor_configs.items() if key[0] == mac]
+        devices_sent[mac] = {component.sensor_unique_id for component in components}
+        migrating = []
+        if CONFIG.ha_discovery_migrate:
+            migrating = [component for component in components if component.sensor_unique_id not in sensors_migrated]
+            sensors_migrated.update(component.sensor_unique_id for component in migrating)
+    if len(components) == 0:
+        return []
+
+    mac_sanitized = mac.replace(':', '-')
+    topic = "{prefix}/device/{mac_sanitized}/config".format(prefix=CONFIG.ha_discovery_prefix, mac_sanitized=mac_sanitized)
+    # A device config replaces the previous one, so it has to include every component. Any left out are removed from HA
+    payload = (b'{"origin":' + ORIGIN + b',"components":{'
+               + b",".join(serialize.dumps(component.sensor_unique_id) + b":" + component.payload for component in components)
+               + b"}," + __station_fragment(mac, components[-1].stationtype, mac_names.get(mac, "")) + b"}")
+    payload_digest = known_sensors.digest(payload)
+    if len(migrating) == 0 and known_sensors.is_known_sensor(mac_sanitized, payload_digest):
+        logger.debug("Already sent device config for {} to HA. Skipping", mac)
+        return []
+    known_sensors.add_known_sensor(mac_sanitized, payload_digest)
+
+    # Reference: https://www.home-assistant.io/integrations/mqtt/#migration-from-single-component-to-device-based-discovery
+    # HA moves each entity to the device config rather than removing it, keeping its history. The entity configs are then cleared
+    return ([(component.topic, MIGRATE_PAYLOAD, True) for component in migrating]
+            + [(topic, payload, CONFIG.ha_discovery_retain)]
+            + [(component.topic, b"", True) for component in migrating])
+
+
+def republish_all():
+    """
+    Queues the config of every sensor of every station we know about to be sent to HA (ex: after HA restarts). With multiple workers, each
+    config is only queued by the worker that claims it first
+    """
+    known_sensors.clear_known_sensors()
+    retained_digests.clear()
+    if CONFIG.ha_discovery_mode == "device":
+        with sensor_configs_lock:
+            macs = {mac for mac, _ in sensor_configs} - devices_pending
+        # The device config is built when it's sent, so there's no digest to claim it with yet
+        macs = {mac for mac in macs if known_sensors.claim_known_sensor(mac.replace(':', '-'))}
+        with sensor_configs_lock:
+            for mac in macs:
+                devices_sent.pop(mac, None)
+            devices_pending.update(macs)
+
+        logger.info("Queueing {count} device configs to be re-sent to HA".format(count=len(macs)))
+        now = time.monotonic()
+        for mac in macs:
+            __enqueue(DeviceConfig(mac, now))
+        return
+
+    with sensor_configs_lock:
+        configs = list(sensor_configs.values())
+
+    configs = [config for config in configs if known_sensors.claim_known_sensor(config.sensor_unique_id, config.digest)]
+    logger.info("Queueing {count} sensor configs to be re-sent to HA".format(count=len(configs)))
+    for config in configs:
+        __enqueue(config)
+
+
+def start_warm_start(broker):
+    """
+    With KNOWN_SENSORS_WARM_START=retained, subscribes to the configs retained on the MQTT server for KNOWN_SENSORS_WARM_START_SEC so
+    we only send the ones HA doesn't have. Called once connected to the main MQTT server
+    """
+    global warm_start_timer
+    if warm_started.is_set() or warm_start_timer is not None:
+        return
+
+    logger.info("Reading retained HA configs for {sec}s".format(sec=CONFIG.known_sensors_warm_start_sec))
+    for topic in WARM_START_TOPICS:
+        broker.subscribe(topic)
+    warm_start_timer = threading.Timer(CONFIG.known_sensors_warm_start_sec, __end_warm_start, [broker])
+    warm_start_timer.daemon = True
+    warm_start_timer.start()
+
+
+def __end_warm_start(broker):
+    for topic in WARM_START_TOPICS:
+        broker.client.unsubscribe(topic)
+    logger.info("Found {count} retained HA configs. Only configs that are missing or have changed will be sent".format(
+        count=len(retained_digests)))
+    warm_started.set()
+
+
+def on_retained_config(topic, payload):
+    """
+    Records a config retained on the MQTT server (ie: sent by a previous run) as known, so it's only sent again if it's changed
+    """
+    # An empty payload is a removed config
+    if warm_started.is_set() or len(payload) == 0:
+        return
+    # The topic is {prefix}/sensor/{sensor_unique_id}/config or {prefix}/device/{mac_sanitized}/config
+    sensor_id = topic.split("/")[-2]
+    retained_digests[sensor_id] = known_sensors.digest(payload)
+    known_sensors.add_known_sensor(sensor_id, retained_digests[sensor_id])
+
+
+def set_publisher(publisher):
+    """
+    Sends configs by calling publisher with each SensorConfig (or DeviceConfig) rather than from the publisher thread
+    """
+    global custom_publisher
+    custom_publisher = publisher
+
+
+def __enqueue(config):
+    """
+    Queues a SensorConfig (or DeviceConfig) to be sent by the publisher thread, starting the thread if required
+    """
+    global publisher_thread
+    if custom_publisher is not None:
+        custom_publisher(config)
+        return
+    # Threads don't survive a fork, so check it's running in this process
+    if publisher_thread is None or not publisher_thread.is_alive():
+        with publisher_lock:
+            if publisher_thread is None or not publisher_thread.is_alive():
+                publisher_thread = threading.Thread(target=__publisher, name="discovery-publisher", daemon=True)
+                publisher_thread.start()
+    publish_queue.put(config)
+
+
+def __publisher():
+    """
+    Sends queued SensorConfigs and DeviceConfigs to HA, limited to HA_DISCOVERY_RATE messages per second
+    """
+    interval = 0
+    if CONFIG.ha_discovery_rate > 0:
+        interval = 1 / CONFIG.ha_discovery_rate
+
+    # Messages that haven't been acknowledged by the MQTT server yet (only used with QoS > 0)
+    inflight = deque()
+    burst_started = None
+    burst_count = 0
+
+    while True:
+        config = publish_queue.get()
+        if isinstance(config, DeviceConfig):
+            time.sleep(max(0.0, config.ready_at - time.monotonic()))
+        # Configs queued while we're still connecting (ex: on startup) would be dropped by the MQTT client, so hold on to them
+        while not mqtt.is_connected():
+            time.sleep(0.1)
+        warm_started.wait()
+        if burst_started is None:
+            burst_started = time.monotonic()
+            burst_count = 0
+
+        for topic, payload, retain in build_messages(config):
+            with metrics.DISCOVERY_PUBLISH_SECONDS.time():
+                info = mqtt.publish_now(topic, payload, insert_prefix=False, retain=retain, qos=CONFIG.ha_discovery_qos)
+                burst_count += 1
+                if CONFIG.ha_discovery_qos > 0 and isinstance(info, MQTTMessageInfo):
+                    inflight.append(info)
+                    if len(inflight) >= CONFIG.ha_discovery_max_inflight:
+                        inflight.popleft().wait_for_publish(timeout=10)
+
+            if interval > 0:
+                time.sleep(interval)
+
+        if publish_queue.empty():
+            while len(inflight) > 0:
+                inflight.popleft().wait_for_publish(timeout=10)
+            logger.info("Done sending {count} discovery configs to HA in {duration:.2f}s".format(count=burst_count,
+                        duration=time.monotonic() - burst_started))
+            burst_started = None
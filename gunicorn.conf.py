@@ -0,0 +1,50 @@
+# Gunicorn config used to run ambient-weather-to-mqtt in production
+# Reference: https://docs.gunicorn.org/en/stable/settings.html
+from config import CONFIG
+
+
+bind = "0.0.0.0:{port}".format(port=CONFIG.listen_port)
+workers = CONFIG.web_workers
+# Each worker handles requests on a pool of threads
+worker_class = "gthread"
+threads = CONFIG.web_threads
+keepalive = CONFIG.web_keepalive_sec
+timeout = CONFIG.web_timeout_sec
+
+# Logging goes through loguru in app.py. Only log errors from gunicorn itself
+accesslog = None
+errorlog = "-"
+loglevel = "debug" if CONFIG.debug else "info"
+
+
+def on_starting(server):
+    """
+    Runs once in the master process before any workers are started
+    """
+    import config
+    config.check()
+
+    import known_sensors
+    known_sensors.reset()
+
+
+def post_worker_init(worker):
+    """
+    Runs in each worker once the app is loaded. The MQTT connection (and its network thread) can't be shared across a fork,
+    so each worker opens its own.
+    """
+    import mqtt
+    client_id_suffix = ""
+    if workers > 1:
+        # The MQTT server disconnects clients with a duplicate ID
+        client_id_suffix = "-{pid}".format(pid=worker.pid)
+    mqtt.connect(client_id_suffix=client_id_suffix)
+
+
+def child_exit(server, worker):
+    """
+    Runs in the master process when a worker exits
+    """
+    if CONFIG.prometheus_multiproc_dir is not None:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
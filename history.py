@@ -0,0 +1,198 @@
+import os
+import time
+import fcntl
+import threading
+from datetime import datetime, timezone
+from config import CONFIG
+from loguru import logger
+from sensors import flatten
+
+
+# numpy is only needed for stations with history, so it's imported on first use to keep startup fast
+np = None
+
+
+def __import_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+# Each station has a directory containing:
+#   meta: int64 [the next row to write, number of fields, size]
+#   time: float64 unix time of each row
+#   <field>: float64 value of the field (ex: temperature.outdoor.celsius) in each row. NaN if the reading didn't have the field
+#   lock: flock'd while writing so multiple workers can share the files
+META_HEAD, META_FIELDS, META_SIZE = range(3)
+RESERVED_FILES = {"meta", "time", "lock"}
+
+
+class StationHistory:
+    """
+    The memory-mapped files of a single station
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = open(os.path.join(path, "lock"), "a")
+        self.meta = self.__open("meta", np.int64, 3, 0)
+        if self.meta[META_SIZE] == 0:
+            self.meta[META_SIZE] = CONFIG.history_size
+        elif self.meta[META_SIZE] != CONFIG.history_size:
+            logger.warning("History for {path} was created with a HISTORY_SIZE of {size}. Using it rather than {new_size}".format(
+                path=path, size=self.meta[META_SIZE], new_size=CONFIG.history_size))
+        self.size = int(self.meta[META_SIZE])
+        self.times = self.__open("time", np.float64, self.size, np.nan)
+        self.fields = {}
+        self.refresh_fields()
+
+    def __open(self, name, dtype, length, fill):
+        """
+        Opens one of the station's files, creating it if it doesn't exist
+        """
+        filename = os.path.join(self.path, name)
+        if not os.path.exists(filename):
+            values = np.memmap(filename + ".tmp", dtype=dtype, mode="w+", shape=(length,))
+            values[:] = fill
+            values.flush()
+            del values
+            # Renamed into place so other workers never see a half-filled file
+            os.replace(filename + ".tmp", filename)
+        return np.memmap(filename, dtype=dtype, mode="r+", shape=(length,))
+
+    def refresh_fields(self):
+        """
+        Opens any fields added since we last looked (ex: by another worker)
+        """
+        if len(self.fields) == self.meta[META_FIELDS]:
+            return
+        for name in os.listdir(self.path):
+            if name not in RESERVED_FILES and not name.endswith(".tmp") and name not in self.fields:
+                self.fields[name] = self.__open(name, np.float64, self.size, np.nan)
+
+    def add_field(self, name):
+        """
+        Adds a field. Must be called with the station locked
+        """
+        self.fields[name] = self.__open(name, np.float64, self.size, np.nan)
+        self.meta[META_FIELDS] = len(self.fields)
+
+
+# mac -> StationHistory (for this process)
+stations = {}
+stations_lock = threading.Lock()
+
+
+def is_enabled():
+    return CONFIG.history_dir != ""
+
+
+def __get_station(mac_sanitized, create):
+    """
+    Returns the StationHistory of a station, or None if it doesn't have any history and create is False
+    """
+    station = stations.get(mac_sanitized)
+    if station is not None:
+        return station
+    __import_numpy()
+
+    # The mac becomes a directory name, so don't let it point anywhere else
+    if mac_sanitized in ("", ".", "..") or "/" in mac_sanitized:
+        logger.warning("Not keeping history for station '{mac}' as it isn't a valid directory name".format(mac=mac_sanitized))
+        return None
+
+    path = os.path.join(CONFIG.history_dir, mac_sanitized)
+    if not create and not os.path.isdir(path):
+        return None
+    os.makedirs(path, exist_ok=True)
+    station = StationHistory(path)
+    stations[mac_sanitized] = station
+    return station
+
+
+def parse_dateutc(value):
+    """
+    Returns the unix time of a station's dateutc argument (ex: 2024-01-31 23:59:59), or the current time if it's missing or "now"
+    """
+    if value is not None and value != "now":
+        try:
+            return datetime.strptime(value.replace("+", " "), "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            logger.debug("Couldn't parse dateutc '{}'. Using the current time", value)
+    return time.time()
+
+
+def add(mac_sanitized, json_payload, timestamp):
+    """
+    Adds each numeric value of a payload to the station's history
+    :param timestamp: unix time of the reading
+    """
+    values = {".".join(keys): value for keys, value in flatten(json_payload)
+              if keys[0] != "station" and isinstance(value, (int, float)) and not isinstance(value, bool)}
+
+    with stations_lock:
+        station = __get_station(mac_sanitized, True)
+        if station is None:
+            return
+        fcntl.flock(station.lock_file, fcntl.LOCK_EX)
+        try:
+            station.refresh_fields()
+            for name in values:
+                if name not in station.fields:
+                    station.add_field(name)
+
+            row = int(station.meta[META_HEAD])
+            for name, column in station.fields.items():
+                column[row] = values.get(name, np.nan)
+            station.times[row] = timestamp
+            station.meta[META_HEAD] = (row + 1) % station.size
+        finally:
+            fcntl.flock(station.lock_file, fcntl.LOCK_UN)
+
+
+def query(mac_sanitized, field, start, end, step=None):
+    """
+    Returns the values of a field between start and end (unix time), oldest first
+    :param step: if set, values are averaged into buckets of this many seconds and each point is [bucket start, avg, min, max]
+    :return: a list of [time, value] (or [time, avg, min, max] with step), or None if there's no history for the station/field
+    """
+    with stations_lock:
+        station = __get_station(mac_sanitized, False)
+        if station is None:
+            return None
+        fcntl.flock(station.lock_file, fcntl.LOCK_SH)
+        try:
+            station.refresh_fields()
+            column = station.fields.get(field)
+            if column is None:
+                return None
+            times = np.array(station.times)
+            values = np.array(column)
+        finally:
+            fcntl.flock(station.lock_file, fcntl.LOCK_UN)
+
+    mask = (times >= start) & (times < end) & ~np.isnan(values)
+    times = times[mask]
+    values = values[mask]
+    # Readings are usually in order already, but bulk uploads of old readings may not be
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    values = values[order]
+
+    if step is None:
+        return np.column_stack((times, values)).tolist()
+
+    if len(times) == 0:
+        return []
+    buckets = ((times - start) // step).astype(np.int64)
+    # As times are sorted, each bucket is a contiguous run of values
+    bucket_ids, starts = np.unique(buckets, return_index=True)
+    counts = np.diff(np.append(starts, len(values)))
+    averages = np.round(np.add.reduceat(values, starts) / counts, CONFIG.precision)
+    minimums = np.minimum.reduceat(values, starts)
+    maximums = np.maximum.reduceat(values, starts)
+    return np.column_stack((start + bucket_ids * step, averages, minimums, maximums)).tolist()
+
+
+if is_enabled():
+    logger.info("Keeping the last {size} readings of each station in {dir}".format(size=CONFIG.history_size, dir=CONFIG.history_dir))
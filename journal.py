@@ -0,0 +1,139 @@
+import os
+import time
+import sqlite3
+import threading
+import metrics
+from config import CONFIG
+from loguru import logger
+
+
+# How often (in seconds) the size and age limits are applied
+TRIM_INTERVAL_SEC = 10
+# Messages claimed longer ago than this (in seconds) are claimed again, as the worker that claimed them has likely died. paho closes a
+# connection that the server has gone quiet on after 1.5x the keepalive, so claimed messages are deleted or unclaimed well before then
+CLAIM_TIMEOUT_SEC = max(60, 2 * CONFIG.mqtt_keepalive_sec)
+
+# The sqlite connection and the pid it was opened in. sqlite connections can't be shared across a fork, so each process opens its own
+db = None
+db_pid = None
+db_lock = threading.Lock()
+next_trim = 0
+
+
+def is_enabled():
+    return CONFIG.mqtt_journal_file != ""
+
+
+def __get_db():
+    """
+    Returns the sqlite connection for this process, opening it if required. Must be called with db_lock held
+    """
+    global db, db_pid
+    if db is None or db_pid != os.getpid():
+        db = sqlite3.connect(CONFIG.mqtt_journal_file, timeout=10, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        # Only an OS crash (not a process crash) can lose the last few writes
+        db.execute("PRAGMA synchronous=NORMAL")
+        # AUTOINCREMENT so ids are never reused. claimed_at is set while a worker is replaying the message
+        db.execute("CREATE TABLE IF NOT EXISTS messages "
+                   "(id INTEGER PRIMARY KEY AUTOINCREMENT, queued_at REAL, topic TEXT, payload BLOB, retain INTEGER, qos INTEGER, claimed_at REAL)")
+        if "claimed_at" not in [column[1] for column in db.execute("PRAGMA table_info(messages)")]:
+            # Journals written by older versions
+            db.execute("ALTER TABLE messages ADD COLUMN claimed_at REAL")
+        db_pid = os.getpid()
+    return db
+
+
+def __trim(conn, now):
+    """
+    Drops messages beyond MQTT_JOURNAL_MAX_AGE_SEC and MQTT_JOURNAL_MAX_MB. Returns how many were dropped
+    """
+    global next_trim
+    next_trim = now + TRIM_INTERVAL_SEC
+    dropped = conn.execute("DELETE FROM messages WHERE queued_at < ?", (now - CONFIG.mqtt_journal_max_age_sec,)).rowcount
+
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    max_pages = CONFIG.mqtt_journal_max_mb * 1024 * 1024 / page_size
+    while conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0] > max_pages:
+        # Drop the oldest tenth until we're under the limit. Freed pages are reused, so the file itself doesn't shrink
+        count = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if count == 0:
+            break
+        dropped += conn.execute("DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY id LIMIT ?)", (max(1, count // 10),)).rowcount
+
+    if dropped > 0:
+        # Only the main MQTT server uses the journal
+        metrics.MQTT_MESSAGES.labels("dropped", "main").inc(dropped)
+        logger.warning("Dropped {dropped} messages from the journal as it's over its size or age limit".format(dropped=dropped))
+    return dropped
+
+
+def write(messages):
+    """
+    Appends messages to the journal
+    :param messages: a list of (topic, payload, retain, qos, time.time queued)
+    """
+    with db_lock:
+        conn = __get_db()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO messages (topic, payload, retain, qos, queued_at) VALUES (?, ?, ?, ?, ?)",
+                             [(topic, payload, int(retain), qos, queued_at) for topic, payload, retain, qos, queued_at in messages])
+            now = time.time()
+            if now >= next_trim:
+                __trim(conn, now)
+    metrics.MQTT_MESSAGES.labels("journaled", "main").inc(len(messages))
+
+
+def claim(limit):
+    """
+    Marks the oldest unclaimed messages as claimed and returns them, so that if multiple workers share the journal each message is only
+    replayed once. Claimed messages stay in the journal until they're deleted (once they've been sent) or unclaimed (if they weren't)
+    :param limit: the most messages to claim
+    :return: a list of (id, topic, payload, retain, qos, time.time queued)
+    """
+    with db_lock:
+        conn = __get_db()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            if now >= next_trim:
+                __trim(conn, now)
+            rows = conn.execute("SELECT id, topic, payload, retain, qos, queued_at FROM messages WHERE claimed_at IS NULL OR claimed_at < ? "
+                                "ORDER BY id LIMIT ?", (now - CLAIM_TIMEOUT_SEC, limit)).fetchall()
+            conn.executemany("UPDATE messages SET claimed_at = ? WHERE id = ?", [(now, row[0]) for row in rows])
+    return [(message_id, topic, payload, bool(retain), qos, queued_at) for message_id, topic, payload, retain, qos, queued_at in rows]
+
+
+def delete(message_ids):
+    """
+    Deletes claimed messages that have been sent
+    """
+    with db_lock:
+        conn = __get_db()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("DELETE FROM messages WHERE id = ?", [(message_id,) for message_id in message_ids])
+
+
+def unclaim(message_ids):
+    """
+    Hands back claimed messages that weren't sent, so they're replayed again in their original place
+    """
+    with db_lock:
+        conn = __get_db()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("UPDATE messages SET claimed_at = NULL WHERE id = ?", [(message_id,) for message_id in message_ids])
+
+
+def is_empty():
+    """
+    Returns True if the journal has no messages, including ones claimed by other workers
+    """
+    with db_lock:
+        return __get_db().execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None
+
+
+if is_enabled():
+    logger.info("Messages will be written to {file} while the MQTT server is unavailable".format(file=CONFIG.mqtt_journal_file))
@@ -0,0 +1,152 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import metrics
+from config import CONFIG
+from loguru import logger
+
+
+# The sensors this process knows we've sent config for -> the digest of the config we sent. With the sqlite backend this acts as a cache in
+# front of the db
+known_sensors = {}
+known_sensors_lock = threading.Lock()
+
+# The sqlite connection and the pid it was opened in. sqlite connections can't be shared across a fork, so each process opens its own
+db = None
+db_pid = None
+
+# After HA's birth message, a config claimed by one process to be sent again (see claim_known_sensor) isn't claimed by another for this
+# long, so with multiple workers sharing KNOWN_SENSORS_CACHE_FILE each config is only sent once
+REPUBLISH_CLAIM_SEC = 10
+
+
+def __is_persisted():
+    """
+    Returns True if known sensors are kept in KNOWN_SENSORS_CACHE_FILE. With KNOWN_SENSORS_WARM_START=snapshot they're kept there so the
+    next run can start with them, whichever backend is used
+    """
+    return CONFIG.known_sensors_backend == "sqlite" or CONFIG.known_sensors_warm_start == "snapshot"
+
+
+def __get_db():
+    """
+    Returns the sqlite connection for this process, opening it if required
+    """
+    global db, db_pid
+    if db is None or db_pid != os.getpid():
+        db = sqlite3.connect(CONFIG.known_sensors_cache_file, timeout=10, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS known_sensors (sensor_id TEXT PRIMARY KEY, digest TEXT, claimed_at REAL)")
+        # Cache files written by older versions don't have the newer columns
+        columns = [row[1] for row in db.execute("PRAGMA table_info(known_sensors)")]
+        if "digest" not in columns:
+            db.execute("ALTER TABLE known_sensors ADD COLUMN digest TEXT")
+        if "claimed_at" not in columns:
+            db.execute("ALTER TABLE known_sensors ADD COLUMN claimed_at REAL")
+        db_pid = os.getpid()
+    return db
+
+
+def digest(payload):
+    """
+    Returns a short hash of a config payload, so a config that's changed since we sent it is sent again
+    """
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+
+def __clear():
+    """
+    Removes all known sensors
+    """
+    with known_sensors_lock:
+        known_sensors.clear()
+        metrics.KNOWN_SENSORS.set(0)
+        if __is_persisted():
+            __get_db().execute("DELETE FROM known_sensors")
+
+
+def reset():
+    """
+    Removes any known sensors left over from a previous run, unless KNOWN_SENSORS_WARM_START=snapshot
+    """
+    if CONFIG.known_sensors_warm_start == "snapshot":
+        count = __get_db().execute("SELECT COUNT(*) FROM known_sensors").fetchone()[0]
+        logger.info("Keeping {count} known sensors from the previous KNOWN_SENSORS_CACHE_FILE".format(count=count))
+        return
+
+    if CONFIG.known_sensors_backend == "sqlite":
+        logger.info("Clearing previous KNOWN_SENSORS_CACHE_FILE")
+    __clear()
+
+
+def clear_known_sensors():
+    """
+    Clears out the known sensors so the config will be sent to Home Assistant next message. Sensors another process has just claimed to
+    send again (see claim_known_sensor) are kept in KNOWN_SENSORS_CACHE_FILE, as each worker clears them when HA comes online
+    """
+    logger.info("Clearing out known sensors")
+    with known_sensors_lock:
+        known_sensors.clear()
+        metrics.KNOWN_SENSORS.set(0)
+        if __is_persisted():
+            __get_db().execute("DELETE FROM known_sensors WHERE claimed_at IS NULL OR claimed_at < ?", (time.time() - REPUBLISH_CLAIM_SEC,))
+
+
+def claim_known_sensor(sensor_id, config_digest=None):
+    """
+    Adds a known sensor after HA comes online, returning True if this process should send its config again. With KNOWN_SENSORS_CACHE_FILE
+    shared between workers, only the first to claim it within REPUBLISH_CLAIM_SEC does
+    :param config_digest: the digest of the config we're sending (see digest)
+    """
+    with known_sensors_lock:
+        known_sensors[sensor_id] = config_digest
+        metrics.KNOWN_SENSORS.set(len(known_sensors))
+        if not __is_persisted():
+            return True
+
+        now = time.time()
+        db = __get_db()
+        db.execute("INSERT OR IGNORE INTO known_sensors (sensor_id) VALUES (?)", (sensor_id,))
+        claimed = db.execute("UPDATE known_sensors SET digest = ?, claimed_at = ? WHERE sensor_id = ? AND (claimed_at IS NULL OR claimed_at < ?)",
+                             (config_digest, now, sensor_id, now - REPUBLISH_CLAIM_SEC)).rowcount == 1
+        if not claimed:
+            # Use the digest of the config the other process is sending
+            known_sensors[sensor_id] = db.execute("SELECT digest FROM known_sensors WHERE sensor_id = ?", (sensor_id,)).fetchone()[0]
+        return claimed
+
+
+def add_known_sensor(sensor_id, config_digest=None):
+    """
+    Adds a known sensor
+    :param config_digest: the digest of the config we sent (see digest)
+    """
+    with known_sensors_lock:
+        known_sensors[sensor_id] = config_digest
+        metrics.KNOWN_SENSORS.set(len(known_sensors))
+        if __is_persisted():
+            # Keeps claimed_at, so a config claimed by another process isn't claimed again once it's sent
+            __get_db().execute("INSERT INTO known_sensors (sensor_id, digest) VALUES (?, ?) "
+                               "ON CONFLICT (sensor_id) DO UPDATE SET digest = excluded.digest", (sensor_id, config_digest))
+
+
+def is_known_sensor(sensor_id, config_digest=None):
+    """
+    Returns True if we've already sent the config for sensor_id
+    :param config_digest: if set, only returns True if the config we sent had this digest
+    """
+    # Dict lookups are atomic, so the common case doesn't need the lock
+    if sensor_id in known_sensors and (config_digest is None or known_sensors.get(sensor_id) == config_digest):
+        return True
+
+    if not __is_persisted():
+        return False
+
+    # Another process (or, with KNOWN_SENSORS_WARM_START=snapshot, a previous run) may have already sent the config
+    with known_sensors_lock:
+        row = __get_db().execute("SELECT digest FROM known_sensors WHERE sensor_id = ?", (sensor_id,)).fetchone()
+        if row is not None and (config_digest is None or row[0] == config_digest):
+            known_sensors[sensor_id] = row[0]
+            return True
+    return False
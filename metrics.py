@@ -0,0 +1,73 @@
+import threading
+from config import CONFIG
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+
+# Most of our timings are well under a millisecond
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+GENERATE_SECONDS = Histogram("ambientweather_generate_seconds", "Time spent parsing and converting a request in generate_sensor_dict",
+                             buckets=FAST_BUCKETS)
+DISCOVERY_PUBLISH_SECONDS = Histogram("ambientweather_discovery_publish_seconds", "Time spent sending a single HA discovery config",
+                                      buckets=FAST_BUCKETS)
+MQTT_PUBLISH_LATENCY_SECONDS = Histogram("ambientweather_mqtt_publish_latency_seconds",
+                                         "Time a message waited in the publish queue before being handed to the MQTT client",
+                                         ["broker"], buckets=FAST_BUCKETS + (2.5, 10.0, 60.0))
+
+STATION_REQUESTS = Counter("ambientweather_station_requests", "Requests received from each station (up to METRICS_MAX_STATIONS)", ["mac"])
+UNKNOWN_ARGS = Counter("ambientweather_unknown_args", "Arguments received that aren't a known sensor (up to METRICS_MAX_UNKNOWN_ARGS)", ["key"])
+MQTT_RECONNECTS = Counter("ambientweather_mqtt_reconnects", "Times the MQTT client reconnected to the MQTT server", ["broker"])
+MQTT_MESSAGES = Counter("ambientweather_mqtt_messages", "Messages queued to be published, by what happened to them", ["result", "broker"])
+
+MQTT_QUEUE_DEPTH = Gauge("ambientweather_mqtt_queue_depth", "Messages waiting in the publish queue", ["broker"], multiprocess_mode="livesum")
+MQTT_CLIENT_QUEUE_DEPTH = Gauge("ambientweather_mqtt_client_queue_depth", "Messages waiting in the MQTT client to be sent (or acknowledged)",
+                                ["broker"], multiprocess_mode="livesum")
+KNOWN_SENSORS = Gauge("ambientweather_known_sensors", "Sensors we've sent the HA config for", multiprocess_mode="max")
+
+# The label used for the values (ex: stations) beyond a metric's limit
+OTHER = "other"
+
+# The stations STATION_REQUESTS has a label for, and the arguments UNKNOWN_ARGS has a label for
+station_labels = set()
+unknown_arg_labels = set()
+labels_lock = threading.Lock()
+
+
+def __capped_label(labels, value, limit):
+    """
+    Returns the label to count value under: the value itself for the first limit values, OTHER for any others. Each label is a
+    separate time series, and anyone who can reach us can send new values
+    :param labels: the values that have their own label so far
+    """
+    if value not in labels:
+        with labels_lock:
+            if value not in labels:
+                if len(labels) >= limit:
+                    return OTHER
+                labels.add(value)
+    return value
+
+
+def count_station_request(mac_sanitized):
+    """
+    Counts a request from a station. The first METRICS_MAX_STATIONS stations get their own label
+    """
+    STATION_REQUESTS.labels(__capped_label(station_labels, mac_sanitized, CONFIG.metrics_max_stations)).inc()
+
+
+def count_unknown_arg(key):
+    """
+    Counts an argument that isn't a known sensor. The first METRICS_MAX_UNKNOWN_ARGS arguments get their own label
+    """
+    UNKNOWN_ARGS.labels(__capped_label(unknown_arg_labels, key, CONFIG.metrics_max_unknown_args)).inc()
+
+
+def generate():
+    """
+    Returns the metrics in the Prometheus text format along with its content type
+    """
+    if CONFIG.prometheus_multiproc_dir is not None:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,107 +1,680 @@
-import os
-import sys
+import time
+import threading
+import dedup
+import journal
+import metrics
 import paho.mqtt.client as mqtt
+from collections import deque
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from config import CONFIG, parse_brokers
 from loguru import logger
-from app import HA_BIRTH_TOPIC, HA_BIRTH_TOPIC_ONLINE, SEND_HA_DISCOVERY_CONFIG
 
-# Env vars
-MQTT_HOST = os.getenv("MQTT_HOST", None)
-MQTT_PORT = int(os.getenv("MQTT_PORT", 0))
 
-MQTT_USERNAME = os.getenv("MQTT_USERNAME", None)
-MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", None)
-MQTT_KEEPALIVE_SEC = int(os.getenv("MQTT_KEEPALIVE_SEC", 60))
-MQTT_PREFIX = os.getenv("MQTT_PREFIX", "ambientweather")
-MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID", "ambientweather")
+# How many seconds of publishes the published_per_sec stat is averaged over
+RATE_WINDOW_SEC = 60
 
-# Topics...
-MQTT_TOPIC_ONLINE = os.getenv("MQTT_TOPIC_ONLINE", "online")
+# How often (in seconds) the publisher checks whether the MQTT client has room for more messages. paho doesn't tell us when it does
+BACKPRESSURE_POLL_SEC = 0.01
+# How often (in seconds) to check whether another worker has finished replaying the journal
+JOURNAL_POLL_SEC = 1
 
-# Required var validation
-if MQTT_HOST is None or MQTT_HOST == "":
-    logger.error("No MQTT_HOST provided")
-    sys.exit(1)
-if MQTT_PORT == 0:
-    logger.error("No MQTT_PORT provided")
-    sys.exit(1)
+# CONNACK reason codes for a server that doesn't support MQTT 5: 3.1.1's "unacceptable protocol version" and 5's "unsupported protocol version"
+UNSUPPORTED_PROTOCOL_CODES = (1, 132)
 
 
-# The global mqtt client
-mqtt_client = None
+def expires_in(latency):
+    """
+    Returns how many seconds a reading that's been waiting latency seconds has left before it expires (MQTT_MESSAGE_EXPIRY_SEC), or
+    None if readings don't expire
+    """
+    if CONFIG.mqtt_message_expiry_sec <= 0:
+        return None
+    # An interval of 0 would mean it never expires
+    return max(1, int(CONFIG.mqtt_message_expiry_sec - latency))
+
+
+class Broker:
+    """
+    An MQTT server we publish to. Each has its own client, publish queue and publisher thread, so a slow or unavailable server
+    never holds up the others (or requests)
+    """
+    def __init__(self, target, journaled=False):
+        """
+        :param target: the config.BrokerTarget to publish to
+        :param journaled: whether messages are written to the journal while the server is unavailable (only one server can use it)
+        """
+        self.target = target
+        self.name = target.name
+        self.client = None
+        # Whether the client has connected before (so we can count reconnects)
+        self.has_connected = False
+        # How many times the client has connected. paho drops the QoS 0 messages it hadn't sent when it reconnects
+        self.connections = 0
+        self.protocol = mqtt.MQTTv5 if CONFIG.mqtt_protocol == "5" else mqtt.MQTTv311
+        self.client_id_suffix = ""
+        # Whether the server has answered a CONNECT. Until it has, a connection closed while waiting for the CONNACK with MQTT 5 is taken to
+        # mean the server doesn't support it
+        self.connack_received = False
+
+        # MQTT 5 topic aliases. They only last for a connection, so they're reset whenever we (re)connect
+        # Reentrant as paho may call on_disconnect (which resets them) from within publish
+        self.alias_lock = threading.RLock()
+        # Counts resets, so an alias isn't kept if the connection was lost while defining it
+        self.alias_generation = 0
+        # How many aliases we can use on this connection (the lower of MQTT_TOPIC_ALIASES and what the server allows)
+        self.alias_max = 0
+        # topic -> its alias
+        self.aliases = {}
+        # Topics published once on this connection. A topic gets an alias when it's published again, so one-off topics don't use them up
+        self.alias_candidates = set()
+
+        # Messages waiting to be published by the publisher thread. Each is a list: [topic, payload, retain, qos, time queued]
+        self.queue = deque()
+        # topic -> the waiting message for that topic (only used when coalescing)
+        self.queue_topics = {}
+        self.condition = threading.Condition()
+        self.publisher_thread = None
+        self.journaled = journaled
+        # Whether messages are going to the journal. Set until a replay finds the journal empty, so messages are published in order
+        # Starts set so anything left in the journal from a previous run is replayed first
+        self.journal_pending = journaled
+        # Messages waiting to be written to the journal by the publisher thread, so requests don't wait on sqlite. Each is a tuple:
+        # (topic, payload, retain, qos, time.time queued)
+        self.journal_batch = []
+        # (journal message id, MQTTMessageInfo, connections when it was published) of replayed messages the MQTT client hasn't sent (or had
+        # acknowledged, for QoS 1 and 2) yet. Only used by the publisher thread
+        self.replaying = []
+
+        # [int(time.monotonic()), messages published in that second] for the last RATE_WINDOW_SEC seconds
+        self.rate = deque(maxlen=RATE_WINDOW_SEC)
+        self.stats = {
+            "queued": 0,  # Messages added to the queue
+            "published": 0,  # Messages handed to the MQTT client
+            "failed": 0,  # Messages the MQTT client refused (ex: its own queue is full)
+            "dropped": 0,  # Messages dropped as the queue was full
+            "coalesced": 0,  # Messages replaced by a newer message for the same topic
+            "journaled": 0,  # Messages written to the journal while the MQTT server was unavailable
+            "replayed": 0,  # Messages read back from the journal (and handed to the MQTT client)
+            "latency_sum_sec": 0.0,  # Total time messages waited in the queue
+            "latency_max_sec": 0.0,  # Longest time a message waited in the queue
+        }
+
+    def __on_connect(self, client, userdata, flags, rc, properties=None):
+        """
+        The callback for when the client receives a CONNACK response from the server
+        """
+        logger.info("Connected to {name} ({protocol}) with result code {rc}".format(name=self.name, protocol=self.protocol_name(), rc=str(rc)))
+        if self.fall_back(rc):
+            self.__start_replacing_client(client)
+            return
+        self.reset_aliases(properties)
+
+        if rc == 0:
+            if self.has_connected:
+                metrics.MQTT_RECONNECTS.labels(self.name).inc()
+                # Payloads and field values published while the connection was going down may not have arrived
+                dedup.forget_all()
+            self.has_connected = True
+            self.connections += 1
+            # Set as retain so anyone wondering if the device is online or not knows regardles of whether they were listening at the time
+            self.publish_now(CONFIG.mqtt_topic_online, "online", retain=True)
+            # Start replaying the journal now rather than waiting for the next message
+            if self.journal_pending:
+                self.__ensure_publisher()
+
+        # We subscribe during the on_connect callback to be more resilient to connect/disconnects
+        if self.target.ha and bool(CONFIG.send_ha_discovery_config):
+            logger.info("Subscribing to HA Birth topic: {topic}".format(topic=CONFIG.ha_birth_topic))
+            self.subscribe(CONFIG.ha_birth_topic)
+            if CONFIG.known_sensors_warm_start == "retained":
+                from discovery import start_warm_start
+                start_warm_start(self)
+
+    def __on_disconnect(self, client, userdata, rc, properties=None):
+        """
+        The callback for when the connection is lost (or closed)
+        """
+        self.reset_aliases()
+        if self.fall_back_on_close():
+            self.__start_replacing_client(client)
+
+    def protocol_name(self):
+        """
+        Returns the MQTT version we're using, for logs
+        """
+        return "MQTT 5" if self.protocol == mqtt.MQTTv5 else "MQTT 3.1.1"
+
+    def fall_back(self, rc):
+        """
+        Switches to MQTT 3.1.1 if the server refused the connection as it doesn't support MQTT 5. Called with each CONNACK
+        :return: True if we switched, so the client should be replaced with a 3.1.1 one
+        """
+        if self.protocol != mqtt.MQTTv5 or rc not in UNSUPPORTED_PROTOCOL_CODES:
+            self.connack_received = True
+            return False
+        logger.warning("{name} doesn't support MQTT 5. Falling back to MQTT 3.1.1".format(name=self.name))
+        self.protocol = mqtt.MQTTv311
+        return True
+
+    def fall_back_on_close(self):
+        """
+        Switches to MQTT 3.1.1 if the connection was closed before the server ever answered with a CONNACK. Some servers that don't support
+        MQTT 5 close the connection (or never answer, until the keepalive times out) rather than refusing it
+        :return: True if we switched, so the client should be replaced with a 3.1.1 one
+        """
+        if self.protocol != mqtt.MQTTv5 or self.connack_received:
+            return False
+        logger.warning("{name} closed the connection without answering an MQTT 5 CONNECT. Falling back to MQTT 3.1.1".format(name=self.name))
+        self.protocol = mqtt.MQTTv311
+        return True
+
+    def __start_replacing_client(self, client):
+        """
+        Replaces the client with one using self.protocol. A client can't change its protocol, and its network thread can't stop itself
+        """
+        threading.Thread(target=self.__replace_client, args=(client,), name="mqtt-fallback-" + self.name, daemon=True).start()
+
+    def __replace_client(self, client):
+        """
+        Stops the client and connects with a new one using self.protocol
+        """
+        client.disconnect()
+        client.loop_stop()
+        self.connect(self.client_id_suffix)
+
+    def reset_aliases(self, properties=None):
+        """
+        Forgets the topic aliases of the previous connection and, once connected, reads how many the server allows
+        :param properties: the CONNACK properties (MQTT 5)
+        """
+        with self.alias_lock:
+            self.aliases.clear()
+            self.alias_candidates.clear()
+            self.alias_max = 0
+            self.alias_generation += 1
+            if properties is None or self.protocol != mqtt.MQTTv5:
+                return
+
+            # Servers that don't send a topic alias maximum don't accept aliases
+            self.alias_max = min(CONFIG.mqtt_topic_aliases, getattr(properties, "TopicAliasMaximum", 0))
+            # The server's receive maximum is how many QoS 1/2 messages it can take before acknowledging them
+            receive_maximum = getattr(properties, "ReceiveMaximum", None)
+            if receive_maximum is not None and self.client is not None:
+                self.client.max_inflight_messages_set(min(CONFIG.mqtt_max_inflight, receive_maximum))
+
+    def __on_message(self, client, userdata, msg):
+        """
+        The callback when we receive a message
+        """
+        topic = msg.topic
+        # Configs retained by a previous run (KNOWN_SENSORS_WARM_START=retained)
+        if msg.retain and topic != CONFIG.ha_birth_topic:
+            from discovery import on_retained_config
+            on_retained_config(topic, msg.payload)
+            return
+
+        payload = msg.payload.decode("utf-8")
+        logger.debug("Received message on topic: {topic} with payload: {payload}".format(topic=topic, payload=payload))
+
+        if topic == CONFIG.ha_birth_topic:
+            logger.debug("Received HA_BIRTH_TOPIC message")
+            if payload == CONFIG.ha_birth_topic_online:
+                logger.info("We have a home assistant online message, we're re-sending all sensor configs")
+                from discovery import republish_all
+                republish_all()
+
+    def connect(self, client_id_suffix=""):
+        """
+        Connect to the MQTT server
+        Connects in the background so we can receive readings while the MQTT server is (re)starting. They're queued until we're connected
+        :param client_id_suffix: added to the Client ID. Each process needs its own ID as the server disconnects duplicates
+        """
+        target = self.target
+        self.client_id_suffix = client_id_suffix
+        client_id = target.client_id + client_id_suffix
+        logger.debug("Attempting to connect to the MQTT server {name} ({host}:{port}) as {client_id}".format(
+            name=self.name, host=target.host, port=target.port, client_id=client_id))
+        self.client = mqtt.Client(client_id=client_id, protocol=self.protocol)
+        self.client.will_set("{prefix}/{topic}".format(prefix=target.prefix, topic=CONFIG.mqtt_topic_online), "offline", retain=True)
+        self.client.on_connect = self.__on_connect
+        self.client.on_disconnect = self.__on_disconnect
+        self.client.on_message = self.__on_message
+
+        if target.username is not None or target.password is not None:
+            logger.debug("Using auth ({user}:****)".format(user=target.username))
+            self.client.username_pw_set(target.username, target.password)
+
+        self.client.max_inflight_messages_set(CONFIG.mqtt_max_inflight)
+        # Only bounds QoS 1/2 messages. Messages it refuses are counted as failed. QoS 0 messages are held back by the publisher instead
+        # (see client_buffered)
+        self.client.max_queued_messages_set(CONFIG.mqtt_queue_size)
+        # Each client backs off on its own, so a server that's down doesn't slow reconnecting to the others
+        self.client.reconnect_delay_set(CONFIG.mqtt_reconnect_min_sec, CONFIG.mqtt_reconnect_max_sec)
+
+        # The network thread keeps retrying until the MQTT server accepts the connection
+        self.client.connect_async(target.host, target.port, CONFIG.mqtt_keepalive_sec)
+        self.client.loop_start()
+
+        logger.debug("Done")
+        return self.client
+
+    def wants(self, topic):
+        """
+        Returns True if messages to the topic (before the prefix) are sent to this server
+        """
+        if self.target.topics is None:
+            return True
+        return any(mqtt.topic_matches_sub(topic_filter, topic) for topic_filter in self.target.topics)
+
+    def prepare(self, messages, insert_prefix):
+        """
+        Returns the messages this server wants, with the prefix added to their topic if insert_prefix is set
+        :param messages: a list of (topic, payload, retain)
+        """
+        if self.target.topics is not None:
+            messages = [message for message in messages if self.wants(message[0])]
+
+        if insert_prefix:
+            messages = [("{prefix}/{topic}".format(prefix=self.target.prefix, topic=topic), payload, retain) for topic, payload, retain in messages]
+        return messages
+
+    def publish_many(self, messages, insert_prefix=True, qos=None):
+        """
+        Queues multiple messages to be published by the publisher thread, taking the queue's lock once
+        :param messages: a list of (topic, payload, retain)
+        :param qos: the QoS to publish with (default: the server's QoS)
+        """
+        if qos is None:
+            qos = self.target.qos
+
+        messages = self.prepare(messages, insert_prefix)
+        if len(messages) == 0:
+            return True
+
+        self.__ensure_publisher()
+        with self.condition:
+            if self.journaled and (self.journal_pending or not self.is_connected()):
+                self.__add_to_journal(messages, qos)
+                self.condition.notify()
+                return True
+
+            for topic, payload, retain in messages:
+                self.__enqueue(topic, payload, retain, qos)
+            metrics.MQTT_QUEUE_DEPTH.labels(self.name).set(len(self.queue))
+            self.condition.notify()
+        return True
+
+    def __add_to_journal(self, messages, qos):
+        """
+        Hands messages to the publisher thread to write to the journal, along with any still waiting in the queue (as they're older).
+        Must be called with the condition held so messages reach the journal in order
+        """
+        now = time.time()
+        monotonic_now = time.monotonic()
+        waiting = [(topic, payload, retain, message_qos, now - (monotonic_now - queued_at))
+                   for topic, payload, retain, message_qos, queued_at in self.queue]
+        self.queue.clear()
+        self.queue_topics.clear()
+        metrics.MQTT_QUEUE_DEPTH.labels(self.name).set(0)
+
+        if not self.journal_pending:
+            logger.warning("The MQTT server {name} is unavailable. Writing messages to the journal until it's back".format(name=self.name))
+        self.journal_pending = True
+        self.journal_batch.extend(waiting)
+        self.journal_batch.extend((topic, payload, retain, qos, now) for topic, payload, retain in messages)
+        self.stats["queued"] += len(messages)
+        self.stats["journaled"] += len(waiting) + len(messages)
+
+    def __enqueue(self, topic, payload, retain, qos):
+        """
+        Adds a message to the publish queue. Must be called with the condition held
+        """
+        self.stats["queued"] += 1
+
+        if CONFIG.mqtt_queue_overflow == "coalesce":
+            waiting = self.queue_topics.get(topic)
+            if waiting is not None:
+                # Replace the payload but keep its place in the queue
+                waiting[1] = payload
+                waiting[2] = retain
+                waiting[3] = qos
+                self.stats["coalesced"] += 1
+                metrics.MQTT_MESSAGES.labels("coalesced", self.name).inc()
+                return
+
+        if len(self.queue) >= CONFIG.mqtt_queue_size:
+            dropped = self.queue.popleft()
+            self.queue_topics.pop(dropped[0], None)
+            self.stats["dropped"] += 1
+            metrics.MQTT_MESSAGES.labels("dropped", self.name).inc()
+            logger.warning("Publish queue for {name} is full. Dropped message to {topic}".format(name=self.name, topic=dropped[0]))
+            self.forget_published(dropped[0])
 
+        message = [topic, payload, retain, qos, time.monotonic()]
+        self.queue.append(message)
+        if CONFIG.mqtt_queue_overflow == "coalesce":
+            self.queue_topics[topic] = message
 
-# The callback for when the client receives a CONNACK response from the server.
-def __on_connect(client, userdata, flags, rc):
-    logger.info("Connected with result code {rc}".format(rc=str(rc)))
+    def publish_now(self, topic, payload, insert_prefix=True, retain=False, qos=0, expiry_sec=None):
+        """
+        Publishes a message immediately from the calling thread, returning the MQTTMessageInfo
+        :param expiry_sec: with MQTT 5, the server drops the message if it hasn't delivered it within this many seconds (see expires_in)
+        """
+        if self.client is None:
+            logger.error("Can't publish message as mqtt client is not established")
+            return False, "No mqtt client established"
 
-    if rc == 0:
-        # Set as retain so anyone wondering if the device is online or not knows regardles of whether they were listening at the time
-        publish(MQTT_TOPIC_ONLINE, "online", retain=True)
+        if insert_prefix:
+            topic = "{prefix}/{topic}".format(prefix=self.target.prefix, topic=topic)
 
-    # We subscribe during the on_connect callback to be more resilient to connect/disconnects
-    if bool(SEND_HA_DISCOVERY_CONFIG):
-        logger.info("Subscribing to HA Birth topic: {topic}".format(topic=HA_BIRTH_TOPIC))
-        subscribe(HA_BIRTH_TOPIC)
+        if CONFIG.debug:
+            logger.debug("Publishing message to {} on {} (payload: {})", topic, self.name, payload)
+        if self.protocol != mqtt.MQTTv5:
+            return self.client.publish(topic, payload, qos=qos, retain=retain)
 
+        properties = Properties(PacketTypes.PUBLISH)
+        if expiry_sec is not None:
+            properties.MessageExpiryInterval = expiry_sec
+        # QoS 1/2 messages can be re-sent on a new connection, where the alias wouldn't be defined
+        if qos > 0 or self.alias_max == 0:
+            return self.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
 
-# The callback when we receive a message
-def __on_message(client, userdata, msg):
-    topic = msg.topic
-    payload = msg.payload.decode("utf-8")
-    logger.debug("Received message on topic: {topic} with payload: {payload}".format(topic=topic, payload=payload))
+        # Held while publishing so the message defining an alias is sent before any that use it
+        with self.alias_lock:
+            alias = self.aliases.get(topic)
+            if alias is not None:
+                properties.TopicAlias = alias
+                return self.client.publish("", payload, qos=qos, retain=retain, properties=properties)
 
-    if topic == HA_BIRTH_TOPIC:
-        logger.debug("Received HA_BIRTH_TOPIC message")
-        if payload == HA_BIRTH_TOPIC_ONLINE:
-            logger.info("We have a home assistant online message, we're clearing out known sensors")
-            from app import clear_known_sensors
-            clear_known_sensors()
+            if topic not in self.alias_candidates or len(self.aliases) >= self.alias_max:
+                if len(self.aliases) < self.alias_max:
+                    self.alias_candidates.add(topic)
+                return self.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
 
+            # Published before, so it's likely to be published again. Define its alias along with this message
+            properties.TopicAlias = len(self.aliases) + 1
+            generation = self.alias_generation
+            info = self.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS and generation == self.alias_generation:
+                self.aliases[topic] = properties.TopicAlias
+                self.alias_candidates.discard(topic)
+                if len(self.aliases) >= self.alias_max:
+                    self.alias_candidates.clear()
+            return info
 
-# Connect to the MQTT server
-def connect():
+    def is_connected(self):
+        """
+        Returns True if the MQTT client is connected to the MQTT server
+        """
+        return self.client is not None and self.client.is_connected()
+
+    def client_buffered(self):
+        """
+        Returns how many messages are waiting in the MQTT client: being written to the socket, or waiting to be acknowledged (QoS 1/2)
+        """
+        # paho doesn't expose the size of its outbound buffers, so read its (private) ones if they're there
+        return len(getattr(self.client, "_out_packet", ())) + len(getattr(self.client, "_out_messages", ()))
+
+    def __ensure_publisher(self):
+        """
+        Starts the publisher thread if it isn't running in this process (threads don't survive a fork)
+        """
+        if self.publisher_thread is not None and self.publisher_thread.is_alive():
+            return
+        with self.condition:
+            if self.publisher_thread is None or not self.publisher_thread.is_alive():
+                self.publisher_thread = threading.Thread(target=self.__publisher, name="mqtt-publisher-" + self.name, daemon=True)
+                self.publisher_thread.start()
+
+    def __publisher(self):
+        """
+        Publishes queued messages, replaying the journal first if it has messages. While the MQTT client isn't connected, messages stay queued
+        (or are written to the journal). While it has MQTT_CLIENT_BUFFER_SIZE messages waiting to be sent, they stay queued too
+        """
+        while True:
+            with self.condition:
+                while len(self.journal_batch) == 0 and (len(self.replaying) == 0 or self.is_connected()) and (
+                        not self.is_connected() or (len(self.queue) == 0 and not self.journal_pending)
+                        or self.client_buffered() >= CONFIG.mqtt_client_buffer_size):
+                    # Wake up periodically as nothing notifies us when the client connects (or has sent its buffered messages)
+                    held_back = self.is_connected() and (len(self.queue) > 0 or self.journal_pending)
+                    self.condition.wait(timeout=BACKPRESSURE_POLL_SEC if held_back else 1)
+
+                batch = self.journal_batch
+                if len(batch) > 0:
+                    self.journal_batch = []
+                    message = None
+                elif len(self.queue) == 0 or not self.is_connected():
+                    message = None
+                else:
+                    message = self.queue.popleft()
+                    self.queue_topics.pop(message[0], None)
+                    metrics.MQTT_QUEUE_DEPTH.labels(self.name).set(len(self.queue))
+
+            if len(batch) > 0:
+                # Only this thread writes to the journal, so the batches are written in order
+                journal.write(batch)
+                continue
+            if message is None:
+                self.__replay_journal()
+                continue
+
+            topic, payload, retain, qos, queued_at = message
+            latency = time.monotonic() - queued_at
+            info = self.publish_now(topic, payload, insert_prefix=False, retain=retain, qos=qos, expiry_sec=expires_in(latency))
+            self.record_publish(topic, info, latency)
+
+    def record_publish(self, topic, info, latency):
+        """
+        Updates the stats for a message handed to the MQTT client
+        """
+        metrics.MQTT_PUBLISH_LATENCY_SECONDS.labels(self.name).observe(latency)
+        metrics.MQTT_CLIENT_QUEUE_DEPTH.labels(self.name).set(self.client_buffered())
+
+        published = isinstance(info, mqtt.MQTTMessageInfo) and info.rc == mqtt.MQTT_ERR_SUCCESS
+        with self.condition:
+            self.stats["latency_sum_sec"] += latency
+            self.stats["latency_max_sec"] = max(self.stats["latency_max_sec"], latency)
+            if published:
+                self.stats["published"] += 1
+                second = int(time.monotonic())
+                if len(self.rate) > 0 and self.rate[-1][0] == second:
+                    self.rate[-1][1] += 1
+                else:
+                    self.rate.append([second, 1])
+                metrics.MQTT_MESSAGES.labels("published", self.name).inc()
+            else:
+                self.stats["failed"] += 1
+                metrics.MQTT_MESSAGES.labels("failed", self.name).inc()
+                logger.warning("Failed to publish message to {topic} on {name}".format(topic=topic, name=self.name))
+        if not published:
+            self.forget_published(topic)
+
+    def forget_published(self, topic):
+        """
+        Called with the topic of a message that didn't reach the server. If it's a station's payload (or one of its fields), it's published
+        again with the next payload even if it's unchanged
+        """
+        prefix = self.target.prefix + "/"
+        if not topic.startswith(prefix):
+            return
+        topic = topic[len(prefix):]
+        mac, _, rest = topic.partition("/")
+        if rest == CONFIG.mqtt_topic_json:
+            dedup.forget_published(mac)
+        else:
+            dedup.forget_field(topic)
+
+    def __replay_journal(self):
+        """
+        Publishes the next chunk of messages from the journal, up to MQTT_CLIENT_BUFFER_SIZE messages waiting in the MQTT client. Messages
+        are only deleted from the journal once they've been sent. Once it's empty, messages go straight to the queue again
+        """
+        self.__settle_replayed()
+        if not self.is_connected():
+            return
+
+        limit = min(CONFIG.mqtt_journal_replay_batch, CONFIG.mqtt_client_buffer_size - self.client_buffered())
+        rows = journal.claim(max(1, limit))
+        if len(rows) == 0:
+            if len(self.replaying) > 0:
+                # Wait for the last chunk to be sent
+                time.sleep(BACKPRESSURE_POLL_SEC)
+                return
+            if not journal.is_empty():
+                # Another worker is replaying the rest
+                time.sleep(JOURNAL_POLL_SEC)
+                return
+            # Messages are only written to the journal by this thread, so it's empty unless some are waiting to be written
+            with self.condition:
+                if len(self.journal_batch) == 0:
+                    self.journal_pending = False
+                    logger.info("Done replaying the journal ({count} messages replayed in total)".format(count=self.stats["replayed"]))
+            return
+
+        for index, (message_id, topic, payload, retain, qos, queued_at) in enumerate(rows):
+            expiry_sec = expires_in(time.time() - queued_at)
+            info = self.publish_now(topic, payload, insert_prefix=False, retain=retain, qos=qos, expiry_sec=expiry_sec)
+            while isinstance(info, mqtt.MQTTMessageInfo) and info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+                # The MQTT client's own queue is full. Wait for it to send some rather than dropping the message
+                time.sleep(0.01)
+                info = self.publish_now(topic, payload, insert_prefix=False, retain=retain, qos=qos, expiry_sec=expiry_sec)
+
+            if not isinstance(info, mqtt.MQTTMessageInfo) or info.rc == mqtt.MQTT_ERR_NO_CONN:
+                # Disconnected part way through. Put the rest back to be replayed once we reconnect
+                journal.unclaim([row[0] for row in rows[index:]])
+                return
+
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self.replaying.append((message_id, info, self.connections))
+            else:
+                # The MQTT client refused it (ex: it's too large), so it would never be sent
+                journal.delete([message_id])
+            with self.condition:
+                self.stats["replayed"] += 1
+            metrics.MQTT_MESSAGES.labels("replayed", self.name).inc()
+            self.record_publish(topic, info, max(0.0, time.time() - queued_at))
+
+    def __settle_replayed(self):
+        """
+        Deletes the replayed messages the MQTT client has sent from the journal. Once it has disconnected, the ones it hadn't sent are
+        handed back to be replayed on the new connection
+        """
+        if len(self.replaying) == 0:
+            return
+        connected = self.is_connected()
+        sent = []
+        unsent = []
+        waiting = []
+        for message in self.replaying:
+            if message[1].is_published():
+                sent.append(message[0])
+            elif not connected or message[2] != self.connections:
+                unsent.append(message[0])
+            else:
+                waiting.append(message)
+        self.replaying = waiting
+
+        if len(sent) > 0:
+            journal.delete(sent)
+        if len(unsent) > 0:
+            journal.unclaim(unsent)
+            logger.info("Disconnected from {name} before {count} replayed messages were sent. They'll be replayed once it's back"
+                        .format(name=self.name, count=len(unsent)))
+
+    def get_stats(self):
+        """
+        Returns the publish queue stats
+        """
+        now = time.monotonic()
+        with self.condition:
+            result = dict(self.stats)
+            result["queue_depth"] = len(self.queue)
+            result["queue_size"] = CONFIG.mqtt_queue_size
+            # How far behind we are: how long the oldest waiting message has been waiting
+            result["lag_sec"] = now - self.queue[0][4] if len(self.queue) > 0 else 0.0
+            recent = sum(count for second, count in self.rate if second > now - RATE_WINDOW_SEC)
+        result["connected"] = self.is_connected()
+        result["protocol"] = "5" if self.protocol == mqtt.MQTTv5 else "3.1.1"
+        result["topic_aliases"] = len(self.aliases)
+        result["published_per_sec"] = recent / RATE_WINDOW_SEC
+        result["latency_avg_sec"] = 0.0
+        if result["published"] + result["failed"] > 0:
+            result["latency_avg_sec"] = result["latency_sum_sec"] / (result["published"] + result["failed"])
+        return result
+
+    def subscribe(self, topic):
+        if self.client is None:
+            logger.error("Can't subscribe to topic as mqtt client is not established")
+            return False, "No mqtt client established"
+
+        logger.info("Subscribing to topic {topic} on {name}".format(topic=topic, name=self.name))
+
+        self.client.subscribe(topic)
+
+
+# The MQTT servers we publish to. The first is the main server (MQTT_HOST), which HA discovery configs are sent to and which uses the journal
+brokers = [Broker(target, journaled=target.ha and journal.is_enabled()) for target in parse_brokers(CONFIG)[0]]
+primary = brokers[0]
+
+
+# Connect to the MQTT servers
+def connect(client_id_suffix=""):
     """
-    Connect to the MQTT server
+    Connects to each MQTT server
+    :param client_id_suffix: added to each server's Client ID. Each process needs its own ID as the server disconnects duplicates
     """
-    logger.debug("Attempting to connect to the MQTT server {host}:{port}".format(host=MQTT_HOST, port=MQTT_PORT))
-    global mqtt_client
-    mqtt_client = mqtt.Client(client_id=MQTT_CLIENT_ID)
-    mqtt_client.will_set("{prefix}/{topic}".format(prefix=MQTT_PREFIX, topic=MQTT_TOPIC_ONLINE), "offline", retain=True)
-    mqtt_client.on_connect = __on_connect
-    mqtt_client.on_message = __on_message
+    for broker in brokers:
+        broker.connect(client_id_suffix)
 
-    if MQTT_USERNAME is not None or MQTT_PASSWORD is not None:
-        logger.debug("Using auth ({user}:****)".format(user=MQTT_USERNAME))
-        mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 
-    mqtt_client.connect(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE_SEC)
-    mqtt_client.loop_start()
+def publish(topic, payload, insert_prefix=True, retain=False, qos=None):
+    """
+    Queues a message to be published to each MQTT server by their publisher threads. This never blocks on the MQTT servers
+    :param qos: the QoS to publish with (default: each server's QoS)
+    """
+    return publish_many([(topic, payload, retain)], insert_prefix=insert_prefix, qos=qos)
 
-    logger.debug("Done")
-    return mqtt_client
 
+def publish_many(messages, insert_prefix=True, qos=None):
+    """
+    Queues multiple messages to be published to each MQTT server (that wants them) by their publisher threads
+    :param messages: a list of (topic, payload, retain)
+    :param qos: the QoS to publish with (default: each server's QoS)
+    """
+    for broker in brokers:
+        broker.publish_many(messages, insert_prefix=insert_prefix, qos=qos)
+    return True
 
-def publish(topic, payload, insert_prefix=True, retain=False):
-    global mqtt_client
 
-    if mqtt_client is None:
-        logger.error("Can't publish message as mqtt client is not established")
-        return False, "No mqtt client established"
+def publish_now(topic, payload, insert_prefix=True, retain=False, qos=0):
+    """
+    Publishes a message to the main MQTT server immediately from the calling thread, returning the MQTTMessageInfo
+    """
+    return primary.publish_now(topic, payload, insert_prefix=insert_prefix, retain=retain, qos=qos)
 
-    if insert_prefix:
-        topic = "{prefix}/{topic}".format(prefix=MQTT_PREFIX, topic=topic)
 
-    logger.info("Publishing message to {topic} (payload: {payload})".format(topic=topic, payload=payload))
-    mqtt_client.publish(topic, payload, retain=retain)
+def is_connected():
+    """
+    Returns True if we're connected to the main MQTT server
+    """
+    return primary.is_connected()
 
 
-def subscribe(topic):
-    global mqtt_client
+def get_stats():
+    """
+    Returns the publish queue stats of the main MQTT server
+    """
+    return primary.get_stats()
 
-    if mqtt_client is None:
-        logger.error("Can't subscribe to topic as mqtt client is not established")
-        return False, "No mqtt client established"
 
-    logger.info("Subscribing to topic {topic}".format(topic=topic))
+def get_broker_stats():
+    """
+    Returns the publish queue stats of each MQTT server: name -> stats
+    """
+    return {broker.name: broker.get_stats() for broker in brokers}
 
-    mqtt_client.subscribe(topic)
+
+def subscribe(topic):
+    return primary.subscribe(topic)
@@ -0,0 +1,93 @@
+import metrics
+from sensors import SENSOR_CHANNELS, LEAK_CHANNELS
+from loguru import logger
+
+
+# Ecowitt gateways (and Ambient Weather stations set to the Ecowitt protocol) POST a form with mostly the same arguments as Ambient Weather
+# Reference: https://www.ecowitt.com/shop/forum/forumDetails/255
+# Ecowitt argument -> Ambient Weather argument
+ECOWITT_ARGS = {
+    # Ecowitt's hourlyrainin is the rain over the last hour, not a rate. The rate is sent as rainratein
+    "rainratein": "hourlyrainin",
+    "pm25_ch1": "pm25",
+    "pm25_avg_24h_ch1": "pm25_24h",
+}
+ECOWITT_ARGS.update({"soilmoisture{channel}".format(channel=channel): "soilhum{channel}".format(channel=channel)
+                     for channel in range(1, SENSOR_CHANNELS + 1)})
+ECOWITT_ARGS.update({"leak_ch{channel}".format(channel=channel): "leak{channel}".format(channel=channel)
+                     for channel in range(1, LEAK_CHANNELS + 1)})
+# Ecowitt battery flags are 0 when the battery is OK, while Ambient Weather's are 1
+ECOWITT_INVERTED_BATTERIES = {"wh65batt": "battout"}
+ECOWITT_INVERTED_BATTERIES.update({"batt{channel}".format(channel=channel): "batt{channel}".format(channel=channel)
+                                   for channel in range(1, SENSOR_CHANNELS + 1)})
+# Arguments that describe the gateway rather than being a sensor
+ECOWITT_IGNORED_ARGS = {"hourlyrainin", "freq", "model", "runtime", "heap", "interval"}
+
+# Weather Underground's upload protocol (updateweatherstation.php)
+# Reference: https://support.weather.com/s/article/PWS-Upload-Protocol
+# Weather Underground argument -> Ambient Weather argument
+WUNDERGROUND_ARGS = {
+    "ID": "PASSKEY",
+    "softwaretype": "stationtype",
+    "baromin": "baromrelin",
+    "absbaromin": "baromabsin",
+    # rainin is the rain over the last hour, which is the closest we have to Ambient Weather's hourly rate
+    "rainin": "hourlyrainin",
+    "UV": "uv",
+    "indoortempf": "tempinf",
+    "indoorhumidity": "humidityin",
+}
+# Arguments that aren't a sensor or that we calculate ourselves (ex: dew point). PASSWORD is dropped so it's never logged
+WUNDERGROUND_IGNORED_ARGS = {"PASSWORD", "action", "realtime", "rtfreq", "dewptf", "windchillf"}
+
+
+def __invert_battery(value):
+    """
+    Converts an Ecowitt battery flag (0 = OK) to Ambient Weather's (1 = OK)
+    :return: the converted flag, or None if the value isn't a flag (ex: empty, or a voltage from a sensor that reports one)
+    """
+    try:
+        flag = float(value)
+    except ValueError:
+        return None
+    if flag == 0:
+        return "1"
+    if flag == 1:
+        return "0"
+    return None
+
+
+def from_ecowitt(args):
+    """
+    Translates the arguments of an Ecowitt upload to their Ambient Weather equivalent
+    """
+    translated = {}
+    for key, value in args.items():
+        if key in ECOWITT_IGNORED_ARGS:
+            continue
+        if key in ECOWITT_INVERTED_BATTERIES:
+            flag = __invert_battery(value)
+            if flag is None:
+                # Counted the same as an argument we don't know, rather than reporting a battery status we can't be sure of
+                logger.debug("Skipping battery {} as {} isn't a battery flag", key, value)
+                metrics.count_unknown_arg(key)
+                continue
+            translated[ECOWITT_INVERTED_BATTERIES[key]] = flag
+            continue
+        translated[ECOWITT_ARGS.get(key, key)] = value
+    return translated
+
+
+def from_wunderground(args):
+    """
+    Translates the arguments of a Weather Underground upload to their Ambient Weather equivalent
+    """
+    return {WUNDERGROUND_ARGS.get(key, key): value for key, value in args.items() if key not in WUNDERGROUND_IGNORED_ARGS}
+
+
+# Protocol name (ex: as used by the bulk endpoint) -> function translating its arguments
+TRANSLATORS = {
+    "ambientweather": dict,
+    "ecowitt": from_ecowitt,
+    "wunderground": from_wunderground,
+}
@@ -0,0 +1,543 @@
+import math
+from collections import namedtuple
+from config import CONFIG
+
+
+# numpy is only needed for batches (generate_columns), so it's imported on first use to keep startup fast
+np = None
+
+
+def __import_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+# How many of the optional (numbered) add-on sensors we know how to parse. Ex: temp1f..temp8f
+SENSOR_CHANNELS = 8
+LEAK_CHANNELS = 4
+
+
+# Home Assistant discovery metadata for a single output value
+HADiscovery = namedtuple("HADiscovery", ["name", "uniqueid", "value_template", "unit_of_measurement", "device_class", "icon", "state_class"])
+
+# A single value written to the json payload
+# :param path: the json path to write to (ex: temperature.outdoor.celsius)
+# :param parents: the keys of the dicts the value is nested in (ex: ("temperature", "outdoor"))
+# :param leaf: the key the value is written to (ex: "celsius")
+# :param convert: the function used to convert the raw value to the value to write
+# :param ha: HADiscovery metadata if this value should be sent to Home Assistant, otherwise None
+# :param convert_array: for numeric values, converts a numpy array of values (before rounding) for generate_columns. Otherwise None
+Output = namedtuple("Output", ["path", "parents", "leaf", "convert", "ha", "convert_array"])
+
+# An argument sent by the Ambient Weather station and the outputs generated from it
+SensorSpec = namedtuple("SensorSpec", ["key", "outputs"])
+
+# A value calculated from multiple arguments (ex: dew point)
+# :param compute: called with the raw value of each of the inputs (in order). The result is passed to each output's convert
+# :param compute_array: as compute, but called with a numpy array of each input (parsed as a float) for generate_columns
+DerivedSpec = namedtuple("DerivedSpec", ["inputs", "compute", "outputs", "compute_array"])
+
+
+def set_value(data, parents, leaf, value):
+    """
+    Writes a value into a nested dict, creating the parent dicts as required (ex: data["rain"]["total"]["mm"] = value)
+    :param data: the dict to update
+    :param parents: the keys of the dicts the value is nested in (ex: ("rain", "total"))
+    :param leaf: the key to write the value to (ex: "mm")
+    :param value: the value to save to the dict (ex: 12)
+    """
+    for key in parents:
+        data = data.setdefault(key, {})
+    data[leaf] = value
+
+
+def flatten(data, parents=()):
+    """
+    Yields each value in a nested dict along with the keys leading to it (ex: (("rain", "total", "mm"), 12))
+    """
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from flatten(value, parents + (key,))
+        else:
+            yield parents + (key,), value
+
+
+def __rounded(value):
+    """
+    Takes a float and returns it rounded to PRECISION
+    """
+    return round(float(value), CONFIG.precision)
+
+
+def __convert_battery_to_percent(value):
+    """
+    Converts the battery int value to a percentage
+    """
+    return int(value) * 100
+
+
+def __convert_in_to_mm(value):
+    """
+    Converts inches to mm
+    """
+    return value * 25.4
+
+
+def __convert_f_to_c(value):
+    """
+    Converts farenheit to celcius
+    """
+    return (value - 32) * 5 / 9
+
+
+def __convert_c_to_f(value):
+    """
+    Converts celcius to farenheit
+    """
+    return (value * 9 / 5) + 32
+
+
+def __convert_inhg_to_hpa(value):
+    """
+    Converts inHg to hPa
+    """
+    return value * 33.86389
+
+
+def __convert_mph_to_kph(value):
+    """
+    Converts MPH to KPH
+    """
+    return value * 1.609344
+
+
+def __convert_mph_to_mps(value):
+    """
+    Converts MPH to m/s
+    """
+    return value * 0.44704
+
+
+def __convert_mph_to_fps(value):
+    """
+    Converts MPH to ft/s
+    """
+    return value * 1.466667
+
+
+def __convert_mph_to_knots(value):
+    """
+    Converts MPH to knots
+    """
+    return value * 0.868976
+
+
+def __convert_wm2_to_lux(value):
+    """
+    Convert W/m^2 to lux (See https://ambientweather.com/faqs/question/view/id/1452/.)
+    """
+    return value * 126.7
+
+
+def __convert_rain_rate_to_status(value):
+    """
+    We evaluate whether it's raining using the hourly rain rate:
+      https://ambientweather.com/faqs/question/view/id/1454/
+    """
+    if float(value) > 0:
+        # It's currently raining
+        return "Raining"
+    return "Not Raining"
+
+
+def __convert_leak_to_status(value):
+    """
+    Converts the leak detector value (0 = no leak, 1 = leak, 2 = offline) to a status
+    """
+    return {0: "No Leak", 1: "Leak Detected"}.get(int(value), "Offline")
+
+
+def __calculate_dew_point_c(temp_c, humidity):
+    """
+    Calculates the dew point (Celsius) from the temperature and relative humidity
+    :param temp_c: the temperature in celsius
+    :param humidity: the relatie humidity (%)
+    """
+    A = 17.625
+    B = 243.04
+    result = ((A * temp_c) / (B + temp_c)) + math.log(humidity / 100.0)
+    return (B * result) / (A - result)
+
+
+def __calculate_feels_like_temp(temp_f, humidity, wind_speed_mph):
+    """
+    Calculates the 'feels like' temperature
+    :param temp_f: the temerature in farenheit
+    :param humidity: the relatie humidity (%)
+    :param wind_speed_mph: the wind speed in mph
+    """
+
+    # References:
+    # https://ambientweather.com/faqs/question/view/id/2033/
+    # https://www.wpc.ncep.noaa.gov/html/heatindex_equation.shtml
+    # https://sciencing.com/calculate-wind-chill-factor-5981683.html
+
+    # If it's cold, we use the wind chill
+    # The Ambient Weather link above has a different threshold than the sciencing.com link.
+    # As sciencing.com sounds more 'sciency', I'm starting with those thresholds for now.
+    if temp_f <= 50 and wind_speed_mph >= 3:
+        # Wind chill = 35.74 + 0.6215T – 35.75 (V^0.16) + 0.4275T (V^0.16)
+        return 35.74 + (0.6215 * temp_f) - 35.75 * (wind_speed_mph ** 0.16) + ((0.4275 * temp_f) * (wind_speed_mph ** 0.16))
+
+    # If it's warm, use the heat index
+    # Using https://www.wpc.ncep.noaa.gov/html/heatindex_equation.shtml for this
+    if temp_f >= 80:
+        # Steadman
+        heat_index_temp = 0.5 * (temp_f + 61.0 + ((temp_f - 68.0) * 1.2) + (humidity * 0.094))
+
+        # Rothfusz regression
+        if heat_index_temp >= 80:
+            heat_index_temp = (
+                -42.379 + 2.04901523 * temp_f + 10.14333127 * humidity - 0.22475541 * temp_f * humidity - 0.00683783 *
+                temp_f * temp_f - 0.05481717 * humidity * humidity + 0.00122874 * temp_f * temp_f * humidity + 0.00085282 *
+                temp_f * humidity * humidity - 0.00000199 * temp_f * temp_f * humidity * humidity
+                )
+            if humidity < 13 and temp_f >= 80 and temp_f <= 112:
+                heat_index_temp = heat_index_temp - ((13 - humidity) / 4) * math.sqrt((17 - math.fabs(temp_f - 95.0)) / 17)
+            if humidity > 85 and temp_f >= 80 and temp_f <= 87:
+                heat_index_temp = heat_index_temp + ((humidity - 85) / 10) * ((87 - temp_f) / 5)
+
+        return heat_index_temp
+
+    # Netiher wind chill or heat index take effect. Return the current temp.
+    return float(temp_f)
+
+
+# The __convert_* functions work on both floats and numpy arrays. The calculations need separate array versions (used by
+# generate_columns). Each must do the same operations in the same order as the scalar version so the results are identical
+# (not just close) after rounding
+
+def __apply_exact(function, values):
+    """
+    Applies a math module function to each value. numpy's log/pow can differ from the math module in the last bit, so instead we call
+    the math function once per distinct value (there are only a handful, ex: humidity is 0-100). Values it can't handle become NaN
+    """
+    def apply(value):
+        try:
+            return function(value)
+        except (ValueError, OverflowError):
+            return math.nan
+
+    distinct, inverse = np.unique(values, return_inverse=True)
+    return np.array([apply(value) for value in distinct.tolist()], dtype=np.float64)[inverse.reshape(-1)]
+
+
+def __array_dew_point_c(temp_c, humidity):
+    """
+    Array version of __calculate_dew_point_c
+    """
+    A = 17.625
+    B = 243.04
+    result = ((A * temp_c) / (B + temp_c)) + __apply_exact(math.log, humidity / 100.0)
+    return (B * result) / (A - result)
+
+
+def __array_feels_like_temp(temp_f, humidity, wind_speed_mph):
+    """
+    Array version of __calculate_feels_like_temp. Every formula is calculated for every value, then the one that applies is picked
+    """
+    wind_factor = __apply_exact(lambda value: value ** 0.16, wind_speed_mph)
+    wind_chill = 35.74 + (0.6215 * temp_f) - 35.75 * wind_factor + ((0.4275 * temp_f) * wind_factor)
+
+    steadman = 0.5 * (temp_f + 61.0 + ((temp_f - 68.0) * 1.2) + (humidity * 0.094))
+    rothfusz = (
+        -42.379 + 2.04901523 * temp_f + 10.14333127 * humidity - 0.22475541 * temp_f * humidity - 0.00683783 *
+        temp_f * temp_f - 0.05481717 * humidity * humidity + 0.00122874 * temp_f * temp_f * humidity + 0.00085282 *
+        temp_f * humidity * humidity - 0.00000199 * temp_f * temp_f * humidity * humidity
+        )
+    with np.errstate(invalid="ignore"):
+        dry_adjusted = rothfusz - ((13 - humidity) / 4) * np.sqrt((17 - np.fabs(temp_f - 95.0)) / 17)
+    humid_adjusted = rothfusz + ((humidity - 85) / 10) * ((87 - temp_f) / 5)
+    rothfusz = np.where((humidity < 13) & (temp_f >= 80) & (temp_f <= 112), dry_adjusted, rothfusz)
+    rothfusz = np.where((humidity > 85) & (temp_f >= 80) & (temp_f <= 87), humid_adjusted, rothfusz)
+    heat_index = np.where(steadman >= 80, rothfusz, steadman)
+
+    return np.where((temp_f <= 50) & (wind_speed_mph >= 3), wind_chill, np.where(temp_f >= 80, heat_index, temp_f))
+
+
+def __output(path, convert, name=None, unit_of_measurement=None, device_class=None, icon=None, state_class=None, convert_array=None):
+    """
+    Builds an Output. If name is set, the output is also sent to Home Assistant as a sensor (with the path as its unique ID)
+    """
+    ha = None
+    if name is not None:
+        ha = HADiscovery(name, path, "{{ value_json." + path + " }}", unit_of_measurement, device_class, icon, state_class)
+    keys = tuple(path.split("."))
+    return Output(path, keys[:-1], keys[-1], convert, ha, convert_array)
+
+
+def __rounded_output(path, name=None, convert=None, **kwargs):
+    """
+    Builds an Output for a float rounded to PRECISION, optionally converted first (ex: __convert_f_to_c)
+    """
+    if convert is None:
+        return __output(path, __rounded, name, convert_array=lambda values: values, **kwargs)
+    return __output(path, lambda value: __rounded(convert(float(value))), name, convert_array=convert, **kwargs)
+
+
+def __temperature_outputs(path, name):
+    """
+    Outputs for a temperature provided in farenheit
+    Only send celsius to HA as HA supports conversion (https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes)
+    """
+    return (
+        __rounded_output(path + ".fahrenheit"),
+        __rounded_output(path + ".celsius", name, convert=__convert_f_to_c, unit_of_measurement="°C", device_class="temperature"),
+    )
+
+
+def __pressure_outputs(path, name):
+    """
+    Outputs for a pressure provided in inHg
+    Only send mmHg to HA as HA supports conversion (https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes)
+    """
+    return (
+        __rounded_output(path + ".inhg"),
+        __rounded_output(path + ".mmhg", name, convert=__convert_in_to_mm, unit_of_measurement="mmHg", device_class="pressure"),
+        __rounded_output(path + ".hpa", convert=__convert_inhg_to_hpa),
+    )
+
+
+def __wind_outputs(path, name):
+    """
+    Outputs for a wind speed provided in mph
+    HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
+    """
+    icon = "mdi:weather-windy"
+    return (
+        __rounded_output(path + ".mph", name + " (mph)", unit_of_measurement="mph", icon=icon),
+        __rounded_output(path + ".kph", name + " (kph)", convert=__convert_mph_to_kph, unit_of_measurement="kph", icon=icon),
+        __rounded_output(path + ".mps", name + " (m/s)", convert=__convert_mph_to_mps, unit_of_measurement="m/s", icon=icon),
+        __rounded_output(path + ".ftps", name + " (ft/s)", convert=__convert_mph_to_fps, unit_of_measurement="ft/s", icon=icon),
+        __rounded_output(path + ".knots", name + " (knots)", convert=__convert_mph_to_knots, unit_of_measurement="knots",
+                         icon=icon),
+    )
+
+
+def __rain_outputs(path, name):
+    """
+    Outputs for a rain volume provided in inches
+    HA doesnt support conversion natively in the entity UI. As such, we send multiple and users can choose
+    """
+    return (
+        __rounded_output(path + ".in", name + " (in)", unit_of_measurement="in", icon="mdi:water", state_class="total"),
+        __rounded_output(path + ".mm", name + " (mm)", convert=__convert_in_to_mm, unit_of_measurement="mm", icon="mdi:water",
+                         state_class="total"),
+    )
+
+
+def __battery_outputs(path, name):
+    """
+    Outputs for a battery status (1 = OK, 0 = low)
+    """
+    return (
+        __output(path, __convert_battery_to_percent, name, unit_of_measurement="%", device_class="battery", icon="mdi:battery"),
+    )
+
+
+def __humidity_outputs(path, name):
+    """
+    Outputs for a relative humidity (%)
+    """
+    return (
+        __output(path + ".percentage", int, name, unit_of_measurement="%", device_class="humidity"),
+    )
+
+
+def __build_sensors():
+    """
+    Builds the lookup of each known Ambient Weather argument to its SensorSpec
+    Reference: https://github.com/ambient-weather/api-docs/wiki/Device-Data-Specs
+    """
+    specs = [
+        SensorSpec("battout", __battery_outputs("station.battery.outdoor", "Outdoor Battery")),
+        SensorSpec("batt_co2", __battery_outputs("station.battery.co2", "CO2 Battery")),
+        SensorSpec("humidityin", __humidity_outputs("humidity.indoor", "Indoor Humidity")),
+        SensorSpec("humidity", __humidity_outputs("humidity.outdoor", "Outdoor Humidity")),
+        SensorSpec("tempinf", __temperature_outputs("temperature.indoor", "Indoor Temperature")),
+        SensorSpec("tempf", __temperature_outputs("temperature.outdoor", "Outdoor Temperature")),
+        SensorSpec("baromrelin", __pressure_outputs("pressure.relative", "Relative Pressure")),
+        SensorSpec("baromabsin", __pressure_outputs("pressure.absolute", "Absolute Pressure")),
+        SensorSpec("winddir", (
+            __output("wind.direction.degrees", int, "Wind Direction", unit_of_measurement="°", icon="mdi:compass"),
+        )),
+        SensorSpec("windspeedmph", __wind_outputs("wind.speed", "Wind Speed")),
+        SensorSpec("windgustmph", __wind_outputs("wind.gust", "Wind Gust")),
+        SensorSpec("maxdailygust", __wind_outputs("wind.daily.gust", "Wind Max. Daily Gust")),
+        # Even though you'd think hourlyrainin and dailyrainin would be similar measurements, they're not...
+        #   hourlyrainin is an hourly rate (in/h) while the others are total volume
+        SensorSpec("hourlyrainin", (
+            __rounded_output("rain.hourlyrate.inh", "Hourly Rain Rate (in/h)", unit_of_measurement="in/h", icon="mdi:water", state_class="total"),
+            __rounded_output("rain.hourlyrate.mmh", "Hourly Rain Rate (mm/h)", convert=__convert_in_to_mm, unit_of_measurement="mm/h",
+                             icon="mdi:water", state_class="total"),
+            __output("rain.currentstatus", __convert_rain_rate_to_status, "Rain Status", icon="mdi:water"),
+        )),
+        SensorSpec("eventrainin", __rain_outputs("rain.event", "Event Rain")),
+        SensorSpec("dailyrainin", __rain_outputs("rain.daily", "Daily Rain")),
+        SensorSpec("weeklyrainin", __rain_outputs("rain.weekly", "Weekly Rain")),
+        SensorSpec("monthlyrainin", __rain_outputs("rain.monthly", "Monthly Rain")),
+        SensorSpec("totalrainin", __rain_outputs("rain.total", "Total Rain")),
+        SensorSpec("solarradiation", (
+            __rounded_output("solarradiation.wm2", "Solar Radiation (W/m²)", unit_of_measurement="W/m²", icon="mdi:white-balance-sunny"),
+            __rounded_output("solarradiation.lux", "Solar Radiation (lux)", convert=__convert_wm2_to_lux, unit_of_measurement="lux",
+                             icon="mdi:white-balance-sunny"),
+        )),
+        SensorSpec("uv", (
+            __output("uv.index", int, "UV Index", unit_of_measurement="Index", icon="mdi:white-balance-sunny"),
+        )),
+        SensorSpec("pm25", (
+            __rounded_output("airquality.outdoor.pm25", "Outdoor PM2.5", unit_of_measurement="µg/m³", device_class="pm25"),
+        )),
+        SensorSpec("pm25_24h", (
+            __rounded_output("airquality.outdoor.pm25_24h", "Outdoor PM2.5 (24h Average)", unit_of_measurement="µg/m³", device_class="pm25"),
+        )),
+        SensorSpec("pm25_in", (
+            __rounded_output("airquality.indoor.pm25", "Indoor PM2.5", unit_of_measurement="µg/m³", device_class="pm25"),
+        )),
+        SensorSpec("pm25_in_24h", (
+            __rounded_output("airquality.indoor.pm25_24h", "Indoor PM2.5 (24h Average)", unit_of_measurement="µg/m³", device_class="pm25"),
+        )),
+        SensorSpec("batt_25", __battery_outputs("station.battery.pm25", "PM2.5 Battery")),
+    ]
+
+    # Optional add-on sensors (ex: WH31E / WH31S) report on numbered channels
+    for channel in range(1, SENSOR_CHANNELS + 1):
+        specs.extend([
+            SensorSpec("temp{}f".format(channel), __temperature_outputs("temperature.channel{}".format(channel), "Temperature {}".format(channel))),
+            SensorSpec("humidity{}".format(channel), __humidity_outputs("humidity.channel{}".format(channel), "Humidity {}".format(channel))),
+            SensorSpec("soilhum{}".format(channel), (
+                __output("soil.channel{}.moisture".format(channel), int, "Soil Moisture {}".format(channel), unit_of_measurement="%",
+                         device_class="moisture"),
+            )),
+            SensorSpec("batt{}".format(channel), __battery_outputs("station.battery.channel{}".format(channel), "Sensor {} Battery".format(channel))),
+        ])
+
+    for channel in range(1, LEAK_CHANNELS + 1):
+        specs.append(SensorSpec("leak{}".format(channel), (
+            __output("leak.channel{}.status".format(channel), __convert_leak_to_status, "Leak Detector {}".format(channel), icon="mdi:water-alert"),
+        )))
+
+    return {spec.key: spec for spec in specs}
+
+
+def __build_derived():
+    """
+    Builds the list of values calculated from multiple arguments
+    """
+    return (
+        # Calculate dew point from the temp and humidity
+        # Only send once as HA supports conversion (https://developers.home-assistant.io/docs/core/entity/sensor/#available-device-classes)
+        DerivedSpec(
+            ("tempf", "humidity"),
+            lambda temp_f, humidity: __calculate_dew_point_c(__convert_f_to_c(float(temp_f)), int(humidity)),
+            (
+                __rounded_output("temperature.dewpoint.fahrenheit", convert=__convert_c_to_f),
+                __rounded_output("temperature.dewpoint.celsius", "Dew Point Temperature", unit_of_measurement="°C", device_class="temperature"),
+            ),
+            lambda temp_f, humidity: __array_dew_point_c(__convert_f_to_c(temp_f), humidity),
+        ),
+        # Calculate 'Feels Like' from the temp, humidity, and windspeed
+        DerivedSpec(
+            ("tempf", "humidity", "windspeedmph"),
+            lambda temp_f, humidity, wind_speed_mph: __calculate_feels_like_temp(float(temp_f), int(humidity), float(wind_speed_mph)),
+            (
+                __rounded_output("temperature.feelslike.fahrenheit"),
+                __rounded_output("temperature.feelslike.celsius", "Feels Like Temperature", convert=__convert_f_to_c, unit_of_measurement="°C",
+                                 device_class="temperature"),
+            ),
+            __array_feels_like_temp,
+        ),
+    )
+
+
+# Ambient Weather argument -> SensorSpec
+SENSORS = __build_sensors()
+DERIVED = __build_derived()
+# json path -> Output, for every value we can generate
+OUTPUTS = {output.path: output for spec in list(SENSORS.values()) + list(DERIVED) for output in spec.outputs}
+
+
+def __parse_floats(values):
+    """
+    Parses a column of raw values to a numpy array. Missing values (None) become NaN
+    """
+    return np.array([math.nan if value is None else float(value) for value in values], dtype=np.float64)
+
+
+def __round_column(values, missing):
+    """
+    Rounds each value to PRECISION, exactly as round() would. Missing and invalid values become None
+    """
+    # Scaling, rounding to an int and scaling back gives the same result as round() unless the scaled value is (almost) exactly
+    # halfway between two ints, where the error from scaling can tip it either way. Those few are rounded with round() itself
+    scale = 10.0 ** CONFIG.precision
+    with np.errstate(all="ignore"):
+        scaled = values * scale
+        rounded = np.rint(scaled) / scale
+        halfway = np.abs(scaled - np.floor(scaled) - 0.5) <= 1e-9 * (1 + np.abs(scaled))
+    invalid = ~np.isfinite(rounded)
+    for index in np.flatnonzero(halfway & ~invalid).tolist():
+        rounded[index] = round(float(values[index]), CONFIG.precision)
+
+    result = rounded.tolist()
+    for index in np.flatnonzero(invalid | np.asarray(missing, dtype=bool)).tolist():
+        result[index] = None
+    return result
+
+
+def generate_columns(columns):
+    """
+    Converts many readings at once, computing each numeric value for every reading with numpy. Values are identical to those
+    generate_sensor_dict produces for each reading
+    :param columns: Ambient Weather argument -> the raw value in each reading (None if the reading doesn't have it). Ex: {"tempf": ["55.8", "56.1"]}
+    :return: json path -> the value for each reading (None if the reading doesn't have it)
+    """
+    __import_numpy()
+    results = {}
+    parsed = {}
+
+    for key, raw in columns.items():
+        spec = SENSORS.get(key)
+        if spec is None:
+            continue
+
+        missing = [value is None for value in raw]
+        for output in spec.outputs:
+            if output.convert_array is None:
+                # Not a number (ex: a status) or an int, so there's nothing to gain from numpy
+                results[output.path] = [None if value is None else output.convert(value) for value in raw]
+                continue
+
+            if key not in parsed:
+                parsed[key] = __parse_floats(raw)
+            results[output.path] = __round_column(output.convert_array(parsed[key]), missing)
+
+    for derived in DERIVED:
+        if not all(key in columns for key in derived.inputs):
+            continue
+
+        inputs = []
+        for key in derived.inputs:
+            if key not in parsed:
+                parsed[key] = __parse_floats(columns[key])
+            inputs.append(parsed[key])
+        missing = np.isnan(np.column_stack(inputs)).any(axis=1).tolist()
+
+        with np.errstate(all="ignore"):
+            result = derived.compute_array(*inputs)
+            for output in derived.outputs:
+                results[output.path] = __round_column(output.convert_array(result), missing)
+
+    return results
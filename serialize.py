@@ -0,0 +1,27 @@
+import json
+
+# orjson is optional. It's several times faster than the json module and writes bytes directly, which is what paho sends
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    ENCODER = "orjson"
+
+    def dumps(data):
+        """
+        Serializes data to compact json bytes
+        """
+        return orjson.dumps(data)
+else:
+    ENCODER = "json"
+    # Matches orjson's output: no spaces and non-ASCII characters (ex: °) written as UTF-8 rather than escaped
+    __encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+    def dumps(data):
+        """
+        Serializes data to compact json bytes
+        """
+        return __encoder.encode(data).encode("utf-8")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules live in the repository root rather than a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
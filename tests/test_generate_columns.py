@@ -0,0 +1,112 @@
+"""
+Checks sensors.generate_columns produces exactly the same values (bit for bit) as converting each reading on its own, as
+generate_sensor_dict does
+"""
+import math
+import struct
+import pytest
+from sensors import SENSORS, DERIVED, generate_columns
+
+
+def generate_scalar(columns):
+    """
+    Converts each reading one at a time, the same way generate_sensor_dict does. Missing values (None) stay None
+    """
+    results = {}
+    rows = len(next(iter(columns.values())))
+    for row in range(rows):
+        args = {key: values[row] for key, values in columns.items()}
+        for key, value in args.items():
+            for output in SENSORS[key].outputs:
+                results.setdefault(output.path, []).append(None if value is None else output.convert(value))
+        for derived in DERIVED:
+            if not all(key in columns for key in derived.inputs):
+                continue
+            inputs = [args[key] for key in derived.inputs]
+            result = None if None in inputs else derived.compute(*inputs)
+            for output in derived.outputs:
+                results.setdefault(output.path, []).append(None if result is None else output.convert(result))
+    return results
+
+
+def bits(value):
+    """
+    Returns the value in a form that's only equal if the values are identical, including the type and sign of zero
+    """
+    if isinstance(value, float):
+        return float, struct.pack("<d", value)
+    return type(value), value
+
+
+def assert_identical(columns):
+    expected = generate_scalar(columns)
+    actual = generate_columns(columns)
+    assert sorted(actual) == sorted(expected)
+
+    for path, values in expected.items():
+        mismatches = [(row, {key: column[row] for key, column in columns.items()}, value, actual[path][row])
+                      for row, value in enumerate(values) if bits(value) != bits(actual[path][row])]
+        assert mismatches[:5] == [], "{count} values of {path} differ".format(count=len(mismatches), path=path)
+
+
+def test_dense_grid():
+    # Every temperature (-40°F to 120°F) and humidity (1% to 100%) with wind speeds cycling from 0 to 40 mph, so wind chill,
+    # heat index (and both of its adjustments) and neither are all covered
+    columns = {"tempf": [], "humidity": [], "windspeedmph": [], "baromrelin": [], "hourlyrainin": [], "solarradiation": []}
+    row = 0
+    for temp_index in range(1601):
+        for humidity in range(1, 101, 3):
+            columns["tempf"].append("{:.1f}".format(-40 + temp_index / 10))
+            columns["humidity"].append(str(humidity))
+            columns["windspeedmph"].append("{:.1f}".format((row % 401) / 10))
+            columns["baromrelin"].append("{:.2f}".format(28 + (row % 300) / 100))
+            columns["hourlyrainin"].append("{:.3f}".format((row % 1000) / 1000))
+            columns["solarradiation"].append("{:.2f}".format((row % 120000) / 100))
+            row += 1
+    assert_identical(columns)
+
+
+@pytest.mark.parametrize("tempf", ["79.9", "80", "80.1", "86.9", "87", "87.1", "94.9", "95", "95.1", "111.9", "112", "112.1"])
+def test_heat_index_adjustment_boundaries(tempf):
+    # The dry adjustment applies below 13% between 80°F and 112°F, the humid one above 85% between 80°F and 87°F
+    humidities = ["1", "12", "13", "14", "50", "84", "85", "86", "100"]
+    assert_identical({"tempf": [tempf] * len(humidities), "humidity": humidities, "windspeedmph": ["0"] * len(humidities)})
+
+
+@pytest.mark.parametrize("tempf", ["-40", "0", "49.9", "50", "50.1"])
+def test_wind_chill_thresholds(tempf):
+    # Wind chill applies at or below 50°F with at least 3 mph of wind
+    wind_speeds = ["0", "2.9", "2.99", "3", "3.0", "3.01", "3.1", "40"]
+    assert_identical({"tempf": [tempf] * len(wind_speeds), "humidity": ["50"] * len(wind_speeds), "windspeedmph": wind_speeds})
+
+
+def test_missing_values():
+    # Readings without a value (ex: in a bulk upload mixing stations) leave out that value and the values calculated from it
+    assert_identical({
+        "tempf": ["55.8", None, "81.2", "30.0"],
+        "humidity": ["96", "40", None, "50"],
+        "windspeedmph": [None, "4.5", "0.0", "10.2"],
+    })
+
+
+def test_missing_column():
+    # Values calculated from an argument that isn't in any reading aren't generated at all
+    columns = {"tempf": ["55.8", "81.2"], "humidity": ["96", "40"]}
+    assert_identical(columns)
+    assert "temperature.feelslike.fahrenheit" not in generate_columns(columns)
+
+
+def test_nan_values():
+    # float("nan") parses, but isn't a value. It's left out (as json null) rather than treated as a number
+    columns = {"tempf": ["nan", "55.8", "NaN"], "humidity": ["50", "96", "10"], "windspeedmph": ["5.0", "5.0", "nan"]}
+    expected = generate_scalar(columns)
+    actual = generate_columns(columns)
+    for path, values in expected.items():
+        for value, actual_value in zip(values, actual[path]):
+            if isinstance(value, float) and math.isnan(value):
+                assert actual_value is None, path
+            else:
+                assert bits(actual_value) == bits(value), path
+    assert actual["temperature.outdoor.fahrenheit"] == [None, 55.8, None]
+    assert actual["temperature.dewpoint.celsius"][0] is None
+    assert actual["temperature.feelslike.celsius"][2] is None